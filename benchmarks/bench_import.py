@@ -0,0 +1,64 @@
+import os, sys, json, time, argparse, subprocess, statistics
+
+# Measures how long a fresh interpreter needs for `import malfetcher` and checks that
+# the import stays free of side effects (no oauth stack, no config prompt).
+# Usage: python benchmarks/bench_import.py [--runs 10] [--max-ms 400]
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+heavy_modules = ['flask', 'gevent', 'gevent.pywsgi', 'webbrowser', 'aiohttp']
+
+probe = f"""
+import sys, time, json
+started = time.perf_counter()
+import malfetcher
+elapsed = time.perf_counter() - started
+print(json.dumps({{
+    'import_ms': elapsed * 1000,
+    'heavy_modules': [module for module in {heavy_modules!r} if module in sys.modules],
+    'client_id_resolved': malfetcher.mal_fetcher.client_id is not None
+}}))
+"""
+
+def run_probe():
+    env = dict(os.environ)
+    env.pop('MAL_CLIENT_ID', None)
+    env['PYTHONPATH'] = repo_path + os.pathsep + env.get('PYTHONPATH', '')
+    # stdin is closed, an input() prompt during import fails the run instead of hanging it
+    result = subprocess.run([sys.executable, '-c', probe], env=env, stdin=subprocess.DEVNULL, capture_output=True, text=True, cwd=repo_path)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing malfetcher failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--max-ms', type=float, default=None, help="fail when the median import time is above this")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    runs = [run_probe() for _ in range(args.runs)]
+    import_times = [run['import_ms'] for run in runs]
+    report = {
+        'runs': args.runs,
+        'median_ms': statistics.median(import_times),
+        'min_ms': min(import_times),
+        'max_ms': max(import_times),
+        'heavy_modules': sorted({module for run in runs for module in run['heavy_modules']}),
+        'client_id_resolved': any(run['client_id_resolved'] for run in runs),
+        'total_s': time.perf_counter() - started
+    }
+    print(json.dumps(report, indent=4))
+
+    failures = []
+    if report['heavy_modules']:
+        failures.append(f"heavy modules loaded on import: {', '.join(report['heavy_modules'])}")
+    if report['client_id_resolved']:
+        failures.append("client id was resolved on import")
+    if args.max_ms is not None and report['median_ms'] > args.max_ms:
+        failures.append(f"median import time {report['median_ms']:.1f}ms is above {args.max_ms}ms")
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import os, sys, json, argparse, tracemalloc
+
+# Memory held by a cache worth of entries as plain dicts (as they come out of the json cache)
+# compared to AnimeEntry models.
+# Usage: python benchmarks/bench_memory.py [--anime 20000]
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_path)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('MAL_CLIENT_ID', 'benchmark')
+from stub_server import make_franchises
+from malfetcher.mal_fetcher import build_anime_entry, get_relation_edges, build_related, mal_to_al_status
+from malfetcher.models import to_models
+
+def build_cache(count):
+    anime = make_franchises(max(count // 3, 1))
+    statuses = {str(anime_id): mal_to_al_status[node['status']] for anime_id, node in anime.items()}
+    entries = {}
+    for anime_id, node in anime.items():
+        related = build_related(get_relation_edges(node['related_anime']), statuses)
+        entry = build_anime_entry(node, anime_id + 100000, related)
+        entry.update(watched_ep=3, watching_status='CURRENT', rewatch_count=0)
+        entries[str(anime_id)] = entry
+    # Round trip through json so nothing is shared, like after loading the cache file
+    return json.dumps(entries)
+
+def measure(build):
+    tracemalloc.start()
+    data = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return data, size
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--anime', type=int, default=20000)
+    args = parser.parse_args()
+
+    raw = build_cache(args.anime)
+    dicts, dict_bytes = measure(lambda: json.loads(raw))
+    models, model_bytes = measure(lambda: to_models(json.loads(raw)))
+    assert all(models[anime_id] == dicts[anime_id] for anime_id in dicts)
+    report = {
+        'entries': len(dicts),
+        'dict_bytes': dict_bytes,
+        'model_bytes': model_bytes,
+        'dict_bytes_per_entry': dict_bytes / len(dicts),
+        'model_bytes_per_entry': model_bytes / len(models),
+        'saved': 1 - model_bytes / dict_bytes
+    }
+    print(json.dumps(report, indent=4))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import os, sys, json, time, tempfile, argparse
+
+# Forced refresh cycles against the local stub server, with and without the http cache.
+# --bandwidth slows the stub's response bodies down, on localhost a 304 saves next to nothing.
+# Usage: python benchmarks/bench_revalidation.py [--anime 300] [--cycles 3] [--bandwidth 65536]
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from stub_server import StubServer, make_franchises
+
+def use_temp_caches(mal_fetcher, cache_dir):
+    # Keep the benchmark away from the real caches
+    mal_fetcher.set_cache_dir(cache_dir)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--anime', type=int, default=300)
+    parser.add_argument('--cycles', type=int, default=3)
+    parser.add_argument('--bandwidth', type=int, default=65536, help="bytes per second, 0 for no limit")
+    args = parser.parse_args()
+
+    server = StubServer(make_franchises(max(args.anime // 3, 1))).start()
+    server.bandwidth = args.bandwidth
+    os.environ['MAL_API_URL'] = server.mal_url
+    os.environ['ANILIST_API_URL'] = server.anilist_url
+    os.environ.setdefault('MAL_CLIENT_ID', 'benchmark')
+    os.environ.setdefault('WEEB_SILENCE', '1')
+    os.environ['MAL_REFRESH_AUTO'] = '0'
+    os.environ['MAL_RESPONSE_MEMO_TTL'] = '0' # every refresh has to reach the server
+    import malfetcher
+    from malfetcher import mal_fetcher
+
+    anime_ids = sorted(server.anime)
+    report = {'anime': len(anime_ids), 'cycles': args.cycles, 'bandwidth': args.bandwidth}
+    try:
+        for label, enabled in (('without_http_cache', False), ('with_http_cache', True)):
+            with tempfile.TemporaryDirectory() as cache_dir:
+                use_temp_caches(mal_fetcher, cache_dir)
+                malfetcher.configure_http_cache(enabled)
+                malfetcher.get_anime_info_many(anime_ids)
+                server.reset_stats()
+                started = time.perf_counter()
+                for _ in range(args.cycles):
+                    malfetcher.get_anime_info_many(anime_ids, force_update=True)
+                elapsed = time.perf_counter() - started
+                stats = server.stats()
+                report[label] = {
+                    'seconds': elapsed,
+                    'requests': stats['requests'],
+                    'not_modified': stats['not_modified'],
+                    'bytes_received': stats['bytes_sent'],
+                    'paths': stats['paths'],
+                    'http_cache': malfetcher.get_http_cache_stats()
+                }
+                mal_fetcher.refresh_scheduler.stop()
+    finally:
+        server.stop()
+    print(json.dumps(report, indent=4))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import os, sys, json, time, shutil, tempfile, argparse
+
+# File size and load times of a full id cache in every storage format: the old indented json,
+# compact json with the stdlib and with orjson, and the binary record file.
+# Usage: python benchmarks/bench_serialization.py [--anime 20000] [--lookups 50] [--writes 20]
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_path)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('MAL_CLIENT_ID', 'benchmark')
+from bench_memory import build_cache
+from malfetcher import cache
+from malfetcher.utils import serializers
+
+def formats():
+    yield 'json_pretty', cache.JsonCache, 'json', True
+    yield 'json_compact', cache.JsonCache, 'json', False
+    if 'orjson' in serializers:
+        yield 'json_compact_orjson', cache.JsonCache, 'orjson', False
+    yield 'records', cache.RecordCache, 'json', False
+    if 'orjson' in serializers:
+        yield 'records_orjson', cache.RecordCache, 'orjson', False
+
+def best_time(function, repeat):
+    # The fastest run, full loads are noisy
+    results = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        results.append(time.perf_counter() - started)
+    return min(results)
+
+def bench_format(backend_class, entries, directory, lookups, writes):
+    file_path = os.path.join(directory, 'myanimelist_id_cache.json')
+    writer = backend_class(file_path)
+    started = time.perf_counter()
+    writer.save(entries)
+    save_seconds = time.perf_counter() - started
+    stored_path = writer.file_path
+
+    loaded = backend_class(file_path).load()
+    assert loaded == entries
+    keys = list(entries)[::max(len(entries) // lookups, 1)][:lookups]
+    # A fresh cache object per lookup, like a new process asking for one id
+    started = time.perf_counter()
+    for key in keys:
+        assert backend_class(file_path).get(key) == entries[key]
+    point_read = (time.perf_counter() - started) / len(keys)
+
+    started = time.perf_counter()
+    for index in range(writes):
+        key = keys[index % len(keys)]
+        writer.set(key, dict(entries[key], watched_ep=index))
+    update_one = (time.perf_counter() - started) / writes
+    return {
+        'file_bytes': os.path.getsize(stored_path),
+        'save_s': save_seconds,
+        'load_s': best_time(lambda: backend_class(file_path).load(), 5),
+        'point_read_ms': point_read * 1000,
+        'update_one_ms': update_one * 1000
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--anime', type=int, default=20000)
+    parser.add_argument('--lookups', type=int, default=50)
+    parser.add_argument('--writes', type=int, default=20)
+    args = parser.parse_args()
+
+    entries = json.loads(build_cache(args.anime))
+    report = {'entries': len(entries), 'formats': {}}
+    for name, backend_class, serializer, pretty in formats():
+        cache.configure_cache_format(serializer, pretty)
+        directory = tempfile.mkdtemp(prefix='malfetcher-serialization-')
+        try:
+            report['formats'][name] = bench_format(backend_class, entries, directory, args.lookups, args.writes)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    baseline = report['formats']['json_pretty']
+    for result in report['formats'].values():
+        result['size_vs_pretty'] = result['file_bytes'] / baseline['file_bytes']
+        result['load_speedup_vs_pretty'] = baseline['load_s'] / result['load_s']
+    print(json.dumps(report, indent=4))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+import os, sys, json, time, math, shutil, platform, tempfile, argparse, statistics
+
+# Offline benchmarks for the hot paths, against the local stub server. Prints one json report.
+# Usage: python benchmarks/bench_suite.py [--output report.json] [--replay recording.json] [--record recording.json]
+#
+# --record saves every stub response of the run, --replay serves a saved recording first
+# (one made with `stub_server.py --upstream` replays real MAL/AniList responses).
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stub_server import StubServer, make_franchises
+
+long_franchise_start = 500001
+
+def timings(function, repeat):
+    results = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        results.append(time.perf_counter() - started)
+    return {'median_s': statistics.median(results), 'min_s': min(results), 'runs': repeat}
+
+def counted(server, function):
+    server.reset_stats()
+    started = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - started
+    stats = server.stats()
+    return result, {'seconds': elapsed, 'requests': stats['requests'], 'bytes_received': stats['bytes_sent']}
+
+def bench_user_list(malfetcher, mal_fetcher, server, sizes, cache_dir):
+    report = {}
+    for size in sizes:
+        reset_caches(mal_fetcher, cache_dir)
+        server.set_list(sorted(server.anime)[:size])
+        entries, cold = counted(server, lambda: malfetcher.get_all_anime_for_user('ALL'))
+        _, warm = counted(server, lambda: malfetcher.get_all_anime_for_user('ALL'))
+        reset_caches(mal_fetcher, cache_dir)
+        _, minimal = counted(server, lambda: malfetcher.get_all_anime_for_user('ALL', projection='minimal'))
+        report[str(size)] = {'entries': len(entries or {}), 'cold': cold, 'warm': warm, 'minimal_cold': minimal}
+    return report
+
+def bench_list_sync(malfetcher, mal_fetcher, server, size, cache_dir, changes = 5):
+    # Repeated syncs of one big list, the snapshot reads only the rows changed since the last one
+    reset_caches(mal_fetcher, cache_dir)
+    server.set_list(sorted(server.anime)[:size])
+    _, cold = counted(server, lambda: malfetcher.get_all_anime_for_user('ALL'))
+    _, unchanged = counted(server, lambda: malfetcher.get_all_anime_for_user('ALL'))
+    for anime_id in sorted(server.list_status)[:changes]:
+        server.update_list_status(anime_id, num_episodes_watched=2)
+    entries, changed = counted(server, lambda: malfetcher.get_all_anime_for_user('ALL'))
+    assert all(entries[str(anime_id)]['watched_ep'] == 2 for anime_id in sorted(server.list_status)[:changes])
+    malfetcher.configure_user_list_sync(enabled=False)
+    try:
+        _, full_fetch = counted(server, lambda: malfetcher.get_all_anime_for_user('ALL'))
+    finally:
+        malfetcher.configure_user_list_sync(enabled=True)
+    return {'entries': size, 'cold': cold, 'unchanged': unchanged, f'{changes}_changed': changed, 'without_snapshot': full_fetch}
+
+def bench_season_ranges(malfetcher, mal_fetcher, server, seasons, cache_dir):
+    reset_caches(mal_fetcher, cache_dir)
+    middle = long_franchise_start + seasons // 2
+    ranges, cold = counted(server, lambda: malfetcher.get_season_ranges(middle))
+    _, warm = counted(server, lambda: malfetcher.get_season_ranges(middle))
+    _, other_season = counted(server, lambda: malfetcher.get_season_ranges(long_franchise_start))
+    return {'seasons': len(ranges or {}), 'cold': cold, 'warm': warm, 'other_season_warm': other_season}
+
+def bench_get_id(malfetcher, mal_fetcher, server, cache_dir):
+    reset_caches(mal_fetcher, cache_dir)
+    _, cold = counted(server, lambda: malfetcher.get_id("Franchise 7", amount=1))
+    _, warm = counted(server, lambda: malfetcher.get_id("Franchise 7", amount=1))
+    # A different spelling of a cached title, answered by the title index
+    _, fuzzy = counted(server, lambda: malfetcher.get_id("FRANCHISE-7", amount=1))
+    return {'cold': cold, 'warm': warm, 'fuzzy_warm': fuzzy}
+
+def fill_id_cache(mal_fetcher, server, count):
+    # count cached entries without going through the api, every tenth one still airing
+    anime_ids = sorted(server.anime)[:count]
+    statuses = {str(anime_id): mal_fetcher.mal_to_al_status[node['status']] for anime_id, node in server.anime.items()}
+    entries = {}
+    for anime_id in anime_ids:
+        node = server.anime[anime_id]
+        related = mal_fetcher.build_related(mal_fetcher.get_relation_edges(node['related_anime']), statuses)
+        entry = mal_fetcher.build_anime_entry(node, anime_id + 100000, related)
+        if anime_id % 10 == 0:
+            entry.update(status='RELEASING', upcoming_ep=3)
+        entries[str(anime_id)] = entry
+    with mal_fetcher.mal_id_cache.batch():
+        mal_fetcher.mal_id_cache.update(entries)
+    return len(entries)
+
+def bench_status_check(malfetcher, mal_fetcher, server, count, cache_dir):
+    reset_caches(mal_fetcher, cache_dir)
+    cached = fill_id_cache(mal_fetcher, server, count)
+    scheduler = mal_fetcher.refresh_scheduler
+    started = time.perf_counter()
+    pending = scheduler.pending() # builds the schedule from the whole cache once
+    schedule_build = time.perf_counter() - started
+    scheduler.configure(auto=True, interval=3600)
+    check = timings(malfetcher.check_status_in_cache, 1000)
+    if scheduler.worker:
+        scheduler.worker.join()
+    scheduler.configure(auto=False)
+    _, refresh = counted(server, lambda: malfetcher.refresh_stale_entries(20))
+    return {
+        'cached_entries': cached,
+        'due_entries': pending,
+        'schedule_build_s': schedule_build,
+        'check_status_in_cache': check,
+        'refresh_stale_entries_20': refresh
+    }
+
+def bench_save_json(malfetcher, server, writes, cache_dir):
+    # Every incremental save rewrites the whole file, compare the bytes written to the data added
+    file_path = os.path.join(cache_dir, 'write_amplification.json')
+    anime_ids = sorted(server.anime)[:writes]
+    written = 0
+    started = time.perf_counter()
+    for anime_id in anime_ids:
+        malfetcher.utils_save_json(file_path, {str(anime_id): server.anime[anime_id]}, False)
+        written += os.path.getsize(file_path)
+    elapsed = time.perf_counter() - started
+    final_size = os.path.getsize(file_path)
+    return {
+        'writes': writes,
+        'seconds': elapsed,
+        'ms_per_write': elapsed / writes * 1000,
+        'final_bytes': final_size,
+        'bytes_written': written,
+        'write_amplification': written / final_size
+    }
+
+def bench_point_reads(malfetcher, mal_fetcher, server, count, cache_dir, lookups = 50):
+    # A fresh process looking up one id, the single file layout parses the whole cache for it
+    from malfetcher.cache import open_cache
+    from malfetcher.metrics import get_metrics
+    report = {}
+    anime_ids = [str(anime_id) for anime_id in sorted(server.anime)[:count]]
+    for backend in ('json', 'sharded'):
+        reset_caches(mal_fetcher, cache_dir, backend)
+        fill_id_cache(mal_fetcher, server, count)
+        malfetcher.reset_metrics()
+        started = time.perf_counter()
+        for anime_id in anime_ids[::max(len(anime_ids) // lookups, 1)][:lookups]:
+            open_cache(mal_fetcher.mal_id_cache_path, backend, memory_tier=False).get(anime_id)
+        elapsed = time.perf_counter() - started
+        bytes_read = sum(counter['value'] for counter in get_metrics()['counters'] if counter['name'] == 'malfetcher_cache_bytes_read_total')
+        report[backend] = {'ms_per_lookup': elapsed / lookups * 1000, 'bytes_read_per_lookup': bytes_read / lookups}
+    reset_caches(mal_fetcher, cache_dir, 'json')
+    return report
+
+def reset_caches(mal_fetcher, cache_dir, backend = None):
+    mal_fetcher.refresh_scheduler.stop()
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.makedirs(cache_dir)
+    mal_fetcher.set_cache_dir(cache_dir, backend)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--list-sizes', default="1000,10000")
+    parser.add_argument('--franchise-seasons', type=int, default=50)
+    parser.add_argument('--cache-entries', type=int, default=20000)
+    parser.add_argument('--writes', type=int, default=500)
+    parser.add_argument('--output', help="write the report to this file as well")
+    parser.add_argument('--replay', help="serve the responses recorded in this file first")
+    parser.add_argument('--record', help="save every stub response to this file")
+    args = parser.parse_args()
+    list_sizes = [int(size) for size in args.list_sizes.split(',') if size]
+
+    largest = max(list_sizes + [args.cache_entries, args.writes])
+    anime = make_franchises(math.ceil(largest / 3))
+    anime.update(make_franchises(1, args.franchise_seasons, long_franchise_start))
+    server = StubServer(anime).start()
+    if args.replay:
+        server.load_recording(args.replay)
+    if args.record:
+        server.start_recording()
+    os.environ['MAL_API_URL'] = server.mal_url
+    os.environ['ANILIST_API_URL'] = server.anilist_url
+    os.environ.setdefault('MAL_CLIENT_ID', 'benchmark')
+    os.environ.setdefault('myanimelist_key', 'benchmark')
+    os.environ.setdefault('WEEB_SILENCE', '1')
+    os.environ['MAL_REFRESH_AUTO'] = '0'
+    os.environ['MAL_RESPONSE_MEMO_TTL'] = '0'
+    import malfetcher
+    from malfetcher import mal_fetcher
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'replay': args.replay,
+        'stub_anime': len(anime)
+    }
+    cache_dir = tempfile.mkdtemp(prefix='malfetcher-bench-')
+    try:
+        report['get_all_anime_for_user'] = bench_user_list(malfetcher, mal_fetcher, server, list_sizes, cache_dir)
+        report['user_list_sync'] = bench_list_sync(malfetcher, mal_fetcher, server, max(list_sizes), cache_dir)
+        report['get_season_ranges'] = bench_season_ranges(malfetcher, mal_fetcher, server, args.franchise_seasons, cache_dir)
+        report['get_id'] = bench_get_id(malfetcher, mal_fetcher, server, cache_dir)
+        report['check_status_in_cache'] = bench_status_check(malfetcher, mal_fetcher, server, args.cache_entries, cache_dir)
+        report['utils_save_json'] = bench_save_json(malfetcher, server, args.writes, cache_dir)
+        report['cache_point_reads'] = bench_point_reads(malfetcher, mal_fetcher, server, args.cache_entries, cache_dir)
+    finally:
+        mal_fetcher.refresh_scheduler.stop()
+        server.stop()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    if args.record:
+        report['recorded_responses'] = server.save_recording(args.record)
+
+    output = json.dumps(report, indent=4)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import os, sys, json, time, glob, random, shutil, signal, tempfile, argparse, multiprocessing
+
+# Several processes writing the same json cache at once, while a reader keeps parsing it and
+# some writers get killed in the middle of a write. Every entry of the surviving writers has
+# to end up in the file and the file has to parse at every point.
+# Usage: python benchmarks/stress_cache_writes.py [--processes 8] [--entries 100] [--kills 4]
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_path)
+
+def writer(file_path, worker, entries, mode):
+    from malfetcher.cache import JsonCache
+    from malfetcher.utils import utils_save_json
+    cache = JsonCache(file_path)
+    for index in range(entries):
+        key = f"{worker}-{index}"
+        value = {'worker': worker, 'index': index, 'padding': "x" * random.randint(0, 200)}
+        if mode == 'update':
+            cache.set(key, value)
+        elif mode == 'batch':
+            with cache.batch():
+                cache.set(key, value)
+                cache.set(f"{key}-extra", value)
+                cache.delete(f"{key}-extra")
+        else:
+            utils_save_json(file_path, {key: value}, False)
+
+def crasher(file_path, worker):
+    # Keeps writing big entries until it gets killed
+    from malfetcher.cache import JsonCache
+    cache = JsonCache(file_path)
+    index = 0
+    while True:
+        cache.set(f"crash-{worker}-{index}", {'padding': "y" * 200000})
+        index += 1
+
+def reader(file_path, stop, results):
+    reads = failures = 0
+    while not stop.is_set():
+        try:
+            with open(file_path, "r", encoding="utf-8") as file:
+                json.load(file)
+            reads += 1
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            failures += 1
+    results.put({'reads': reads, 'parse_failures': failures})
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--entries', type=int, default=100)
+    parser.add_argument('--kills', type=int, default=4)
+    args = parser.parse_args()
+    os.environ.setdefault('MAL_CLIENT_ID', 'stress')
+
+    cache_dir = tempfile.mkdtemp(prefix='malfetcher-stress-')
+    file_path = os.path.join(cache_dir, 'stress_cache.json')
+    modes = ['update', 'batch', 'merge']
+    stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    reader_process = multiprocessing.Process(target=reader, args=(file_path, stop, results))
+    reader_process.start()
+
+    started = time.perf_counter()
+    writers = [
+        multiprocessing.Process(target=writer, args=(file_path, worker, args.entries, modes[worker % len(modes)]))
+        for worker in range(args.processes)
+    ]
+    for process in writers:
+        process.start()
+    killed = 0
+    for worker in range(args.kills):
+        process = multiprocessing.Process(target=crasher, args=(file_path, f"k{worker}"))
+        process.start()
+        time.sleep(random.uniform(0.05, 0.3))
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
+        killed += 1
+    for process in writers:
+        process.join()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    read_stats = results.get()
+    reader_process.join()
+
+    with open(file_path, "r", encoding="utf-8") as file:
+        data = json.load(file)
+    expected = {f"{worker}-{index}" for worker in range(args.processes) for index in range(args.entries)}
+    missing = expected - set(data)
+    report = {
+        'processes': args.processes,
+        'entries_per_process': args.entries,
+        'killed_writers': killed,
+        'seconds': elapsed,
+        'expected_entries': len(expected),
+        'missing_entries': len(missing),
+        'leftover_extra_entries': len([key for key in data if key.endswith('-extra')]),
+        'leftover_temp_files': len(glob.glob(os.path.join(cache_dir, '*.tmp'))),
+        'writer_exit_codes': sorted({process.exitcode for process in writers}),
+        **read_stats
+    }
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    print(json.dumps(report, indent=4))
+    failed = missing or read_stats['parse_failures'] or report['leftover_extra_entries'] or report['writer_exit_codes'] != [0]
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
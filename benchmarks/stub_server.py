@@ -0,0 +1,316 @@
+import os, re, json, time, hashlib, threading, urllib.request, urllib.error
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+# Local stand-in for the MAL v2 api and the AniList graphql endpoint, for benchmarks and
+# manual testing without touching the real services. Point malfetcher at it with
+# MAL_API_URL=<server.mal_url> and ANILIST_API_URL=<server.anilist_url> before importing it.
+#
+#   with StubServer(make_franchises(100)) as server:
+#       ...
+#       print(server.stats())
+#
+# Responses can be recorded to a json file and replayed later, recorded responses win over the
+# generated ones. With upstream=True unknown requests are forwarded to the real apis, which
+# records real MAL/AniList responses for offline runs:
+#
+#   python benchmarks/stub_server.py --record recording.json --upstream
+
+last_modified = "Mon, 01 Jan 2024 00:00:00 GMT"
+recorded_url = "{stub_url}" # the stub address changes between runs
+list_epoch = 1577836800 # list updated_at timestamps count up from 2020-01-01
+upstream_urls = {'/v2': "https://api.myanimelist.net/v2", '/graphql': "https://graphql.anilist.co"}
+
+def make_anime(anime_id, title, media_type = 'tv', status = 'finished_airing', episodes = 12, related = ()):
+    return {
+        'id': anime_id,
+        'title': title,
+        'alternative_titles': {'ja': f"{title} JA", 'en': f"{title} EN", 'synonyms': [f"{title} synonym"]},
+        'start_date': '2020-01-01',
+        'end_date': '2020-03-25',
+        'nsfw': 'white',
+        'media_type': media_type,
+        'status': status,
+        'genres': [{'id': 1, 'name': 'Action'}],
+        'num_episodes': episodes,
+        'related_anime': [
+            {'node': {'id': relation_id, 'title': f"Anime {relation_id}"}, 'relation_type': relation_type, 'relation_type_formatted': relation_type.title()}
+            for relation_id, relation_type in related
+        ]
+    }
+
+def make_franchises(count, seasons = 3, start_id = 1):
+    # count franchises of seasons consecutive ids each, linked by prequel/sequel edges
+    anime = {}
+    for franchise in range(count):
+        first_id = franchise * seasons + start_id
+        for season in range(seasons):
+            anime_id = first_id + season
+            related = []
+            if season:
+                related.append((anime_id - 1, 'prequel'))
+            if season < seasons - 1:
+                related.append((anime_id + 1, 'sequel'))
+            title = f"Franchise {(first_id - 1) // seasons}" + (f" {season + 1}th Season" if season else "")
+            anime[anime_id] = make_anime(anime_id, title, related=related)
+    return anime
+
+def project(node, fields):
+    # Keep only the requested fields like MAL does, sub field lists are ignored
+    if not fields:
+        return node
+    names = set(re.sub(r'\{[^}]*\}', '', fields).split(',')) | {'id', 'title'}
+    return {key: value for key, value in node.items() if key in names}
+
+def recording_key(method, path, query, body):
+    return json.dumps([method, path, sorted(query.items()), body], sort_keys=True)
+
+class StubServer:
+    def __init__(self, anime = None, validators = True, port = 0, upstream = False):
+        self.anime = anime if anime is not None else make_franchises(10)
+        self.list_clock = 0
+        self.set_list(self.anime)
+        self.validators = validators # send ETag/Last-Modified and answer conditional requests with 304
+        self.upstream = upstream
+        self.bandwidth = None # bytes per second, response bodies are slowed down to it like on a real link
+        self.replayed = {} # recording_key -> (status, payload), loaded from a recording
+        self.recorded = {}
+        self.recording = False
+        self.lock = threading.Lock()
+        self.reset_stats()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    @property
+    def mal_url(self):
+        return f"{self.url}/v2"
+
+    @property
+    def anilist_url(self):
+        return f"{self.url}/graphql"
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests = 0
+            self.not_modified = 0
+            self.bytes_sent = 0
+            self.paths = {}
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests, 'not_modified': self.not_modified, 'bytes_sent': self.bytes_sent, 'paths': dict(self.paths)}
+
+    def record(self, path, sent, not_modified):
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += sent
+            self.not_modified += not_modified
+            endpoint = re.sub(r'/\d+', '/{id}', path)
+            self.paths[endpoint] = self.paths.get(endpoint, 0) + 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def list_timestamp(self):
+        # Every list change gets a later updated_at, like MAL's second resolution timestamps
+        self.list_clock += 1
+        return datetime.fromtimestamp(list_epoch + self.list_clock, timezone.utc).isoformat()
+
+    def set_list(self, anime_ids, status = 'watching'):
+        # Replace the user list, every anime_id has to be in self.anime. Later ids count as updated later.
+        self.list_status = {
+            anime_id: {'status': status, 'num_times_rewatched': 0, 'is_rewatching': False, 'num_episodes_watched': 1, 'updated_at': self.list_timestamp()}
+            for anime_id in anime_ids
+        }
+
+    def update_list_status(self, anime_id, **changes):
+        # Add or change one list entry like the user would, it moves to the top of the list_updated_at order
+        status = self.list_status.setdefault(anime_id, {'status': 'plan_to_watch', 'num_times_rewatched': 0, 'is_rewatching': False, 'num_episodes_watched': 0})
+        status.update(changes, updated_at=self.list_timestamp())
+        return status
+
+    def load_recording(self, path):
+        with open(path, "r", encoding="utf-8") as recording_file:
+            raw = recording_file.read().replace(recorded_url, self.url)
+        with self.lock:
+            self.replayed.update({key: tuple(response) for key, response in json.loads(raw).items()})
+        return len(self.replayed)
+
+    def start_recording(self):
+        self.recording = True
+
+    def save_recording(self, path):
+        with self.lock:
+            raw = json.dumps(self.recorded, ensure_ascii=False)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as recording_file:
+            recording_file.write(raw.replace(self.url, recorded_url))
+        return len(self.recorded)
+
+    def respond_to(self, method, path, query, body, headers):
+        key = recording_key(method, path, query, body)
+        replayed = self.replayed.get(key)
+        if replayed is not None:
+            return replayed
+        if self.upstream and path.startswith(tuple(upstream_urls)):
+            status, payload = self.forward(method, path, query, body, headers)
+        else:
+            status, payload = self.route(method, path, query, body)
+        if self.recording:
+            with self.lock:
+                self.recorded[key] = (status, payload)
+        return status, payload
+
+    def forward(self, method, path, query, body, headers):
+        prefix = next(prefix for prefix in upstream_urls if path.startswith(prefix))
+        url = upstream_urls[prefix] + path[len(prefix):] + (f"?{urlencode(query)}" if query else '')
+        forwarded = {key: value for key, value in headers.items() if key.lower() in ('authorization', 'x-mal-client-id', 'content-type')}
+        data = None
+        if body:
+            data = json.dumps(body).encode() if 'json' in forwarded.get('Content-Type', '') else urlencode(body).encode()
+        request = urllib.request.Request(url, data=data, headers=forwarded, method=method)
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                status, raw = response.status, response.read()
+        except urllib.error.HTTPError as error:
+            status, raw = error.code, error.read()
+        payload = json.loads(raw or b'null')
+        # Point the paging links back at the stub
+        return status, json.loads(json.dumps(payload).replace(upstream_urls['/v2'], self.mal_url))
+
+    def route(self, method, path, query, body):
+        # Returns (status, payload)
+        if path == '/graphql':
+            return 200, self.graphql(body)
+        if path == '/v2/users/@me':
+            return 200, {'id': 1, 'name': 'stub_user', 'picture': ''}
+        match = re.fullmatch(r'/v2/anime/(\d+)/my_list_status', path)
+        if match and method == 'PUT':
+            changes = {}
+            if 'num_watched_episodes' in body:
+                changes['num_episodes_watched'] = int(body['num_watched_episodes'])
+            if 'status' in body:
+                changes['status'] = body['status']
+            return 200, self.update_list_status(int(match.group(1)), **changes)
+        match = re.fullmatch(r'/v2/anime/(\d+)', path)
+        if match:
+            anime = self.anime.get(int(match.group(1)))
+            return (200, project(anime, query.get('fields'))) if anime else (404, {'error': 'not_found'})
+        if path == '/v2/anime':
+            search = query.get('q', '').lower()
+            limit = int(query.get('limit', 10))
+            found = [anime for anime in self.anime.values() if search in anime['title'].lower()][:limit]
+            return 200, {'data': [{'node': {'id': anime['id'], 'title': anime['title'], 'media_type': anime['media_type']}} for anime in found], 'paging': {}}
+        if re.fullmatch(r'/v2/users/[^/]+/animelist', path):
+            limit = int(query.get('limit', 100))
+            offset = int(query.get('offset', 0))
+            anime_ids = sorted(anime_id for anime_id, status in self.list_status.items() if query.get('status') in (None, status['status']))
+            if query.get('sort') == 'list_updated_at':
+                anime_ids.sort(key=lambda anime_id: self.list_status[anime_id]['updated_at'], reverse=True)
+            page = [{'node': project(dict(self.anime[anime_id], my_list_status=self.list_status[anime_id]), query.get('fields'))} for anime_id in anime_ids[offset:offset + limit] if anime_id in self.anime]
+            paging = {}
+            if offset + limit < len(anime_ids):
+                # Like MAL the next link carries all the query params
+                paging['next'] = f"{self.mal_url}/users/stub_user/animelist?{urlencode(dict(query, offset=offset + limit, limit=limit))}"
+            return 200, {'data': page, 'paging': paging}
+        return 404, {'error': 'not_found'}
+
+    def graphql(self, body):
+        variables = body.get('variables', {})
+        if 'idMal_in' in body.get('query', ''):
+            media = [{'id': anime_id + 100000, 'idMal': anime_id} for anime_id in variables.get('ids', []) if anime_id in self.anime]
+            return {'data': {'Page': {'media': media}}}
+        mal_id = int(variables.get('malId', 0))
+        return {'data': {'Media': {'id': mal_id + 100000} if mal_id in self.anime else None}}
+
+    def handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True # headers and body go out in separate writes
+
+            def log_message(self, *args):
+                pass
+
+            def read_body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length).decode() if length else ''
+                if 'json' in (self.headers.get('Content-Type') or ''):
+                    return json.loads(raw or '{}')
+                return {key: values[0] for key, values in parse_qs(raw).items()}
+
+            def respond(self):
+                url = urlsplit(self.path)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                status, payload = stub.respond_to(self.command, url.path, query, self.read_body(), dict(self.headers))
+                body = json.dumps(payload).encode()
+                etag = f'"{hashlib.sha1(body).hexdigest()}"'
+                cacheable = stub.validators and self.command == 'GET' and status == 200
+                # Counted before answering, the client can be done before the write returns
+                if cacheable and self.headers.get('If-None-Match') == etag:
+                    stub.record(url.path, 0, 1)
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                if cacheable:
+                    self.send_header('ETag', etag)
+                    self.send_header('Last-Modified', last_modified)
+                stub.record(url.path, len(body), 0)
+                if stub.bandwidth:
+                    time.sleep(len(body) / stub.bandwidth)
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = respond
+            do_POST = respond
+            do_PUT = respond
+
+        return Handler
+
+if __name__ == '__main__':
+    import time, argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--replay', help="serve the responses recorded in this file first")
+    parser.add_argument('--record', help="save every response to this file on exit")
+    parser.add_argument('--upstream', action='store_true', help="forward requests to the real apis instead of generating them")
+    args = parser.parse_args()
+    with StubServer(make_franchises(100), port=args.port, upstream=args.upstream) as server:
+        if args.replay:
+            server.load_recording(args.replay)
+        if args.record:
+            server.start_recording()
+        print(f"MAL_API_URL={server.mal_url}")
+        print(f"ANILIST_API_URL={server.anilist_url}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        if args.record:
+            print(f"Recorded {server.save_recording(args.record)} responses to {args.record}")
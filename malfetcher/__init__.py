@@ -1,3 +1,10 @@
-from .mal_fetcher import update_entry, check_status_in_cache, get_userdata, clear_cache, get_latest_anime_entry_for_user, get_all_anime_for_user, get_anime_entry_for_user, get_anime_info, get_id, mal_to_al_id, get_season_ranges
-from .utils import utils_read_json, utils_save_json
-from .mal_config_utils import config_setup, regenerate_token, minimal_setup
\ No newline at end of file
+from .mal_fetcher import update_entry, update_entries, check_status_in_cache, get_userdata, clear_cache, get_latest_anime_entry_for_user, get_all_anime_for_user, iter_all_anime_for_user, get_anime_entry_for_user, get_anime_info, get_anime_info_many, get_id, search_titles, mal_to_al_id, mal_to_al_ids, get_season_ranges, get_franchise, set_cache_backend, set_cache_dir, export_cache, configure_memory_cache, invalidate_memory_cache, configure_http_cache, get_http_cache_stats, use_entry_model, refresh_stale_entries, start_refresh_scheduler, stop_refresh_scheduler, configure_refresh_scheduler, sync_user_list, configure_user_list_sync
+from .utils import utils_read_json, utils_save_json, register_serializer
+from .mal_config_utils import config_setup, regenerate_token, minimal_setup
+from .http_client import http_client, configure_http_client
+from .cache import open_cache, register_cache_backend, migrate_json_cache, configure_cache_format
+from .rate_limit import configure_rate_limit, get_rate_limit_stats
+from .retry import RetryPolicy, CircuitBreaker, configure_retry_policy
+from .coalesce import configure_request_coalescing
+from .models import AnimeEntry, Relation, to_models
+from .metrics import get_metrics, metrics_text, add_metrics_exporter, remove_metrics_exporter, add_span_hook, remove_span_hook, reset_metrics
\ No newline at end of file
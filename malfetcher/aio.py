@@ -0,0 +1,713 @@
+import asyncio, os, time, json
+from . import mal_fetcher
+from .mal_fetcher import (
+    anime_request_url, mal_base_url, anilist_api_url, al_to_mal_user_status,
+    mal_to_al_status, status_options, media_formats, get_request_headers, load_config, build_anime_entry,
+    add_user_list_status, compute_season_ranges, get_relation_edges, build_related, find_season, entry_update_params,
+    overflowing_ids, season_targets, plan_entry_updates, report_entry_updates, projections, get_projection, projection_query, has_fields, select_list_rows
+)
+from .user_lists import newer_nodes
+from .http_cache import not_modified
+from .mal_config_utils import regenerate_token
+from .http_client import default_pool_size, default_timeout
+from .rate_limit import get_rate_limiter, get_service
+from .retry import retry_policies, circuit_breakers
+from .coalesce import async_single_flight, response_memo, request_key
+from .metrics import record_request, timer, span, traced
+from .utils import print_deb
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Async counterparts of the malfetcher api, they share the caches with the sync functions
+
+default_concurrency = int(os.getenv('MAL_MAX_WORKERS', 4))
+
+class AsyncClient:
+    # Pass the same client to every task to share its connection pool and concurrency limit
+    def __init__(self, max_concurrency = default_concurrency, pool_size = default_pool_size, timeout = default_timeout):
+        if aiohttp is None:
+            raise ImportError("malfetcher.aio requires aiohttp, install it with: pip install aiohttp")
+        self.max_concurrency = max_concurrency
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.session = None
+        self.semaphore = None
+        self.loop = None
+        self.closer = None
+        self.cooldown_until = 0
+
+    def prepare(self):
+        # aiohttp sessions and semaphores are bound to the loop they were created in
+        loop = asyncio.get_running_loop()
+        if self.session is None or self.session.closed or self.loop is not loop:
+            self.discard_session()
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+            self.loop = loop
+            # asyncio.run() finalizes async generators before it closes the loop, this one closes the session there
+            self.closer = close_with_loop(self.session)
+            asyncio.ensure_future(self.closer.__anext__())
+        return self.session
+
+    def discard_session(self):
+        # The session of another loop, closed on that loop when it still runs
+        session, self.session = self.session, None
+        if session is None or session.closed:
+            return
+        if self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(session.close(), self.loop)
+        else:
+            # Nothing can await the close on a stopped loop anymore
+            session.detach()
+
+    async def request(self, method, url, **kwargs):
+        session = self.prepare()
+        async with self.semaphore:
+            cooldown = self.cooldown_until - time.monotonic()
+            if cooldown > 0:
+                await asyncio.sleep(cooldown)
+            rate_limiter = get_rate_limiter(url)
+            if rate_limiter:
+                await rate_limiter.acquire_async()
+            elapsed = timer()
+            try:
+                async with session.request(method.upper(), url, **kwargs) as response:
+                    content = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                record_request(get_service(url), url, 'error', elapsed())
+                raise
+            record_request(get_service(url), url, response.status, elapsed(), len(content))
+            try:
+                body = json.loads(content) if content else None
+            except ValueError:
+                body = None
+            return response.status, response.headers, body
+
+    def set_cooldown(self, seconds):
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + seconds)
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+async def close_with_loop(session):
+    try:
+        yield
+    finally:
+        await session.close()
+
+default_client = None
+
+def get_client(client = None):
+    global default_client
+    if client:
+        return client
+    if default_client is None:
+        default_client = AsyncClient()
+    return default_client
+
+async def close_default_client():
+    # For loops not run by asyncio.run(), which closes the default client's session by itself
+    if default_client is not None:
+        await default_client.close()
+
+async def run_sync(function, *args):
+    # Cache reads and writes, config files and token refreshing are sync, keep them off the event loop
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+def cached_values(cache, keys):
+    # {key: value} of the keys the cache holds, meant to be read in one go through run_sync()
+    values = {}
+    for key in keys:
+        value = cache.get(key)
+        if value is not None:
+            values[key] = value
+    return values
+
+def store_entries(anime_data):
+    mal_fetcher.mal_id_cache.update(anime_data)
+    mal_fetcher.index_cached_entries(anime_data)
+
+def stringify(params):
+    return {key: str(value) for key, value in params.items()}
+
+# Functions
+
+async def make_mal_request(mal_api_url, params, method='get', mal_token=None, user_request = False, client = None, full_response = False, keep_body = True, revalidate = True, force_update = False):
+    if method.lower() != 'get':
+        response_memo.invalidate(mal_api_url.rsplit('/my_list_status', 1)[0])
+        with span('make_mal_request', url=mal_api_url, method=method.upper()):
+            return await send_mal_request(mal_api_url, params, method, mal_token, user_request, client, full_response)
+    key = request_key(mal_api_url, params, mal_token or ('user' if user_request else 'client'), full_response, keep_body, revalidate)
+    with span('make_mal_request', url=mal_api_url, method='GET'):
+        return await async_single_flight.run(key, lambda: send_mal_request(mal_api_url, params, method, mal_token, user_request, client, full_response, keep_body, revalidate), memoize = not user_request, refresh = force_update)
+
+async def send_mal_request(mal_api_url, params, method='get', mal_token=None, user_request = False, client = None, full_response = False, keep_body = True, revalidate = True):
+    client = get_client(client)
+    HEADERS, local_token = await run_sync(get_request_headers, mal_token, user_request, False)
+    retry_state = retry_policies['mal'].start('mal')
+    circuit_breaker = circuit_breakers['mal']
+    token_refreshed = False
+    while True:
+        if not circuit_breaker.allow():
+            print_deb("MyAnimeList is not responding, failing fast")
+            return {}
+        try:
+            if method.lower() == 'put':
+                status, headers, json_response = await client.request(method, mal_api_url, data=stringify(params), headers=HEADERS)
+            else:
+                http_cache = mal_fetcher.http_cache
+                cache_key, cached_entry, request_headers = await run_sync(http_cache.lookup, mal_api_url, params, HEADERS, keep_body, revalidate)
+                status, headers, json_response = await client.request(method, mal_api_url, params=stringify(params), headers=request_headers)
+                if status == 304 and cached_entry is not None:
+                    status, json_response = 200, await run_sync(http_cache.revalidated, cached_entry)
+                elif status == 200 and cache_key is not None:
+                    await run_sync(http_cache.save, cache_key, headers, json_response, keep_body)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            circuit_breaker.record_failure()
+            delay = retry_state.next_delay(None)
+            if delay is None:
+                raise
+            print_deb(f"Connection error: {error}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+        finally:
+            circuit_breaker.end_trial()
+        if status >= 500:
+            circuit_breaker.record_failure()
+        else:
+            circuit_breaker.record_success()
+        if status == 200:
+            if json_response is not_modified:
+                return json_response
+            if json_response and 'data' in json_response and not full_response:
+                return json_response['data']
+            return json_response
+        elif status == 429:
+            print_deb(f"Rate limit exceeded. Waiting before retrying...")
+            delay = retry_state.next_delay(429, headers.get('retry-after'))
+            if delay is not None:
+                client.set_cooldown(delay)
+        elif status == 404:
+            print(f"Anime not found")
+            return None
+        elif status == 401 and local_token and not token_refreshed:
+            print_deb(f"Access token expired, refreshing")
+            await run_sync(regenerate_token)
+            HEADERS = {'Authorization': f"Bearer {await run_sync(load_config, False)}"}
+            token_refreshed = True
+            delay = 0
+        elif status in retry_state.policy.status_rules:
+            print_deb(f"Unknown error occurred, retrying...")
+            print_deb(params, json_response, sep="\n")
+            delay = retry_state.next_delay(status)
+            if delay:
+                await asyncio.sleep(delay)
+        else:
+            print_deb(f"Error {status}: {params}")
+            return {}
+
+        if delay is None:
+            print_deb("Maximum retries reached. Exiting.")
+            return {}
+
+        print_deb(f"Retrying... (Attempt {retry_state.total_attempts})")
+
+async def make_anilist_request(url, body, headers, client = None):
+    client = get_client(client)
+    retry_state = retry_policies['anilist'].start('anilist')
+    circuit_breaker = circuit_breakers['anilist']
+    while True:
+        if not circuit_breaker.allow():
+            print_deb("AniList is not responding, failing fast")
+            return None, None
+        try:
+            status, response_headers, response_dict = await client.request('post', url, json=body, headers=headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            circuit_breaker.record_failure()
+            delay = retry_state.next_delay(None)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            continue
+        finally:
+            circuit_breaker.end_trial()
+        if status >= 500:
+            circuit_breaker.record_failure()
+        else:
+            circuit_breaker.record_success()
+        if status == 200 or status not in retry_state.policy.status_rules:
+            return status, response_dict
+        delay = retry_state.next_delay(status, response_headers.get('Retry-After'))
+        if delay is None:
+            print_deb(f"AniList request failed with {status}, giving up")
+            return None, None
+        await asyncio.sleep(delay)
+
+@traced('mal_to_al_id')
+async def mal_to_al_id(mal_id, client = None):
+    query = """
+    query ($malId: Int) {
+        Media(idMal: $malId type: ANIME) {
+            id
+        }
+    }
+    """
+    mal_id = str(mal_id)
+    cached_al_id = await run_sync(mal_fetcher.mal_to_al_cache.get, mal_id)
+    if cached_al_id is not None:
+        return int(cached_al_id)
+    ANILIST_API_URL = anilist_api_url
+    HEADERS = {'Content-Type': "application/json"}
+    variables = {'malId': mal_id}
+    status, response_dict = await make_anilist_request(ANILIST_API_URL, {'query': query, 'variables': variables}, HEADERS, client)
+
+    if response_dict and status == 200:
+        await run_sync(mal_fetcher.mal_to_al_cache.set, mal_id, response_dict['data']['Media']['id'])
+        return int(response_dict['data']['Media']['id'])
+    return None
+
+@traced('mal_to_al_ids')
+async def mal_to_al_ids(mal_ids, chunk_size = 50, client = None):
+    query = """
+    query ($ids: [Int], $perPage: Int) {
+        Page(perPage: $perPage) {
+            media(idMal_in: $ids, type: ANIME) {
+                id
+                idMal
+            }
+        }
+    }
+    """
+    mal_ids = list(dict.fromkeys(str(mal_id) for mal_id in mal_ids))
+    al_ids = {mal_id: int(al_id) for mal_id, al_id in (await run_sync(cached_values, mal_fetcher.mal_to_al_cache, mal_ids)).items()}
+    missing_ids = [mal_id for mal_id in mal_ids if mal_id not in al_ids]
+    ANILIST_API_URL = anilist_api_url
+    HEADERS = {'Content-Type': "application/json"}
+
+    async def fetch_chunk(chunk):
+        variables = {'ids': [int(mal_id) for mal_id in chunk], 'perPage': len(chunk)}
+        status, response_dict = await make_anilist_request(ANILIST_API_URL, {'query': query, 'variables': variables}, HEADERS, client)
+        if status != 200 or not response_dict:
+            return []
+        return response_dict['data']['Page']['media']
+
+    chunks = [missing_ids[index:index + chunk_size] for index in range(0, len(missing_ids), chunk_size)]
+    fetched_ids = {}
+    for media_list in await asyncio.gather(*(fetch_chunk(chunk) for chunk in chunks)):
+        for media in media_list:
+            fetched_ids[str(media['idMal'])] = media['id']
+    await run_sync(mal_fetcher.mal_to_al_cache.update, fetched_ids)
+    al_ids.update(fetched_ids)
+    return {mal_id: al_ids.get(mal_id) for mal_id in mal_ids}
+
+async def generate_anime_entries(anime_infos, mal_token = None, client = None, projection = None):
+    # Relation statuses come from the batch and the id cache first, unknown ones are fetched once per batch
+    fields = get_projection(projection)
+    anime_infos = list(anime_infos)
+    known_statuses = {str(anime_info['id']): mal_to_al_status[anime_info['status']] for anime_info in anime_infos if 'status' in anime_info}
+    status_tasks = {}
+    cached_entries = await run_sync(cached_values, mal_fetcher.mal_id_cache, [str(anime_info['id']) for anime_info in anime_infos])
+
+    async def fetch_status(relation_id):
+        data = await make_mal_request(anime_request_url + f"/{relation_id}", {'fields': "status"}, mal_token = mal_token, client = client)
+        return mal_to_al_status[data['status']] if data else None
+
+    async def get_status(relation_id):
+        if relation_id not in known_statuses:
+            if relation_id not in status_tasks:
+                status_tasks[relation_id] = asyncio.ensure_future(fetch_status(relation_id))
+            return await status_tasks[relation_id]
+        return known_statuses[relation_id]
+
+    async def getRelated(anime_info):
+        anime_id = str(anime_info['id'])
+        if 'related_anime' in anime_info:
+            edges = get_relation_edges(anime_info['related_anime'])
+        else:
+            cached_entry = cached_entries.get(anime_id)
+            if cached_entry is not None and 'related' in cached_entry:
+                return cached_entry['related']
+            data = await make_mal_request(anime_request_url + f"/{anime_id}", {'fields': "related_anime"}, mal_token = mal_token, client = client)
+            edges = get_relation_edges(data['related_anime']) if data else []
+        unknown_ids = [relation_id for relation_id, _, _ in edges if relation_id not in known_statuses and relation_id not in status_tasks]
+        for relation_id, cached_entry in (await run_sync(cached_values, mal_fetcher.mal_id_cache, unknown_ids)).items():
+            if cached_entry.get('status') is not None:
+                known_statuses.setdefault(relation_id, cached_entry['status'])
+        statuses = await asyncio.gather(*(get_status(relation_id) for relation_id, _, _ in edges))
+        return build_related(edges, {relation_id: status for (relation_id, _, _), status in zip(edges, statuses)})
+
+    async def generate(anime_info):
+        anime_id = str(anime_info['id'])
+        related = await getRelated(anime_info) if 'related' in fields else None
+        entry = build_anime_entry(anime_info, al_ids.get(anime_id), related, fields)
+        if fields != projections['full']:
+            # A partial entry never drops the fields the cache already holds
+            cached_entry = cached_entries.get(anime_id)
+            if cached_entry is not None:
+                entry = dict(cached_entry, **entry)
+        return entry
+
+    al_ids = await mal_to_al_ids((anime_info['id'] for anime_info in anime_infos), client = client) if 'al_id' in fields else {}
+    entries = await asyncio.gather(*(generate(anime_info) for anime_info in anime_infos))
+    anime_data = {str(anime_info['id']): entry for anime_info, entry in zip(anime_infos, entries)}
+    await run_sync(store_entries, anime_data)
+    return mal_fetcher.as_entries(anime_data)
+
+async def generate_anime_entry(anime_info, mal_token = None, client = None, projection = None):
+    return (await generate_anime_entries([anime_info], mal_token, client, projection))[str(anime_info['id'])]
+
+async def mal_fetch_anime_info(mal_id, mal_token = None, client = None, projection = None, force_update = False):
+    params = {
+        'fields': projection_query(get_projection(projection))
+    }
+    data = await make_mal_request(f'{anime_request_url}/{mal_id}', params, mal_token = mal_token, client = client, force_update = force_update)
+    anime_data = {}
+    if data:
+        anime_data[str(data['id'])] = await generate_anime_entry(data, mal_token, client, projection)
+    return anime_data
+
+async def get_anime_info(anime_id, force_update = False, mal_token = None, client = None, projection = None):
+    anime_id = str(anime_id)
+    if not anime_id:
+        return None
+    fields = get_projection(projection)
+    if not force_update:
+        mal_fetcher.check_status_in_cache()
+        cached_entry = await run_sync(mal_fetcher.mal_id_cache.get, anime_id)
+        if cached_entry is not None and has_fields(cached_entry, fields):
+            print_deb("Returning cached result for anime_id:", anime_id)
+            return mal_fetcher.as_entries({anime_id: cached_entry})
+    return mal_fetcher.as_entries(await mal_fetch_anime_info(anime_id, mal_token, client, fields, force_update))
+
+async def get_anime_info_many(anime_ids, force_update = False, mal_token = None, client = None, projection = None):
+    anime_ids = [str(anime_id) for anime_id in dict.fromkeys(anime_ids) if anime_id]
+    fields = get_projection(projection)
+    anime_data = {}
+    missing_ids = []
+    stale_entries = {}
+    if not force_update:
+        mal_fetcher.check_status_in_cache()
+    cached_entries = await run_sync(cached_values, mal_fetcher.mal_id_cache, anime_ids)
+    for anime_id in anime_ids:
+        cached_entry = cached_entries.get(anime_id)
+        if cached_entry is not None and has_fields(cached_entry, fields):
+            if not force_update:
+                anime_data[anime_id] = cached_entry
+                continue
+            stale_entries[anime_id] = cached_entry
+        missing_ids.append(anime_id)
+    if missing_ids:
+        params = {
+            'fields': projection_query(fields)
+        }
+        anime_nodes = await asyncio.gather(*(make_mal_request(f'{anime_request_url}/{anime_id}', params, mal_token = mal_token, client = client, keep_body = False, revalidate = anime_id in stale_entries, force_update = force_update) for anime_id in missing_ids))
+        for anime_id, node in zip(missing_ids, anime_nodes):
+            if node is not_modified:
+                anime_data[anime_id] = stale_entries[anime_id]
+        anime_data.update(await generate_anime_entries([node for node in anime_nodes if node and node is not not_modified], mal_token, client, fields))
+    return mal_fetcher.as_entries({anime_id: anime_data[anime_id] for anime_id in anime_ids if anime_id in anime_data})
+
+async def mal_fetch_id(name, media_format, amount, mal_token = None, client = None):
+    params = {
+        'q': name,
+        'limit': 100 if not amount else amount,
+        'fields': (
+            "id,"
+            "media_type"
+        )
+    }
+    data = await make_mal_request(anime_request_url, params, mal_token = mal_token, client = client)
+    if data:
+        return [item['node']['id'] for item in data if not media_format or item['node']['media_type'].upper() == media_format]
+    return None
+
+async def get_id(name, media_format = None, amount = 1, mal_token = None, client = None, fuzzy = True):
+    search_cache = mal_fetcher.mal_search_cache
+    amount = int(amount)
+    format_name = name
+    media_format = media_format.upper() if media_format else None
+    if media_format:
+        if media_format not in media_formats:
+            print("Invalid media format. Please choose from:", media_formats)
+            return
+        format_name = f"{name}_{media_format}"
+    cached_ids = await run_sync(search_cache.get, format_name, [])
+    if len(cached_ids) >= amount:
+        print_deb("Returning cached result for search query:", name)
+        return await get_anime_info_many(cached_ids, False, mal_token, client)
+    matches = await run_sync(mal_fetcher.title_index.search, name, media_format, amount) if fuzzy and amount else []
+    if len(matches) >= amount:
+        print_deb("Returning title index result for search query:", name)
+        return await get_anime_info_many([anime_id for anime_id, _, _ in matches], False, mal_token, client)
+    anime_ids = await mal_fetch_id(name, media_format, amount - len(cached_ids), mal_token, client)
+    if anime_ids:
+        existing_ids = set(cached_ids)
+        cached_ids = cached_ids + [anime_id for anime_id in anime_ids if anime_id not in existing_ids]
+        await run_sync(search_cache.set, format_name, cached_ids)
+        return await get_anime_info_many(cached_ids[:amount], True, mal_token, client)
+    return None
+
+async def get_userdata(mal_token, client = None):
+    data = await make_mal_request(f"{mal_base_url}/users/@me", {}, mal_token = mal_token, user_request = True, client = client)
+    if data:
+        return [data['name'], data['picture']]
+
+async def iter_user_list_pages(status, amount = 0, mal_token = None, username = None, user_request = False, prefetch = False, client = None, projection = None):
+    # Follows MAL paging links, the next page can be requested while the caller handles the current one
+    status = status.upper()
+    params = {}
+    params['sort'] = "list_updated_at"
+    params['limit'] = min(amount, 1000) if amount else 1000
+    params['fields'] = projection_query(get_projection(projection), True)
+    if status != "ALL" and status != "REPEATING":
+        if not status in status_options:
+            print("Invalid status option. Allowed options are:", ", ".join(str(option) for option in status_options))
+            return
+        params['status'] = al_to_mal_user_status[status]
+
+    def fetch_page(request_url, params):
+        return make_mal_request(request_url, params, mal_token = mal_token, user_request = user_request, client = client, full_response = True)
+
+    request_url = f"{mal_base_url}/users/{username}/animelist"
+    response = await fetch_page(request_url, params)
+    fetched = 0
+    next_page = None
+    try:
+        while response and response.get('data'):
+            page = response['data']
+            if amount:
+                page = page[:amount - fetched]
+            fetched += len(page)
+            next_url = response.get('paging', {}).get('next')
+            if amount and fetched >= amount:
+                next_url = None
+            next_page = asyncio.ensure_future(fetch_page(next_url, {})) if next_url and prefetch else None
+            yield [anime_entry['node'] for anime_entry in page]
+            if not next_url:
+                break
+            response = await (next_page or fetch_page(next_url, {}))
+            next_page = None
+    finally:
+        if next_page:
+            next_page.cancel()
+
+async def fetch_user_list(username, mal_token, user_request, fields, watermark = None, client = None):
+    # List nodes newest first down to the watermark, and whether the list was read that far
+    params = {}
+    params['sort'] = "list_updated_at"
+    params['limit'] = 1000 if watermark is None else mal_fetcher.user_list_snapshots.page_size
+    params['fields'] = projection_query(fields, True)
+    request_url = f"{mal_base_url}/users/{username}/animelist"
+    nodes = []
+    while request_url:
+        response = await make_mal_request(request_url, params, mal_token = mal_token, user_request = user_request, client = client, full_response = True)
+        if not response:
+            return nodes, False
+        page, reached = newer_nodes([anime_entry['node'] for anime_entry in response.get('data', [])], watermark)
+        nodes += page
+        if reached:
+            return nodes, True
+        request_url = response.get('paging', {}).get('next')
+        params = {}
+    return nodes, True
+
+async def sync_list_snapshot(username, mal_token, fields, full = False, client = None):
+    snapshots = mal_fetcher.user_list_snapshots
+    watermark = await run_sync(snapshots.plan, username, full)
+    nodes, complete = await fetch_user_list(username, mal_token, True, fields, watermark, client)
+    return await run_sync(snapshots.apply, username, nodes, complete, watermark is None)
+
+async def sync_user_list(mal_token = None, full = False, client = None):
+    username = (await get_userdata(mal_token, client))[0]
+    _, changed = await sync_list_snapshot(username, mal_token, projections['minimal'], full, client)
+    return list(changed)
+
+async def iter_snapshot_entries(status, media_format = None, amount = 0, mal_token = None, username = None, client = None, projection = None):
+    # Serves the list from the shared snapshot after a delta sync, only the rows that changed get rebuilt
+    if status != "ALL" and status != "REPEATING" and not status in status_options:
+        print("Invalid status option. Allowed options are:", ", ".join(str(option) for option in status_options))
+        return
+    fields = get_projection(projection)
+    rows, changed = await sync_list_snapshot(username, mal_token, fields, client = client)
+    rows = select_list_rows(rows, status, media_format, amount)
+    anime_data = {}
+    missing_ids = []
+    cached_entries = await run_sync(cached_values, mal_fetcher.mal_id_cache, [str(row['id']) for row in rows if str(row['id']) not in changed])
+    for row in rows:
+        anime_id = str(row['id'])
+        if anime_id in changed:
+            continue
+        cached_entry = cached_entries.get(anime_id)
+        if cached_entry is not None and has_fields(cached_entry, fields):
+            anime_data[anime_id] = cached_entry
+        else:
+            missing_ids.append(anime_id)
+    if len(missing_ids) > mal_fetcher.user_list_snapshots.page_size:
+        rows, changed = await sync_list_snapshot(username, mal_token, fields, True, client)
+        rows = select_list_rows(rows, status, media_format, amount)
+        missing_ids = []
+    changed_nodes = [changed[str(row['id'])] for row in rows if str(row['id']) in changed]
+    for start in range(0, len(changed_nodes), 1000):
+        anime_data.update(await generate_anime_entries(changed_nodes[start:start + 1000], mal_token, client, projection))
+    if missing_ids:
+        anime_data.update(await get_anime_info_many(missing_ids, mal_token = mal_token, client = client, projection = fields))
+    anime_data = mal_fetcher.as_entries(anime_data)
+    for row in rows:
+        anime_id = str(row['id'])
+        if anime_id not in anime_data:
+            continue
+        anime_info = anime_data[anime_id].copy()
+        try:
+            add_user_list_status(anime_info, row['my_list_status'])
+        except (KeyError, TypeError):
+            pass
+        yield anime_id, anime_info
+
+async def iter_user_entries(status, media_format = None, amount = 0, mal_token = None, username = None, user_request = False, prefetch = False, client = None, projection = None):
+    status = status.upper()
+    if user_request and await run_sync(mal_fetcher.user_list_snapshots.serves, username, amount, prefetch):
+        async for anime_id, anime_info in iter_snapshot_entries(status, media_format, amount, mal_token, username, client, projection):
+            yield anime_id, anime_info
+        return
+    async for page in iter_user_list_pages(status, amount, mal_token, username, user_request, prefetch, client, projection):
+        nodes = []
+        for anime_entry_data in page:
+            if status == "REPEATING" and not anime_entry_data['my_list_status']['is_rewatching']:
+                continue
+            if media_format and media_format != anime_entry_data['media_type']:
+                continue
+            nodes.append(anime_entry_data)
+        entries = await generate_anime_entries(nodes, mal_token, client, projection)
+        for anime_entry_data in nodes:
+            anime_id = str(anime_entry_data['id'])
+            anime_info = entries[anime_id].copy()
+            try:
+                add_user_list_status(anime_info, anime_entry_data['my_list_status'])
+            except KeyError:
+                pass
+            yield anime_id, anime_info
+
+async def iter_all_anime_for_user(status_list = "ALL", media_format = None, amount = 0, mal_token = None, username = None, prefetch = False, client = None, projection = None):
+    if not username:
+        username = (await get_userdata(mal_token, client))[0]
+        user_request = True
+    else:
+        user_request = False
+    if isinstance(status_list, str):
+        status_list = [status_list]
+    for status in status_list:
+        async for anime_id, anime_info in iter_user_entries(status, media_format, amount, mal_token, username, user_request, prefetch, client, projection):
+            yield anime_id, anime_info
+
+async def get_all_anime_for_user(status_list = "ALL", media_format = None, amount = 0, mal_token = None, username = None, prefetch = False, client = None, projection = None):
+    if not username:
+        username = (await get_userdata(mal_token, client))[0]
+        user_request = True
+    else:
+        user_request = False
+
+    async def main_function(status):
+        user_ids = {anime_id: anime_info async for anime_id, anime_info in iter_user_entries(status, media_format, amount, mal_token, username, user_request, prefetch, client, projection)}
+        if user_ids:
+            return user_ids
+        print(f"No entries found for {username}'s {status.lower()} anime list.")
+        return None
+
+    if isinstance(status_list, str):
+        return await main_function(status_list)
+    ani_list = {}
+    for status in status_list:
+        ani_list.update(await main_function(status) or {})
+    return ani_list
+
+async def get_anime_entry_for_user(mal_id, mal_token = None, client = None, projection = None):
+    params = {
+        'fields': projection_query(get_projection(projection), True)
+    }
+    data = await make_mal_request(f"{anime_request_url}/{mal_id}", params, mal_token = mal_token, user_request = True, client = client)
+    if data:
+        if 'my_list_status' not in data:
+            return None
+        anime_id = str(data['id'])
+        anime_data = {anime_id: (await generate_anime_entry(data, mal_token, client, projection)).copy()}
+        add_user_list_status(anime_data[anime_id], data['my_list_status'])
+        return anime_data
+    return None
+
+async def get_season_ranges(anime_id, mal_token = None, client = None):
+    # Load the whole prequel/sequel chain concurrently, then walk it in memory
+    anime_id = str(anime_id)
+    season_ranges = await run_sync(mal_fetcher.franchise_index.get_ranges, anime_id)
+    if season_ranges is not None:
+        return season_ranges
+    franchise = {}
+    attempted = set() # every id is asked for once, the ones MAL doesn't have are left out
+    pending = [anime_id]
+    while pending:
+        attempted.update(pending)
+        franchise.update(await get_anime_info_many(pending, False, mal_token, client))
+        pending = []
+        for entry in list(franchise.values()):
+            for relation in entry['related'] or {}:
+                if relation not in attempted and relation not in pending:
+                    pending.append(relation)
+    await run_sync(mal_fetcher.franchise_index.update, franchise)
+    season_ranges = compute_season_ranges(anime_id, franchise.get)
+    await run_sync(mal_fetcher.franchise_index.set_ranges, anime_id, season_ranges)
+    return season_ranges
+
+async def update_entry(anime_id, progress, mal_token = None, client = None):
+    if not mal_token:
+        mal_token = await run_sync(load_config, False)
+    anime_id = str(anime_id)
+    progress = int(progress)
+
+    async def get_user_entry(anime_id):
+        user_entry = await get_anime_entry_for_user(anime_id, mal_token, client)
+        if user_entry:
+            return user_entry[anime_id], user_entry[anime_id]['watching_status']
+        return (await get_anime_info(anime_id, False, mal_token, client))[anime_id], 'PLANNING'
+
+    anime_info, current_status = await get_user_entry(anime_id)
+    if progress > anime_info['total_eps']:
+        target_id, progress = find_season(await get_season_ranges(anime_id, mal_token, client), anime_id, progress)
+        if target_id != anime_id:
+            anime_id = target_id
+            anime_info, current_status = await get_user_entry(anime_id)
+    params = entry_update_params(anime_info, current_status, progress)
+    if params is None:
+        return
+    request_url = f"{anime_request_url}/{anime_id}/my_list_status"
+    await make_mal_request(request_url, params, 'put', mal_token, True, client)
+    print_deb('Updating progress successful')
+
+async def update_entries(progress_map, mal_token = None, client = None):
+    if not mal_token:
+        mal_token = await run_sync(load_config, False)
+    progress_map = {str(anime_id): int(progress) for anime_id, progress in dict(progress_map).items()}
+    user_list = await get_all_anime_for_user("ALL", mal_token = mal_token, client = client) or {}
+    anime_infos = dict(user_list)
+    anime_infos.update(await get_anime_info_many([anime_id for anime_id in progress_map if anime_id not in user_list], False, mal_token, client))
+    overflowing = overflowing_ids(progress_map, anime_infos)
+    season_ranges = dict(zip(overflowing, await asyncio.gather(*(get_season_ranges(anime_id, mal_token, client) for anime_id in overflowing))))
+    targets = season_targets(progress_map, anime_infos, season_ranges)
+    anime_infos.update(await get_anime_info_many([target_id for target_id, _ in targets.values() if target_id not in anime_infos], False, mal_token, client))
+    report, updates, owners = plan_entry_updates(progress_map, targets, anime_infos)
+
+    responses = await asyncio.gather(*(
+        make_mal_request(f"{anime_request_url}/{target_id}/my_list_status", params, 'put', mal_token, True, client)
+        for target_id, params in updates.items()
+    ))
+    return report_entry_updates(report, owners, dict(zip(updates, responses)))
@@ -0,0 +1,720 @@
+import os, copy, json, glob, zlib, shutil, sqlite3, threading, time
+from collections import OrderedDict
+from contextlib import contextmanager, ExitStack
+from .utils import utils_save_json, utils_read_json, write_json, print_deb, read_cache_file, to_json, file_lock, dumps, loads, set_serializer, get_serializer, env_flag
+from .records import RecordFile, rewrite_records, write_records
+from .metrics import increment, record_cache_lookup
+
+memory_cache_size = int(os.getenv('MAL_MEMORY_CACHE_SIZE', 4096))
+memory_cache_ttl = float(os.getenv('MAL_MEMORY_CACHE_TTL', 3600))
+cache_shards = int(os.getenv('MAL_CACHE_SHARDS', 1024))
+# Json cache files are compact, MAL_CACHE_PRETTY=1 keeps writing them indented
+pretty_cache_files = env_flag('MAL_CACHE_PRETTY', False)
+
+def default_cache_dir():
+    # MAL_CACHE_DIR, otherwise the per user cache dir: $XDG_CACHE_HOME/malfetcher, ~/.cache/malfetcher
+    # or %LOCALAPPDATA%\malfetcher\cache on Windows
+    if os.getenv('MAL_CACHE_DIR'):
+        return os.path.abspath(os.path.expanduser(os.getenv('MAL_CACHE_DIR')))
+    if os.name == 'nt' and os.getenv('LOCALAPPDATA'):
+        return os.path.join(os.getenv('LOCALAPPDATA'), 'malfetcher', 'cache')
+    base = os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'malfetcher')
+
+# {cache dir: legacy dir} still to be copied, done on the first access to the cache dir
+pending_imports = {}
+pending_imports_lock = threading.Lock()
+
+def import_legacy_cache_dir(legacy_dir, cache_dir):
+    # Caches used to live inside the package, carry them over once so nothing gets refetched
+    pending_imports[os.path.abspath(cache_dir)] = legacy_dir
+
+def prepare_cache_dir(file_path):
+    # Called by the backends before they touch the disk, runs a pending legacy import for that dir
+    if not pending_imports:
+        return
+    path = os.path.abspath(file_path)
+    with pending_imports_lock:
+        for cache_dir, legacy_dir in list(pending_imports.items()):
+            if path != cache_dir and not path.startswith(cache_dir + os.sep):
+                continue
+            if os.path.isdir(legacy_dir) and not os.path.exists(cache_dir):
+                try:
+                    shutil.copytree(legacy_dir, cache_dir, ignore=shutil.ignore_patterns('*.lock', '*.tmp'))
+                except OSError as e:
+                    print("Could not copy the old cache dir:", e)
+            del pending_imports[cache_dir]
+
+class JsonCache:
+    # Default driver, keeps the cache in a single json file.
+    # Writes made inside batch() are kept in memory and flushed with a single dump.
+    # Every write re-reads the file under its lock and applies only its own changes,
+    # so several processes can share one cache without losing each other's entries.
+    # Values are copied on the way in and out, a caller changing one can't change the cache.
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.name = os.path.splitext(os.path.basename(file_path))[0]
+        self.lock = threading.RLock()
+        self.batch_depth = 0
+        self.pending = None
+        self.changes = {}
+        self.removed = set()
+        self.replaced = False
+        self.dirty = False
+        self.snapshot = None
+        self.snapshot_stamp = None
+
+    def file_stamp(self):
+        prepare_cache_dir(self.file_path)
+        try:
+            stat = os.stat(self.file_path)
+            # Writes rename a new file over the old one, so the inode changes too
+            return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return None
+
+    def read(self):
+        # Only parse the file again when it changed on disk
+        stamp = self.file_stamp()
+        if stamp is None:
+            return {}
+        if self.snapshot is None or stamp != self.snapshot_stamp:
+            self.snapshot = read_cache_file(self.file_path)
+            self.snapshot_stamp = stamp
+        return self.snapshot
+
+    def write(self, data):
+        prepare_cache_dir(self.file_path)
+        with file_lock(self.file_path):
+            utils_save_json(self.file_path, data, pretty=pretty_cache_files)
+            self.snapshot = data
+            self.snapshot_stamp = self.file_stamp()
+
+    def merge(self, changes, removed = ()):
+        # Apply changes on top of what is on disk right now
+        prepare_cache_dir(self.file_path)
+        with file_lock(self.file_path):
+            data = dict(self.read())
+            data.update(changes)
+            for key in removed:
+                data.pop(key, None)
+            self.write(data)
+
+    def load(self):
+        # A decoded copy like get() returns, a round trip through the serializer beats deepcopy on a whole cache
+        with self.lock:
+            return loads(dumps(self.pending if self.pending is not None else self.read()))
+
+    def get(self, key, default = None):
+        with self.lock:
+            data = self.pending if self.pending is not None else self.read()
+            value = data.get(str(key))
+        record_cache_lookup(self.name, value is not None)
+        return default if value is None else copy.deepcopy(value)
+
+    def __contains__(self, key):
+        with self.lock:
+            data = self.pending if self.pending is not None else self.read()
+            return str(key) in data
+
+    def keys(self):
+        with self.lock:
+            return list(self.pending if self.pending is not None else self.read())
+
+    def items(self):
+        return list(self.load().items())
+
+    def set(self, key, value):
+        self.update({str(key): value})
+
+    def update(self, data):
+        if not data:
+            return
+        data = {str(key): copy.deepcopy(value) for key, value in data.items()}
+        with self.lock:
+            if self.pending is not None:
+                self.pending.update(data)
+                self.changes.update(data)
+                self.removed.difference_update(data)
+                self.dirty = True
+            else:
+                self.merge(data)
+
+    def delete(self, key):
+        key = str(key)
+        with self.lock:
+            if self.pending is not None:
+                if self.pending.pop(key, None) is not None:
+                    self.changes.pop(key, None)
+                    self.removed.add(key)
+                    self.dirty = True
+            elif key in self.read():
+                self.merge({}, [key])
+
+    def save(self, data):
+        # Overwrite the whole cache
+        data = {str(key): copy.deepcopy(value) for key, value in data.items()}
+        with self.lock:
+            if self.pending is not None:
+                self.pending = data
+                self.replaced = True
+                self.dirty = True
+            else:
+                self.write(data)
+
+    def clear(self):
+        prepare_cache_dir(self.file_path)
+        with self.lock, file_lock(self.file_path):
+            if self.pending is not None:
+                self.pending = {}
+                self.reset_changes()
+            if os.path.exists(self.file_path):
+                os.remove(self.file_path)
+            self.snapshot = None
+            self.snapshot_stamp = None
+
+    def reset_changes(self):
+        self.changes = {}
+        self.removed = set()
+        self.replaced = False
+        self.dirty = False
+
+    @contextmanager
+    def batch(self):
+        with self.lock:
+            if self.batch_depth == 0:
+                self.pending = dict(self.read())
+                self.reset_changes()
+            self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.batch_depth -= 1
+                if self.batch_depth == 0:
+                    pending, self.pending = self.pending, None
+                    if self.replaced:
+                        self.write(pending)
+                    elif self.dirty:
+                        self.merge(self.changes, self.removed)
+                    self.reset_changes()
+
+class SqliteCache:
+    # Keyed point reads and writes, values are stored as json text
+    def __init__(self, file_path):
+        self.file_path = os.path.splitext(file_path)[0] + '.sqlite3'
+        self.name = os.path.splitext(os.path.basename(file_path))[0]
+        self.json_path = file_path
+        self.lock = threading.RLock()
+        self.batch_depth = 0
+        prepare_cache_dir(self.file_path)
+        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+        self.connection = sqlite3.connect(self.file_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        if os.path.exists(self.json_path) and not self.keys():
+            migrate_json_cache(self.json_path, self)
+
+    def execute(self, query, args = ()):
+        with self.lock:
+            return self.connection.execute(query, args).fetchall()
+
+    def load(self):
+        return {key: json.loads(value) for key, value in self.execute("SELECT key, value FROM cache")}
+
+    def get(self, key, default = None):
+        row = self.execute("SELECT value FROM cache WHERE key = ?", (str(key),))
+        record_cache_lookup(self.name, bool(row))
+        if row:
+            increment('malfetcher_cache_bytes_read_total', len(row[0][0]), file=os.path.basename(self.file_path))
+            return json.loads(row[0][0])
+        return default
+
+    def __contains__(self, key):
+        return bool(self.execute("SELECT 1 FROM cache WHERE key = ?", (str(key),)))
+
+    def keys(self):
+        return [row[0] for row in self.execute("SELECT key FROM cache")]
+
+    def items(self):
+        return list(self.load().items())
+
+    def set(self, key, value):
+        self.update({key: value})
+
+    def update(self, data):
+        if not data:
+            return
+        rows = [(str(key), json.dumps(value, ensure_ascii=False, default=to_json)) for key, value in data.items()]
+        increment('malfetcher_cache_bytes_written_total', sum(len(value) for _, value in rows), file=os.path.basename(self.file_path))
+        with self.batch():
+            with self.lock:
+                self.connection.executemany("INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)", rows)
+
+    def delete(self, key):
+        self.execute("DELETE FROM cache WHERE key = ?", (str(key),))
+
+    def save(self, data):
+        with self.batch():
+            self.execute("DELETE FROM cache")
+            self.update(data)
+
+    def clear(self):
+        self.execute("DELETE FROM cache")
+
+    @contextmanager
+    def batch(self):
+        with self.lock:
+            if self.batch_depth == 0:
+                self.connection.execute("BEGIN")
+            self.batch_depth += 1
+        try:
+            yield self
+        except:
+            with self.lock:
+                self.batch_depth -= 1
+                if self.batch_depth == 0:
+                    self.connection.execute("ROLLBACK")
+            raise
+        else:
+            with self.lock:
+                self.batch_depth -= 1
+                if self.batch_depth == 0:
+                    self.connection.execute("COMMIT")
+
+class ShardedJsonCache:
+    # Json cache split over many small files in a directory named after the cache, a key always
+    # lands in the same shard so a point read or write only touches that one file.
+    # Every shard is a JsonCache, so it gets the same atomic and locked writes.
+    # The shard count is saved in the dir, a dir always keeps the count it was created with.
+    def __init__(self, file_path, shards = None):
+        self.json_path = file_path
+        self.name = os.path.splitext(os.path.basename(file_path))[0]
+        self.file_path = os.path.splitext(file_path)[0]
+        self.meta_path = os.path.join(self.file_path, 'shards.meta')
+        self.requested_count = shards or cache_shards
+        self.count = None # read from the meta file on first use
+        self.count_saved = False
+        self.shards = {}
+        self.lock = threading.RLock()
+        self.batch_depth = 0
+        self.batch_stack = None
+        prepare_cache_dir(self.file_path)
+        if os.path.exists(self.json_path) and not os.path.isdir(self.file_path):
+            migrate_json_cache(self.json_path, self)
+
+    @property
+    def shard_count(self):
+        if self.count is None:
+            with self.lock:
+                if self.count is None:
+                    self.use_saved_count((utils_read_json(self.meta_path) or {}).get('shards'))
+        return self.count
+
+    def use_saved_count(self, saved):
+        if saved and saved != self.requested_count:
+            print_deb(f"{self.file_path} was created with {saved} shards, using that instead of {self.requested_count}")
+        self.count = saved or self.requested_count
+        self.count_saved = bool(saved)
+
+    def save_count(self):
+        # Before the first write to a new dir, another process could have created it in the meantime
+        if self.count_saved:
+            return
+        with self.lock, file_lock(self.meta_path):
+            saved = (utils_read_json(self.meta_path) or {}).get('shards')
+            if saved is None:
+                write_json(self.meta_path, {'shards': self.shard_count})
+            self.use_saved_count(saved or self.shard_count)
+
+    def shard_name(self, key):
+        return f"{zlib.crc32(key.encode()) % self.shard_count:03x}"
+
+    def shard(self, key = None, name = None):
+        name = name or self.shard_name(key)
+        with self.lock:
+            shard = self.shards.get(name)
+            if shard is None:
+                shard = self.shards[name] = JsonCache(os.path.join(self.file_path, f"{name}.json"))
+                shard.name = self.name
+            if self.batch_stack is not None and shard.batch_depth == 0:
+                self.batch_stack.enter_context(shard.batch())
+            return shard
+
+    def shard_names(self):
+        prepare_cache_dir(self.file_path)
+        names = {os.path.splitext(os.path.basename(path))[0] for path in glob.glob(os.path.join(self.file_path, '*.json'))}
+        with self.lock:
+            return sorted(names | {name for name, shard in self.shards.items() if shard.pending is not None})
+
+    def group(self, keys):
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.shard_name(key), []).append(key)
+        return groups
+
+    def load(self):
+        data = {}
+        for name in self.shard_names():
+            data.update(self.shard(name=name).load())
+        return data
+
+    def get(self, key, default = None):
+        key = str(key)
+        return self.shard(key).get(key, default)
+
+    def __contains__(self, key):
+        key = str(key)
+        return key in self.shard(key)
+
+    def keys(self):
+        return list(self.load().keys())
+
+    def items(self):
+        return list(self.load().items())
+
+    def set(self, key, value):
+        self.update({key: value})
+
+    def update(self, data):
+        if not data:
+            return
+        data = {str(key): value for key, value in data.items()}
+        self.save_count()
+        for name, keys in self.group(data).items():
+            self.shard(name=name).update({key: data[key] for key in keys})
+
+    def delete(self, key):
+        key = str(key)
+        self.save_count()
+        self.shard(key).delete(key)
+
+    def save(self, data):
+        # Overwrite the whole cache, shards without any of the new keys end up empty
+        data = {str(key): value for key, value in data.items()}
+        self.save_count()
+        groups = self.group(data)
+        with self.batch():
+            for name in set(self.shard_names()) | set(groups):
+                self.shard(name=name).save({key: data[key] for key in groups.get(name, [])})
+
+    def clear(self):
+        with self.lock:
+            for shard in self.shards.values():
+                shard.clear()
+            self.shards = {name: shard for name, shard in self.shards.items() if shard.pending is not None}
+            if self.batch_depth == 0:
+                shutil.rmtree(self.file_path, ignore_errors=True)
+                self.count_saved = False
+
+    @contextmanager
+    def batch(self):
+        # Shards touched inside the batch are flushed together when it ends
+        with self.lock:
+            if self.batch_depth == 0:
+                self.batch_stack = ExitStack()
+            self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.batch_depth -= 1
+                if self.batch_depth == 0:
+                    stack, self.batch_stack = self.batch_stack, None
+                    stack.close()
+
+class RecordCache:
+    # Binary record file (see records.py), a point read maps the file and decodes a single record.
+    # Writes rewrite the file under its lock like JsonCache, but unchanged records are copied
+    # as raw bytes so only the changed values get serialized.
+    def __init__(self, file_path):
+        self.file_path = os.path.splitext(file_path)[0] + '.rec'
+        self.name = os.path.splitext(os.path.basename(file_path))[0]
+        self.json_path = file_path
+        self.lock = threading.RLock()
+        self.batch_depth = 0
+        self.view = None
+        self.reset_changes()
+        prepare_cache_dir(self.file_path)
+        if os.path.exists(self.json_path) and not os.path.exists(self.file_path):
+            migrate_json_cache(self.json_path, self)
+
+    def open_view(self):
+        # The mapped file, opened again once another writer replaced it
+        prepare_cache_dir(self.file_path)
+        try:
+            stat = os.stat(self.file_path)
+        except FileNotFoundError:
+            self.close_view()
+            return None
+        if self.view is None or self.view.stamp != (stat.st_ino, stat.st_mtime_ns, stat.st_size):
+            self.close_view()
+            try:
+                self.view = RecordFile(self.file_path)
+            except ValueError:
+                print(f"Cache file {self.file_path} is corrupt, moving it to {self.file_path}.corrupt")
+                os.replace(self.file_path, f"{self.file_path}.corrupt")
+                return None
+        return self.view
+
+    def close_view(self):
+        if self.view is not None:
+            self.view.close()
+            self.view = None
+
+    def read_value(self, key):
+        with self.lock:
+            if key in self.changes:
+                return copy.deepcopy(self.changes[key])
+            if key in self.removed or self.replaced:
+                return None
+            view = self.open_view()
+            raw = view.find(key) if view else None
+        if raw is None:
+            return None
+        increment('malfetcher_cache_bytes_read_total', len(raw), file=os.path.basename(self.file_path))
+        return loads(raw)
+
+    def load(self):
+        with self.lock:
+            data = {}
+            view = None if self.replaced else self.open_view()
+            if view:
+                decode = get_serializer()[1]
+                for key, value in view.records():
+                    if key not in self.removed and key not in self.changes:
+                        data[key] = decode(value)
+                increment('malfetcher_cache_bytes_read_total', view.index_offset, file=os.path.basename(self.file_path))
+            data.update(copy.deepcopy(self.changes))
+            return data
+
+    def get(self, key, default = None):
+        value = self.read_value(str(key))
+        record_cache_lookup(self.name, value is not None)
+        return default if value is None else value
+
+    def __contains__(self, key):
+        return self.read_value(str(key)) is not None
+
+    def keys(self):
+        with self.lock:
+            view = None if self.replaced else self.open_view()
+            keys = [key for key in (view.keys() if view else []) if key not in self.removed and key not in self.changes]
+            return keys + list(self.changes)
+
+    def items(self):
+        return list(self.load().items())
+
+    def set(self, key, value):
+        self.update({key: value})
+
+    def update(self, data):
+        if not data:
+            return
+        data = {str(key): copy.deepcopy(value) for key, value in data.items()}
+        with self.lock:
+            self.changes.update(data)
+            self.removed.difference_update(data)
+            self.dirty = True
+            if self.batch_depth == 0:
+                self.flush()
+
+    def delete(self, key):
+        key = str(key)
+        with self.lock:
+            if key not in self:
+                return
+            self.changes.pop(key, None)
+            self.removed.add(key)
+            self.dirty = True
+            if self.batch_depth == 0:
+                self.flush()
+
+    def save(self, data):
+        # Overwrite the whole cache
+        with self.lock:
+            self.changes = {str(key): value for key, value in data.items()}
+            self.removed = set()
+            self.replaced = True
+            self.dirty = True
+            if self.batch_depth == 0:
+                self.flush()
+
+    def clear(self):
+        prepare_cache_dir(self.file_path)
+        with self.lock, file_lock(self.file_path):
+            self.reset_changes()
+            self.close_view()
+            if os.path.exists(self.file_path):
+                os.remove(self.file_path)
+
+    def flush(self):
+        # Rewrite the file with the changes on top of what is on disk right now
+        prepare_cache_dir(self.file_path)
+        try:
+            with file_lock(self.file_path):
+                view = None if self.replaced else self.open_view()
+                changes = {key: dumps(value) for key, value in self.changes.items()}
+                temp_path = write_records(self.file_path, *rewrite_records(view, changes, self.removed))
+                # An open map keeps Windows from replacing the file
+                self.close_view()
+                try:
+                    os.replace(temp_path, self.file_path)
+                except BaseException:
+                    os.remove(temp_path)
+                    raise
+                increment('malfetcher_cache_bytes_written_total', os.path.getsize(self.file_path), file=os.path.basename(self.file_path))
+        finally:
+            self.reset_changes()
+
+    def reset_changes(self):
+        self.changes = {}
+        self.removed = set()
+        self.replaced = False
+        self.dirty = False
+
+    @contextmanager
+    def batch(self):
+        with self.lock:
+            self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.batch_depth -= 1
+                if self.batch_depth == 0 and self.dirty:
+                    self.flush()
+
+class MemoryCache:
+    # Process wide LRU/TTL tier in front of any backend, writes go through to the backend.
+    # Values are kept serialized and decoded on every read, so callers always get their own copy.
+    def __init__(self, backend, max_size = None, ttl = None):
+        self.backend = backend
+        self.max_size = memory_cache_size if max_size is None else max_size
+        self.ttl = memory_cache_ttl if ttl is None else ttl
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+
+    def remember(self, key, value):
+        if self.max_size <= 0:
+            return
+        encode, decode = get_serializer()
+        self.entries[key] = (encode(value), decode, time.monotonic() + self.ttl if self.ttl else None)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get(self, key, default = None):
+        key = str(key)
+        with self.lock:
+            if key in self.entries:
+                raw, decode, expires = self.entries[key]
+                if expires is None or expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    record_cache_lookup(getattr(self.backend, 'name', None), True, 'memory')
+                    return decode(raw)
+                del self.entries[key]
+        value = self.backend.get(key)
+        if value is None:
+            return default
+        with self.lock:
+            self.remember(key, value)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def load(self):
+        return self.backend.load()
+
+    def keys(self):
+        return self.backend.keys()
+
+    def items(self):
+        return self.backend.items()
+
+    def set(self, key, value):
+        self.update({key: value})
+
+    def update(self, data):
+        if not data:
+            return
+        self.backend.update(data)
+        with self.lock:
+            for key, value in data.items():
+                self.remember(str(key), value)
+
+    def delete(self, key):
+        self.backend.delete(key)
+        self.invalidate(key)
+
+    def save(self, data):
+        self.backend.save(data)
+        self.invalidate()
+
+    def clear(self):
+        self.backend.clear()
+        self.invalidate()
+
+    def invalidate(self, key = None):
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(str(key), None)
+
+    def configure(self, max_size = None, ttl = None):
+        with self.lock:
+            if max_size is not None:
+                self.max_size = max_size
+            if ttl is not None:
+                self.ttl = ttl
+            self.entries.clear()
+
+    def batch(self):
+        return self.backend.batch()
+
+cache_backends = {
+    'json': JsonCache,
+    'sharded': ShardedJsonCache,
+    'sqlite': SqliteCache,
+    'records': RecordCache
+}
+
+def register_cache_backend(name, backend_class):
+    cache_backends[name] = backend_class
+
+def configure_cache_format(serializer = None, pretty = None):
+    # serializer picks how cache values are encoded ('orjson', 'json' or a registered one),
+    # pretty=True writes the json cache files indented again
+    global pretty_cache_files
+    if serializer is not None:
+        set_serializer(serializer)
+    if pretty is not None:
+        pretty_cache_files = pretty
+
+def set_memory_cache_defaults(max_size = None, ttl = None):
+    global memory_cache_size, memory_cache_ttl
+    if max_size is not None:
+        memory_cache_size = max_size
+    if ttl is not None:
+        memory_cache_ttl = ttl
+
+def open_cache(file_path, backend = None, memory_tier = True):
+    backend = backend or os.getenv('MAL_CACHE_BACKEND', 'json')
+    try:
+        backend_class = cache_backends[backend.lower()]
+    except KeyError:
+        raise ValueError(f"Unknown cache backend {backend}. Available backends: {', '.join(cache_backends)}")
+    cache = backend_class(file_path)
+    if memory_tier:
+        cache = MemoryCache(cache)
+    return cache
+
+def migrate_json_cache(json_path, cache):
+    # Import an existing json cache file into any other backend
+    data = read_cache_file(json_path)
+    if data:
+        with cache.batch():
+            cache.update(data)
+    return len(data)
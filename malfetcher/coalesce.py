@@ -0,0 +1,133 @@
+import os, time, copy, asyncio, threading
+from collections import OrderedDict
+
+default_memo_ttl = float(os.getenv('MAL_RESPONSE_MEMO_TTL', 30))
+default_memo_size = int(os.getenv('MAL_RESPONSE_MEMO_SIZE', 1024))
+
+def request_key(url, params, scope, *extra):
+    params = tuple(sorted((str(key), str(value)) for key, value in (params or {}).items()))
+    return (url, params, scope) + extra
+
+class ResponseMemo:
+    # Short lived LRU of successful GET responses, values are copied in and out
+    def __init__(self, ttl = default_memo_ttl, max_size = default_memo_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                value, expires = self.entries[key]
+                if expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return copy.deepcopy(value)
+                del self.entries[key]
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        value = copy.deepcopy(value)
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, url = None):
+        with self.lock:
+            if url is None:
+                self.entries.clear()
+            else:
+                for key in [key for key in self.entries if key[0] == url]:
+                    del self.entries[key]
+
+class SingleFlight:
+    # Concurrent calls with the same key share one execution and its result
+    def __init__(self, memo = None):
+        self.memo = memo
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.shared = 0
+
+    def run(self, key, function, memoize = False, refresh = False):
+        # refresh=True skips the remembered response, the new one is remembered in its place
+        if memoize and self.memo and not refresh:
+            result = self.memo.get(key)
+            if result is not None:
+                return result
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+            else:
+                self.shared += 1
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return copy.deepcopy(call['result'])
+        try:
+            call['result'] = function()
+            if memoize and self.memo and call['result']:
+                self.memo.set(key, call['result'])
+            return call['result']
+        except BaseException as error:
+            call['error'] = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['done'].set()
+
+class AsyncSingleFlight:
+    # Same as SingleFlight for coroutines, calls are only shared within one event loop
+    def __init__(self, memo = None):
+        self.memo = memo
+        self.calls = {}
+        self.shared = 0
+
+    async def run(self, key, function, memoize = False, refresh = False):
+        if memoize and self.memo and not refresh:
+            result = self.memo.get(key)
+            if result is not None:
+                return result
+        key = (id(asyncio.get_running_loop()), key)
+        future = self.calls.get(key)
+        if future is not None:
+            self.shared += 1
+            return copy.deepcopy(await asyncio.shield(future))
+        future = self.calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await function()
+            if memoize and self.memo and result:
+                self.memo.set(key[1], result)
+            future.set_result(result)
+            return result
+        except BaseException as error:
+            future.set_exception(error)
+            future.exception() # waiters get the error, don't warn about it being unretrieved
+            raise
+        finally:
+            del self.calls[key]
+
+response_memo = ResponseMemo()
+single_flight = SingleFlight(response_memo)
+async_single_flight = AsyncSingleFlight(response_memo)
+
+def configure_request_coalescing(memo_ttl = None, memo_size = None):
+    # memo_ttl=0 turns the response memo off, identical in-flight requests are still shared
+    with response_memo.lock:
+        if memo_ttl is not None:
+            response_memo.ttl = memo_ttl
+        if memo_size is not None:
+            response_memo.max_size = memo_size
+        response_memo.entries.clear()
+    return response_memo
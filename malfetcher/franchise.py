@@ -0,0 +1,124 @@
+import heapq, threading
+
+# Persisted prequel/sequel graph of everything in the id cache. Every anime belongs to a
+# franchise (connected component) which keeps its members in release order and the
+# season ranges once they have been computed.
+
+node_fields = ('main_title', 'format', 'total_eps', 'status', 'related')
+
+def sort_key(anime_id):
+    return (0, int(anime_id)) if str(anime_id).isdigit() else (1, str(anime_id))
+
+class FranchiseIndex:
+    def __init__(self, nodes, franchises):
+        self.nodes = nodes # {anime_id: projected entry + franchise id}, ids only seen in relations are stubs
+        self.franchises = franchises # {franchise_id: {'members': [...], 'seasons': [...], 'ranges': {...}}}
+        self.lock = threading.RLock()
+
+    def get_franchise_id(self, anime_id):
+        node = self.nodes.get(str(anime_id))
+        return node['franchise'] if node else None
+
+    def get_franchise(self, anime_id):
+        franchise_id = self.get_franchise_id(anime_id)
+        if franchise_id is None:
+            return None
+        franchise = self.franchises.get(franchise_id)
+        if franchise is None:
+            return None
+        return {'id': franchise_id, 'members': franchise['members'], 'seasons': franchise['seasons']}
+
+    def get_node(self, anime_id):
+        # The indexed part of a cache entry, None for unknown ids and stubs
+        node = self.nodes.get(str(anime_id))
+        if node is None or node.get('stub'):
+            return None
+        return node
+
+    def get_ranges(self, anime_id):
+        franchise_id = self.get_franchise_id(anime_id)
+        franchise = self.franchises.get(franchise_id) if franchise_id is not None else None
+        if not franchise or franchise.get('ranges') is None:
+            return None
+        # json turns the season numbers into strings
+        return {int(season): dict(season_range) for season, season_range in franchise['ranges'].items()}
+
+    def set_ranges(self, anime_id, season_ranges):
+        with self.lock:
+            franchise_id = self.get_franchise_id(anime_id)
+            if franchise_id is None:
+                return
+            franchise = self.franchises.get(franchise_id)
+            if franchise is not None:
+                self.franchises.set(franchise_id, dict(franchise, ranges=season_ranges))
+
+    def order_seasons(self, members, nodes):
+        # Topological order over sequel edges, ties broken by id
+        successors = {member: set() for member in members}
+        predecessors = {member: 0 for member in members}
+        for member in members:
+            for relation_id, relation in (nodes[member].get('related') or {}).items():
+                if relation_id not in successors:
+                    continue
+                edge = (member, relation_id) if relation['type'] == 'SEQUEL' else (relation_id, member)
+                if edge[1] not in successors[edge[0]]:
+                    successors[edge[0]].add(edge[1])
+                    predecessors[edge[1]] += 1
+        ready = [(sort_key(member), member) for member in members if not predecessors[member]]
+        heapq.heapify(ready)
+        seasons = []
+        while ready:
+            _, member = heapq.heappop(ready)
+            seasons.append(member)
+            for successor in successors[member]:
+                predecessors[successor] -= 1
+                if not predecessors[successor]:
+                    heapq.heappush(ready, (sort_key(successor), successor))
+        # Whatever is left sits on a cycle, keep it at the end instead of dropping it
+        seasons += sorted((member for member in members if member not in seasons), key=sort_key)
+        return seasons
+
+    def update(self, anime_data):
+        # Index freshly cached entries, franchises get merged as new edges show up.
+        # Franchises whose members changed lose their cached season ranges.
+        if not anime_data:
+            return
+        with self.lock, self.nodes.batch(), self.franchises.batch():
+            changed_nodes = {}
+            for anime_id, entry in anime_data.items():
+                anime_id = str(anime_id)
+                node = {field: entry.get(field) for field in node_fields}
+                old_node = self.nodes.get(anime_id)
+                if old_node is not None and not old_node.get('stub') and {field: old_node.get(field) for field in node_fields} == node:
+                    continue
+                changed_nodes[anime_id] = node
+            for anime_id, node in changed_nodes.items():
+                self.add_node(anime_id, node)
+
+    def add_node(self, anime_id, node):
+        touched = {anime_id, *(node['related'] or {})}
+        franchise_ids = {self.get_franchise_id(member) for member in touched} - {None}
+        members = set(touched)
+        for franchise_id in franchise_ids:
+            franchise = self.franchises.get(franchise_id)
+            if franchise is not None:
+                members.update(franchise['members'])
+        members = sorted(members, key=sort_key)
+        franchise_id = members[0]
+        nodes = {}
+        for member in members:
+            member_node = node if member == anime_id else self.nodes.get(member) or {'stub': True, 'related': None}
+            nodes[member] = dict(member_node, franchise=franchise_id)
+        self.nodes.update(nodes)
+        for old_franchise_id in franchise_ids - {franchise_id}:
+            self.franchises.delete(old_franchise_id)
+        self.franchises.set(franchise_id, {
+            'members': members,
+            'seasons': self.order_seasons([member for member in members if not nodes[member].get('stub')], nodes),
+            'ranges': None
+        })
+
+    def clear(self):
+        with self.lock:
+            self.nodes.clear()
+            self.franchises.clear()
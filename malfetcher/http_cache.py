@@ -0,0 +1,167 @@
+import os, json, time, sqlite3, hashlib, threading
+from contextlib import contextmanager
+from .utils import dumps, loads, env_flag
+from .cache import prepare_cache_dir
+
+# Conditional GETs, responses that come with an ETag or Last-Modified header get one row each
+# with their validators and a 304 answer is served from here. The body is only kept when the
+# caller has nowhere else to keep it, anime nodes end up in the id cache anyway. Requests sent
+# with a user token are never stored. MAL_HTTP_CACHE=0 turns it off, MAL_HTTP_CACHE_SIZE caps
+# the rows, the least recently used ones go first.
+
+http_cache_enabled = env_flag('MAL_HTTP_CACHE')
+default_max_entries = int(os.getenv('MAL_HTTP_CACHE_SIZE', 5000))
+trim_every = 100 # saves between evictions
+
+class NotModified:
+    # Returned for a 304 when the caller keeps the parsed response itself, survives the coalescing copies
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+not_modified = NotModified()
+
+class CachedResponse:
+    # Stands in for a requests response when the server answered 304
+    def __init__(self, entry):
+        self.status_code = 200
+        self.headers = {'ETag': entry['etag'], 'Last-Modified': entry['last_modified']}
+        self.body = entry['body']
+        self.from_cache = True
+
+    def json(self):
+        return self.body
+
+    @property
+    def text(self):
+        return json.dumps(self.body, ensure_ascii=False)
+
+class HttpCache:
+    def __init__(self, file_path, enabled = http_cache_enabled, max_entries = default_max_entries):
+        self.file_path = file_path
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.connection = None # opened on first use
+        self.lock = threading.RLock()
+        self.batch_depth = 0
+        self.saves = 0
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+
+    def connect(self):
+        with self.lock:
+            if self.connection is None:
+                prepare_cache_dir(self.file_path)
+                os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+                self.connection = sqlite3.connect(self.file_path, check_same_thread=False, isolation_level=None)
+                self.connection.execute("PRAGMA journal_mode=WAL")
+                self.connection.execute("CREATE TABLE IF NOT EXISTS http_cache (key TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, body BLOB, used_at REAL NOT NULL)")
+                self.connection.execute("CREATE INDEX IF NOT EXISTS http_cache_used_at ON http_cache (used_at)")
+            return self.connection
+
+    def execute(self, query, args = ()):
+        with self.lock:
+            return self.connect().execute(query, args).fetchall()
+
+    def key(self, url, params):
+        params = sorted((str(key), str(value)) for key, value in (params or {}).items())
+        return hashlib.sha256(json.dumps([url, params]).encode()).hexdigest()
+
+    def lookup(self, url, params, headers, keep_body = True, revalidate = True):
+        # Returns (key, entry, headers with validators) for the request about to be sent.
+        # keep_body=False means the caller caches the parsed response itself, only the validators
+        # get stored and a 304 returns not_modified. revalidate=False sends no validators, for such
+        # a caller that has no parsed response yet.
+        if not self.enabled or 'Authorization' in headers:
+            return None, None, headers
+        key = self.key(url, params)
+        if not revalidate:
+            return key, None, headers
+        row = self.execute("SELECT etag, last_modified, body FROM http_cache WHERE key = ?", (key,))
+        if not row or (keep_body and row[0][2] is None):
+            return key, None, headers
+        etag, last_modified, body = row[0]
+        headers = dict(headers)
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return key, {'key': key, 'etag': etag, 'last_modified': last_modified, 'body': body if keep_body else None}, headers
+
+    def revalidated(self, entry):
+        # The body of a 304, not_modified when only the validators are stored
+        with self.lock:
+            self.hits += 1
+        self.execute("UPDATE http_cache SET used_at = ? WHERE key = ?", (time.time(), entry['key']))
+        if entry['body'] is None:
+            return not_modified
+        return loads(entry['body'])
+
+    def save(self, key, headers, body, keep_body = True):
+        if key is None:
+            return
+        with self.lock:
+            self.misses += 1
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if not etag and not last_modified:
+            return
+        self.execute(
+            "INSERT OR REPLACE INTO http_cache (key, etag, last_modified, body, used_at) VALUES (?, ?, ?, ?, ?)",
+            (key, etag, last_modified, dumps(body) if keep_body else None, time.time())
+        )
+        with self.lock:
+            self.stored += 1
+            self.saves += 1
+            trim = self.saves % trim_every == 0
+        if trim:
+            self.trim()
+
+    def trim(self):
+        # Drops the least recently used rows past max_entries
+        self.execute(
+            "DELETE FROM http_cache WHERE key IN (SELECT key FROM http_cache ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+            (max(self.max_entries, 0),)
+        )
+
+    def load(self):
+        # Every row with its body decoded, for export_cache()
+        return {
+            key: {'etag': etag, 'last_modified': last_modified, 'body': loads(body) if body is not None else None}
+            for key, etag, last_modified, body in self.execute("SELECT key, etag, last_modified, body FROM http_cache")
+        }
+
+    @contextmanager
+    def batch(self):
+        # Many saves in one transaction, also fine from several threads
+        if not self.enabled:
+            yield self
+            return
+        with self.lock:
+            if self.batch_depth == 0:
+                self.connect().execute("BEGIN")
+            self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.batch_depth -= 1
+                if self.batch_depth == 0:
+                    self.connection.execute("COMMIT")
+
+    def clear(self):
+        self.execute("DELETE FROM http_cache")
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def stats(self):
+        entries = self.execute("SELECT COUNT(*) FROM http_cache")[0][0] if self.connection is not None else None
+        with self.lock:
+            return {'enabled': self.enabled, 'hits': self.hits, 'misses': self.misses, 'stored': self.stored, 'entries': entries}
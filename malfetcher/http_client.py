@@ -0,0 +1,92 @@
+import os, threading, requests
+from requests import RequestException
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .rate_limit import get_rate_limiter, get_service
+from .metrics import record_request, timer
+
+default_pool_size = int(os.getenv('MAL_POOL_SIZE', 10))
+default_max_retries = int(os.getenv('MAL_CONNECTION_RETRIES', 3))
+default_timeout = float(os.getenv('MAL_REQUEST_TIMEOUT', 30))
+
+class HttpClient:
+    def __init__(self, pool_size = default_pool_size, max_retries = default_max_retries, timeout = default_timeout):
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def create_session(self):
+        session = requests.Session()
+        # Only retry on connection level errors, http status codes are handled by the callers
+        retry = Retry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            read=self.max_retries,
+            status=0,
+            backoff_factor=0.5,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def get_session(self, url):
+        # One keep-alive session per host (api.myanimelist.net, myanimelist.net, graphql.anilist.co)
+        host = urlsplit(url).netloc
+        session = self.sessions.get(host)
+        if session is None:
+            with self.lock:
+                session = self.sessions.get(host)
+                if session is None:
+                    session = self.create_session()
+                    self.sessions[host] = session
+        return session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        rate_limiter = get_rate_limiter(url)
+        if rate_limiter:
+            rate_limiter.acquire()
+        elapsed = timer()
+        try:
+            response = self.get_session(url).request(method.upper(), url, **kwargs)
+        except RequestException:
+            record_request(get_service(url), url, 'error', elapsed())
+            raise
+        record_request(get_service(url), url, response.status_code, elapsed(), len(response.content))
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('get', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('post', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('put', url, **kwargs)
+
+    def configure(self, pool_size = None, max_retries = None, timeout = None):
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if max_retries is not None:
+            self.max_retries = max_retries
+        if timeout is not None:
+            self.timeout = timeout
+        self.close() # sessions get recreated with the new settings on next request
+
+    def close(self):
+        with self.lock:
+            sessions = self.sessions
+            self.sessions = {}
+        for session in sessions.values():
+            session.close()
+
+http_client = HttpClient()
+
+def configure_http_client(pool_size = None, max_retries = None, timeout = None):
+    http_client.configure(pool_size, max_retries, timeout)
+    return http_client
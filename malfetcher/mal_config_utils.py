@@ -1,9 +1,8 @@
 import socket
-import os, webbrowser, platform, requests, gevent, gc, string, random
-from flask import Flask, request, redirect
-from gevent.pywsgi import WSGIServer
+import os, platform, gc, string, random
 from urllib.parse import parse_qs
 from .utils import utils_save_json, utils_read_json
+from .http_client import http_client
 from time import sleep
 
 def generate_mal_verifier():
@@ -17,7 +16,7 @@ def generate_mal_verifier():
     code_verifier = generate_random_string(code_verifier_length)
     return code_verifier
 
-code_verifier = generate_mal_verifier()
+code_verifier = None # generated when config_setup() starts the oauth flow
 
 def get_ip_address():
     try:
@@ -33,7 +32,7 @@ def get_ip_address():
 # Paths
 script_path = os.path.dirname(os.path.abspath(__file__))
 config_path = os.path.join(script_path, 'config', 'config.json')
-config = utils_read_json(config_path)
+config = None # read on first use, importing the package shouldn't touch the disk
 
 is_ssh = 'SSH_CONNECTION' in os.environ
 is_displayless = 'DISPLAY' not in os.environ
@@ -43,10 +42,19 @@ if is_linux:
     if is_ssh or is_displayless:
         headless_config = True
 
-if headless_config:
-    host_ip = get_ip_address()
-else:
-    host_ip = 'localhost'
+host_ip = None
+
+def get_host_ip():
+    # Resolved on first use, on headless machines this needs a socket
+    global host_ip
+    if host_ip is None:
+        host_ip = get_ip_address() if headless_config else 'localhost'
+    return host_ip
+
+def read_config():
+    global config
+    config = utils_read_json(config_path) or {}
+    return config
 
 def gen_please(name, help):
     return f"Please input your {name} here ({help}):\n"
@@ -61,17 +69,16 @@ def get_input(prompt, data_type = str):
             print("Invalid input. Please enter a valid", data_type.__name__)   
 
 def minimal_setup():
-    global config
-    if not config or 'myanimelist_client_id' not in config:
+    config = read_config()
+    if 'myanimelist_client_id' not in config:
         print("Please create a new API client")
-        print(f"Put this as the redirect URI: http://{host_ip}:8888/access_token")
+        print(f"Put this as the redirect URI: http://{get_host_ip()}:8888/access_token")
         if headless_config:
             client_id = get_input(gen_please("MyAnimeList API Client ID","https://myanimelist.net/apiconfig"))
         else:
+            import webbrowser
             webbrowser.open("https://myanimelist.net/apiconfig", 0)
             client_id = get_input(gen_please("MyAnimeList API Client ID","Paste the Client ID"))
-        if not config:
-            config = {}
         config['myanimelist_client_id'] = client_id
         utils_save_json(config_path, config)
     else:
@@ -92,7 +99,7 @@ def generate_user_agents(num_agents):
     return random.sample(user_agents, num_agents)
 
 def regenerate_token():
-    global code_verifier
+    config = read_config()
     user_agents = generate_user_agents(8)
     chosen_user_agent = random.choice(user_agents)
     headers = {
@@ -107,7 +114,7 @@ def regenerate_token():
         'grant_type': "refresh_token",
         'refresh_token': config['myanimelist_refresh_token'],
     }
-    response = requests.post("https://myanimelist.net/v1/oauth2/token", data=json, headers=headers)
+    response = http_client.post("https://myanimelist.net/v1/oauth2/token", data=json, headers=headers)
     if response.status_code == 200:
         response = response.json()
     else:
@@ -118,6 +125,11 @@ def regenerate_token():
     utils_save_json(config_path, config)
 
 def setup_webserver():
+    # The oauth webserver stack is heavy, only load it when the setup actually runs
+    import webbrowser
+    from flask import Flask, request, redirect
+    from gevent.pywsgi import WSGIServer
+
     app = Flask(__name__)
 
     # Enable CORS for all routes
@@ -145,11 +157,11 @@ def setup_webserver():
                 'client_secret': global_secret,
                 'grant_type': "authorization_code",
                 'code': code,
-                'redirect_uri': f"http://{host_ip}:8888/access_token",
+                'redirect_uri': f"http://{get_host_ip()}:8888/access_token",
                 'code_verifier': code_verifier,
                 'state': "authrequest"
             }
-            response = requests.post("https://myanimelist.net/v1/oauth2/token", data=json, headers=headers)
+            response = http_client.post("https://myanimelist.net/v1/oauth2/token", data=json, headers=headers)
             if response.status_code == 200:
                 return response.json()
             else:
@@ -180,12 +192,15 @@ def setup_webserver():
             webbrowser.open(global_tooltip, 0)
         http_server.serve_forever()
 
-    http_server = WSGIServer((host_ip, 8888), app, log=None)
+    http_server = WSGIServer((get_host_ip(), 8888), app, log=None)
 
     return start_webserver, http_server 
         
 def config_setup(print_only = False):
-    global config
+    global code_verifier
+    import webbrowser, gevent
+    config = read_config()
+    code_verifier = generate_mal_verifier()
     setup_function, _ = setup_webserver()  # Setup the server function here  
     
     def generate_api_key(client_id, client_secret):
@@ -198,7 +213,7 @@ def config_setup(print_only = False):
         global_tooltip = "https://myanimelist.net/v1/oauth2/authorize?"
         global_tooltip += "response_type=code"
         global_tooltip += f"&client_id={global_id}"
-        global_tooltip += f"&redirect_uri=http://{host_ip}:8888/access_token"
+        global_tooltip += f"&redirect_uri=http://{get_host_ip()}:8888/access_token"
         global_tooltip += f"&code_challenge={code_verifier}"
         global_tooltip += "&code_challenge_method=plain"
         
@@ -212,7 +227,7 @@ def config_setup(print_only = False):
 
     if 'myanimelist_client_id' not in config:
         print("Please create a new API client")
-        print(f"Put this as the redirect URI: http://{host_ip}:8888/access_token")
+        print(f"Put this as the redirect URI: http://{get_host_ip()}:8888/access_token")
     if headless_config:
         if is_displayless:
             print("The setup process cannot be continued on this machine")
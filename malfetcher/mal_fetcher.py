@@ -1,16 +1,58 @@
-import requests, time, os, copy, math, re
-from datetime import datetime, timedelta
-from .utils import utils_save_json, utils_read_json, print_deb
-from .mal_config_utils import config_setup, regenerate_token, minimal_setup
+import time, os, math, re, threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from .utils import utils_save_json, utils_read_json, print_deb, env_flag
+from .http_client import http_client, RequestException
+from .retry import retry_policies, circuit_breakers
+from .coalesce import single_flight, response_memo, request_key
+from .metrics import span, traced
+from .http_cache import HttpCache, CachedResponse, not_modified
+from .models import AnimeEntry
+from .title_index import TitleIndex
+from .cache import open_cache, set_memory_cache_defaults, default_cache_dir, import_legacy_cache_dir
+from .refresh import RefreshScheduler
+from .franchise import FranchiseIndex
+from .user_lists import UserListSnapshots, newer_nodes
+from .mal_config_utils import config_setup, regenerate_token, minimal_setup, read_config
 
 # Paths
 
 script_path = os.path.dirname(os.path.abspath(__file__))
-mal_id_cache_path = os.path.join(script_path, 'cache', 'myanimelist_id_cache.json')
-mal_search_cache_path = os.path.join(script_path, 'cache', 'myanimelist_search_cache.json')
-mal_to_al_cache_path = os.path.join(script_path, 'cache', 'mal_to_al_cache.json')
+# Caches live outside the package, MAL_CACHE_DIR or set_cache_dir() move them anywhere
+legacy_cache_dir = os.path.join(script_path, 'cache')
+cache_dir = default_cache_dir()
+import_legacy_cache_dir(legacy_cache_dir, cache_dir)
+mal_id_cache_path = os.path.join(cache_dir, 'myanimelist_id_cache.json')
+mal_search_cache_path = os.path.join(cache_dir, 'myanimelist_search_cache.json')
+mal_to_al_cache_path = os.path.join(cache_dir, 'mal_to_al_cache.json')
+refresh_schedule_path = os.path.join(cache_dir, 'refresh_schedule.json')
+franchise_nodes_path = os.path.join(cache_dir, 'franchise_nodes.json')
+franchise_index_path = os.path.join(cache_dir, 'franchise_index.json')
+http_cache_path = os.path.join(cache_dir, 'http_validators.sqlite3')
+user_lists_path = os.path.join(cache_dir, 'user_lists.json')
 config_path = os.path.join(script_path, 'config', 'config.json')
-anime_request_url = "https://api.myanimelist.net/v2/anime"
+# Both can be pointed at a local stand-in server
+mal_base_url = os.getenv('MAL_API_URL', "https://api.myanimelist.net/v2").rstrip('/')
+anilist_api_url = os.getenv('ANILIST_API_URL', "https://graphql.anilist.co")
+anime_request_url = f"{mal_base_url}/anime"
+
+# Caches
+
+cache_backend = None # None follows MAL_CACHE_BACKEND
+mal_id_cache = open_cache(mal_id_cache_path)
+mal_search_cache = open_cache(mal_search_cache_path)
+mal_to_al_cache = open_cache(mal_to_al_cache_path)
+http_cache = HttpCache(http_cache_path)
+
+# Concurrency
+
+max_workers = int(os.getenv('MAL_MAX_WORKERS', 4))
+mal_cooldown_until = 0 # shared between threads, set when MAL responds with 429
+mal_cooldown_lock = threading.Lock()
+
+# Entry model, MAL_ENTRY_MODEL=1 makes the api return compact AnimeEntry objects
+
+entry_model = env_flag('MAL_ENTRY_MODEL', False)
 
 # Global vars
 
@@ -33,77 +75,263 @@ al_to_mal_status = {
 mal_to_al_status = {v:k for k, v in al_to_mal_status.items()}
 status_options = ["CURRENT", "PLANNING", "COMPLETED", "DROPPED", "PAUSED", "REPEATING"]
 media_formats = ['TV', 'MOVIE', 'SPECIAL', 'OVA', 'ONA', 'MUSIC']
+anime_fields = (
+    "id,"
+    "title,"
+    "alternative_titles,"
+    "start_date,"
+    "end_date,"
+    "nsfw,"
+    "media_type,"
+    "status,"
+    "genres,"
+    "my_list_status,"
+    "num_episodes,"
+    "related_anime"
+)
+user_list_status_field = "my_list_status{status,num_times_rewatched,is_rewatching,num_episodes_watched,updated_at}"
+user_anime_fields = anime_fields.replace("my_list_status,", f"{user_list_status_field},")
+# MAL fields every entry field is built from. A projection builds only some of the entry fields,
+# requests only their MAL fields and skips the relation and AniList lookups when it can.
+entry_field_sources = {
+    'al_id': ('id',),
+    'total_eps': ('num_episodes',),
+    'is_sus': ('genres', 'nsfw'),
+    'main_title': ('title',),
+    'synonyms': ('alternative_titles',),
+    'status': ('status',),
+    'release_date': ('start_date',),
+    'end_date': ('end_date',),
+    'upcoming_ep': ('status', 'start_date'),
+    'format': ('media_type',),
+    'related': ('related_anime',)
+}
+projections = {
+    'minimal': ('main_title', 'format'),
+    'list': ('total_eps', 'main_title', 'synonyms', 'status', 'release_date', 'end_date', 'upcoming_ep', 'format'),
+    'full': tuple(entry_field_sources)
+}
 
-# Minimal user setup to interact with MyAnimeList API
-config = utils_read_json(config_path)
-client_id = os.getenv("MAL_CLIENT_ID", "") if os.getenv("MAL_CLIENT_ID", "") else minimal_setup()
+# Minimal user setup to interact with MyAnimeList API, resolved on the first request
+client_id = None
 
 # Utils
 
+def get_client_id(interactive = True):
+    # interactive=False raises instead of asking for the client id, the async api can't prompt
+    global client_id
+    if not client_id:
+        if os.getenv("MAL_CLIENT_ID", ""):
+            client_id = os.getenv("MAL_CLIENT_ID")
+        elif interactive:
+            client_id = minimal_setup()
+        else:
+            client_id = read_config().get('myanimelist_client_id')
+            if not client_id:
+                raise RuntimeError("No MyAnimeList client id configured, set MAL_CLIENT_ID or run the setup first")
+    return client_id
+
+def set_cache_backend(backend):
+    global mal_id_cache, mal_search_cache, mal_to_al_cache, refresh_scheduler, franchise_index, http_cache, cache_backend, user_list_snapshots
+    cache_backend = backend
+    mal_id_cache = open_cache(mal_id_cache_path, backend)
+    mal_search_cache = open_cache(mal_search_cache_path, backend)
+    mal_to_al_cache = open_cache(mal_to_al_cache_path, backend)
+    http_cache.close()
+    http_cache = HttpCache(http_cache_path, http_cache.enabled, http_cache.max_entries)
+    refresh_scheduler.stop()
+    refresh_scheduler = create_refresh_scheduler(backend)
+    franchise_index = create_franchise_index(backend)
+    user_list_snapshots = create_user_list_snapshots(backend)
+    title_index.clear()
+
+def set_cache_dir(path = None, backend = None):
+    # Point every cache at path, None goes back to MAL_CACHE_DIR or the per user default.
+    # backend='sharded' splits the big caches into small files, None keeps the current backend.
+    global cache_dir, mal_id_cache_path, mal_search_cache_path, mal_to_al_cache_path, refresh_schedule_path
+    global franchise_nodes_path, franchise_index_path, http_cache_path, user_lists_path
+    cache_dir = os.path.abspath(os.path.expanduser(path)) if path else default_cache_dir()
+    mal_id_cache_path = os.path.join(cache_dir, os.path.basename(mal_id_cache_path))
+    mal_search_cache_path = os.path.join(cache_dir, os.path.basename(mal_search_cache_path))
+    mal_to_al_cache_path = os.path.join(cache_dir, os.path.basename(mal_to_al_cache_path))
+    refresh_schedule_path = os.path.join(cache_dir, os.path.basename(refresh_schedule_path))
+    franchise_nodes_path = os.path.join(cache_dir, os.path.basename(franchise_nodes_path))
+    franchise_index_path = os.path.join(cache_dir, os.path.basename(franchise_index_path))
+    http_cache_path = os.path.join(cache_dir, os.path.basename(http_cache_path))
+    user_lists_path = os.path.join(cache_dir, os.path.basename(user_lists_path))
+    set_cache_backend(backend or cache_backend)
+    return cache_dir
+
+def use_entry_model(enabled = True):
+    # Return AnimeEntry objects instead of plain dicts, the caches keep storing dicts
+    global entry_model
+    entry_model = enabled
+
+def as_entries(anime_data):
+    if not entry_model:
+        return anime_data
+    return {anime_id: entry if isinstance(entry, (AnimeEntry, LazyAnimeEntry)) else AnimeEntry(entry) for anime_id, entry in anime_data.items()}
+
+def configure_http_cache(enabled = None, max_entries = None):
+    if enabled is not None:
+        http_cache.enabled = enabled
+    if max_entries is not None:
+        http_cache.max_entries = max_entries
+        http_cache.trim()
+    return http_cache
+
+def get_http_cache_stats():
+    return http_cache.stats()
+
+def configure_memory_cache(max_size = None, ttl = None):
+    set_memory_cache_defaults(max_size, ttl)
+    for cache in (mal_id_cache, mal_search_cache, mal_to_al_cache):
+        cache.configure(max_size, ttl)
+
+def invalidate_memory_cache(anime_id = None):
+    if anime_id is None:
+        for cache in (mal_id_cache, mal_search_cache, mal_to_al_cache):
+            cache.invalidate()
+    else:
+        mal_id_cache.invalidate(anime_id)
+        mal_to_al_cache.invalidate(anime_id)
+
+def export_cache(directory = None):
+    # Write every cache as indented json, whatever backend and serializer they are stored with
+    directory = os.path.abspath(os.path.expanduser(directory)) if directory else os.path.join(cache_dir, 'export')
+    caches = {
+        mal_id_cache_path: mal_id_cache,
+        mal_search_cache_path: mal_search_cache,
+        mal_to_al_cache_path: mal_to_al_cache,
+        refresh_schedule_path: refresh_scheduler.store,
+        franchise_nodes_path: franchise_index.nodes,
+        franchise_index_path: franchise_index.franchises,
+        http_cache_path: http_cache,
+        user_lists_path: user_list_snapshots.store
+    }
+    exported = []
+    for cache_path, cache in caches.items():
+        export_path = os.path.join(directory, os.path.splitext(os.path.basename(cache_path))[0] + '.json')
+        utils_save_json(export_path, cache.load(), pretty=True)
+        exported.append(export_path)
+    return exported
+
 def clear_cache():
-    config = utils_read_json(config_path)
-    try:
-        del config["checked_date"]
-    except:
-        pass
-    os.remove(mal_id_cache_path)
-    os.remove(mal_search_cache_path)
+    mal_id_cache.clear()
+    mal_search_cache.clear()
+    refresh_scheduler.clear()
+    franchise_index.clear()
+    http_cache.clear()
+    user_list_snapshots.clear()
+    title_index.clear()
+    invalidate_memory_cache()
+
+# Cache refreshing
+
+def refresh_cached_entries(anime_ids):
+    return get_anime_info_many(anime_ids, True)
+
+def create_refresh_scheduler(backend = None):
+    return RefreshScheduler(
+        open_cache(refresh_schedule_path, backend, memory_tier=False),
+        lambda: mal_id_cache.load(),
+        refresh_cached_entries
+    )
+
+refresh_scheduler = create_refresh_scheduler()
+
+def create_franchise_index(backend = None):
+    return FranchiseIndex(open_cache(franchise_nodes_path, backend), open_cache(franchise_index_path, backend))
+
+franchise_index = create_franchise_index()
+
+def create_user_list_snapshots(backend = None):
+    return UserListSnapshots(open_cache(user_lists_path, backend, memory_tier=False))
+
+user_list_snapshots = create_user_list_snapshots()
+title_index = TitleIndex(lambda: mal_id_cache.load())
+
+def index_cached_entries(anime_data):
+    # Everything written to the id cache goes through here to keep the refresh schedule, franchise graph and title index current
+    refresh_scheduler.track(anime_data)
+    franchise_index.update({anime_id: entry for anime_id, entry in anime_data.items() if 'related' in entry})
+    title_index.add(anime_data)
+
+def search_titles(query, media_format = None, limit = 10, threshold = None):
+    # Fuzzy lookup over the cached titles and synonyms, [(anime_id, score, matched title)]
+    return title_index.search(query, media_format.upper() if media_format else None, limit, threshold)
 
 def check_status_in_cache():
-    og_cache = utils_read_json(mal_id_cache_path)
-    if not og_cache: return
-    cache = copy.deepcopy(og_cache)
-    config_dict = utils_read_json(config_path) if utils_read_json(config_path) else {}
-    current_date = datetime.now().date()
-    try:
-        checked_date = datetime.strptime(config_dict['checked_date'], '%Y-%m-%d').date()
-    except:
-        config_dict['checked_date'] = current_date.strftime('%Y-%m-%d')
-        utils_save_json(config_path, config_dict)
-        checked_date = current_date
-    if current_date > checked_date:
-        for anime in og_cache:
-            try:
-                release_date = datetime.strptime(cache[anime]['release_date'], '%Y-%m-%d').date()
-            except:
-                release_date = None
-            try:
-                end_date = datetime.strptime(cache[anime]['end_date'], '%Y-%m-%d').date()
-            except:
-                end_date = None
-            status = cache[anime]['status']
-            if status == "NOT_YET_RELEASED":
-                cache.update(get_anime_info(anime, True)) #force update everytime
-            elif status == "RELEASING" and release_date:
-                    try:
-                        next_ep_date = release_date + timedelta(cache[anime]['upcoming_ep'] * 7)
-                        if end_date and current_date > end_date:
-                            updated_info = get_anime_info(anime, True)
-                            cache.update(updated_info)
-                        if current_date > next_ep_date:
-                            updated_info = get_anime_info(anime, True)
-                            cache.update(updated_info)
-                    except: #force update if we don't have the next episode
-                        updated_info = get_anime_info(anime, True)
-                        cache.update(updated_info)
-        config_dict['checked_date'] = current_date.strftime('%Y-%m-%d')
-        utils_save_json(config_path, config_dict)
-        utils_save_json(mal_id_cache_path, cache, True)
+    # Never blocks, stale entries get refreshed in the background in bounded batches
+    refresh_scheduler.poke()
+
+def refresh_stale_entries(budget = None):
+    # Refresh up to budget entries that are due right now, in the calling thread
+    return refresh_scheduler.run(budget)
+
+def start_refresh_scheduler(interval = None):
+    refresh_scheduler.start(interval)
+
+def stop_refresh_scheduler():
+    refresh_scheduler.stop()
+
+def configure_refresh_scheduler(budget = None, interval = None, auto = None):
+    refresh_scheduler.configure(budget, interval, auto)
+    return refresh_scheduler
+
+def configure_user_list_sync(enabled = None, full_sync_interval = None, page_size = None):
+    # enabled=False fetches the whole list on every call again
+    user_list_snapshots.configure(enabled, full_sync_interval, page_size)
+    return user_list_snapshots
+
+# Field projections
+
+def get_projection(projection = None):
+    # A profile name from projections or an iterable of entry fields, None is the full entry
+    if projection is None:
+        return projections['full']
+    if isinstance(projection, str):
+        if projection not in projections:
+            print("Invalid projection, using the full entry. Please choose from:", ", ".join(projections))
+            return projections['full']
+        return projections[projection]
+    projection = set(projection)
+    unknown_fields = projection - set(entry_field_sources)
+    if unknown_fields:
+        print("Ignoring unknown entry fields:", ", ".join(sorted(unknown_fields)))
+    return tuple(field for field in entry_field_sources if field in projection)
+
+def projection_query(fields, user_request = False):
+    # The MAL fields query for a projection, the full one keeps the exact query it always had
+    if fields == projections['full']:
+        return user_anime_fields if user_request else anime_fields
+    mal_fields = dict.fromkeys(['id'] + [source for field in fields for source in entry_field_sources[field]])
+    if user_request:
+        # The list filters on media_type
+        mal_fields['media_type'] = None
+        mal_fields[user_list_status_field] = None
+    return ",".join(mal_fields)
+
+def has_fields(entry, fields):
+    # Cached entries hold exactly the fields they were built with
+    return all(field in entry for field in fields)
 
 def load_cache():
     check_status_in_cache()
-    return utils_read_json(mal_id_cache_path)
+    return mal_id_cache.load()
 
-def load_config():
+def load_config(interactive = True):
     config = utils_read_json(config_path)
     try:
         return config['myanimelist_user_token']
     except:
+        if not interactive:
+            raise RuntimeError("No MyAnimeList user token configured, pass mal_token or run the setup first")
         return config_setup()['myanimelist_user_token']
 
 # Functions
 
-def make_mal_request(mal_api_url, params, method='get', mal_token=None, user_request = False):
+def get_request_headers(mal_token=None, user_request = False, interactive = True):
     local_token = False
     if user_request:
         if mal_token:
@@ -111,61 +339,287 @@ def make_mal_request(mal_api_url, params, method='get', mal_token=None, user_req
         elif 'myanimelist_key' in os.environ:
             mal_token = os.getenv('myanimelist_key')
             if not os.path.exists(config_path):
-                os.makedirs(os.path.dirname(config_path))
+                os.makedirs(os.path.dirname(config_path), exist_ok=True)
         else:
-            mal_token = load_config()
+            mal_token = load_config(interactive)
             local_token = True
         HEADERS = {'Authorization': f"Bearer {mal_token}"}
     else:
-        HEADERS = {'X-MAL-CLIENT-ID': f"{client_id}"}
+        HEADERS = {'X-MAL-CLIENT-ID': f"{get_client_id(interactive)}"}
+    return HEADERS, local_token
+
+def make_mal_request(mal_api_url, params, method='get', mal_token=None, user_request = False, full_response = False, keep_body = True, revalidate = True, force_update = False):
+    if method.lower() != 'get':
+        # A write makes anything we remember about that url stale
+        response_memo.invalidate(mal_api_url.rsplit('/my_list_status', 1)[0])
+        with span('make_mal_request', url=mal_api_url, method=method.upper()):
+            return send_mal_request(mal_api_url, params, method, mal_token, user_request, full_response)
+    # Identical GETs in flight share one request, public ones are also remembered for a short while
+    # unless force_update asks for a new answer
+    key = request_key(mal_api_url, params, mal_token or ('user' if user_request else 'client'), full_response, keep_body, revalidate)
+    with span('make_mal_request', url=mal_api_url, method='GET'):
+        return single_flight.run(key, lambda: send_mal_request(mal_api_url, params, method, mal_token, user_request, full_response, keep_body, revalidate), memoize = not user_request, refresh = force_update)
+
+def send_mal_request(mal_api_url, params, method='get', mal_token=None, user_request = False, full_response = False, keep_body = True, revalidate = True):
+    # keep_body=False is for callers that cache the parsed response, a 304 then returns not_modified.
+    # They pass revalidate=False while they don't have it yet.
+    HEADERS, local_token = get_request_headers(mal_token, user_request)
 
     def make_request():
-        request_func = getattr(requests, method.lower(), None)
+        # Wait out a rate limit hit by any other thread before sending
+        cooldown = mal_cooldown_until - time.monotonic()
+        if cooldown > 0:
+            time.sleep(cooldown)
         if method.lower() == 'put':
-           response = request_func(mal_api_url, data=params, headers=HEADERS)
-        else: 
-            response = request_func(mal_api_url, params=params, headers=HEADERS)    
-        return response
+            return http_client.request(method, mal_api_url, data=params, headers=HEADERS), None
+        # Revalidate what we already have, a 304 is served from the http cache
+        cache_key, cached_entry, request_headers = http_cache.lookup(mal_api_url, params, HEADERS, keep_body, revalidate)
+        response = http_client.request(method, mal_api_url, params=params, headers=request_headers)
+        if response.status_code == 304 and cached_entry is not None:
+            body = http_cache.revalidated(cached_entry)
+            if body is not_modified:
+                return body, None
+            cached_entry['body'] = body
+            return CachedResponse(cached_entry), None
+        return response, cache_key
 
-    retries = 0
+    global mal_cooldown_until
+    retry_state = retry_policies['mal'].start('mal')
+    circuit_breaker = circuit_breakers['mal']
+    token_refreshed = False
     while True:
-        response = make_request()
+        if not circuit_breaker.allow():
+            print_deb("MyAnimeList is not responding, failing fast")
+            return {}
+        try:
+            response, cache_key = make_request()
+            if response is not_modified:
+                circuit_breaker.record_success()
+                return response
+        except RequestException as error:
+            circuit_breaker.record_failure()
+            delay = retry_state.next_delay(None)
+            if delay is None:
+                raise
+            print_deb(f"Connection error: {error}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        finally:
+            circuit_breaker.end_trial()
+        if response.status_code >= 500:
+            circuit_breaker.record_failure()
+        else:
+            circuit_breaker.record_success()
         if response.status_code == 200:
             json_response = response.json()
-            if 'data' in json_response:
+            http_cache.save(cache_key, response.headers, json_response, keep_body)
+            if 'data' in json_response and not full_response:
                 return json_response['data']
             return json_response
         elif response.status_code == 429:
             print_deb(f"Rate limit exceeded. Waiting before retrying...")
             print_deb(params, HEADERS, sep="\n")
-            print_deb(response.json())
-            retry_after = int(response.headers.get('retry-after', 1))
-            time.sleep(retry_after)
-            retries += 1
-        elif response.status_code == 500 or response.status_code == 400:
-            print_deb(f"Unknown error occurred, retrying...")
-            print_deb(params, HEADERS, sep="\n")
-            print_deb(response.json())
-            retries += 1
+            delay = retry_state.next_delay(429, response.headers.get('retry-after'))
+            if delay is not None:
+                # Every thread waits this out before its next request
+                with mal_cooldown_lock:
+                    mal_cooldown_until = max(mal_cooldown_until, time.monotonic() + delay)
         elif response.status_code == 404:
             print(f"Anime not found")
             return None
-        elif response.status_code == 401 and local_token:
+        elif response.status_code == 401 and local_token and not token_refreshed:
             print_deb(f"Access token expired, refreshing")
             regenerate_token()
-            retries += 1
+            HEADERS = {'Authorization': f"Bearer {load_config()}"}
+            token_refreshed = True
+            delay = 0
+        elif response.status_code in retry_state.policy.status_rules:
+            print_deb(f"Unknown error occurred, retrying...")
+            print_deb(params, HEADERS, response.text, sep="\n")
+            delay = retry_state.next_delay(response.status_code)
+            if delay:
+                time.sleep(delay)
         else:
             print_deb(f"Error {response.status_code}: {params}")
             return {}
 
-        # Exponential backoff with a maximum of 5 retries
-        if retries >= 5:
+        if delay is None:
             print_deb("Maximum retries reached. Exiting.")
             return {}
                 
-        print(f"Retrying... (Attempt {retries})")
+        print(f"Retrying... (Attempt {retry_state.total_attempts})")
+
+def iter_user_list_pages(status, amount = 0, mal_token=None, username = None, user_request = False, prefetch = False, projection = None):
+    # Follows MAL paging links and yields the list nodes page by page
+    status = status.upper()
+    params = {}
+    params['sort'] = "list_updated_at"
+    params['limit'] = min(amount, 1000) if amount else 1000
+    params['fields'] = projection_query(get_projection(projection), True)
+    if status != "ALL" and status != "REPEATING":
+        if not status in status_options:
+            print("Invalid status option. Allowed options are:", ", ".join(str(option) for option in status_options))
+            return
+        params['status'] = al_to_mal_user_status[status]
+
+    def fetch_page(request_url, params):
+        return make_mal_request(request_url, params, mal_token = mal_token, user_request = user_request, full_response = True)
+
+    request_url = f"{mal_base_url}/users/{username}/animelist"
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    try:
+        response = fetch_page(request_url, params)
+        fetched = 0
+        while response and response.get('data'):
+            page = response['data']
+            if amount:
+                page = page[:amount - fetched]
+            fetched += len(page)
+            next_url = response.get('paging', {}).get('next')
+            if amount and fetched >= amount:
+                next_url = None
+            next_page = None
+            if next_url:
+                # The next link already carries all the query params
+                next_page = executor.submit(fetch_page, next_url, {}) if executor else next_url
+            yield [anime_entry['node'] for anime_entry in page]
+            if not next_page:
+                break
+            response = next_page.result() if executor else fetch_page(next_page, {})
+    finally:
+        if executor:
+            executor.shutdown(wait=False)
+
+def fetch_user_list(username, mal_token, user_request, fields, watermark = None):
+    # List nodes newest first, down to the watermark when there is one. Also returns whether
+    # the list was read that far, a failed page leaves it incomplete.
+    params = {}
+    params['sort'] = "list_updated_at"
+    params['limit'] = 1000 if watermark is None else user_list_snapshots.page_size
+    params['fields'] = projection_query(fields, True)
+    request_url = f"{mal_base_url}/users/{username}/animelist"
+    nodes = []
+    while request_url:
+        response = make_mal_request(request_url, params, mal_token = mal_token, user_request = user_request, full_response = True)
+        if not response:
+            return nodes, False
+        page, reached = newer_nodes([anime_entry['node'] for anime_entry in response.get('data', [])], watermark)
+        nodes += page
+        if reached:
+            return nodes, True
+        # The next link already carries all the query params
+        request_url = response.get('paging', {}).get('next')
+        params = {}
+    return nodes, True
+
+def sync_list_snapshot(username, mal_token, fields, full = False):
+    # -> (list rows newest first, {anime_id: node} of the rows whose entries need rebuilding)
+    watermark = user_list_snapshots.plan(username, full)
+    nodes, complete = fetch_user_list(username, mal_token, True, fields, watermark)
+    return user_list_snapshots.apply(username, nodes, complete, watermark is None)
+
+def sync_user_list(mal_token = None, full = False):
+    # Brings the snapshot of the token owner's list up to date, returns the ids of the rows that changed
+    username = get_userdata(mal_token)[0]
+    _, changed = sync_list_snapshot(username, mal_token, projections['minimal'], full)
+    return list(changed)
+
+def select_list_rows(rows, status, media_format, amount):
+    # The same rows the list endpoint would return for these filters
+    if status != "ALL" and status != "REPEATING":
+        rows = [row for row in rows if (row['my_list_status'] or {}).get('status') == al_to_mal_user_status[status]]
+    if amount:
+        rows = rows[:amount]
+    if status == "REPEATING":
+        rows = [row for row in rows if (row['my_list_status'] or {}).get('is_rewatching')]
+    if media_format:
+        rows = [row for row in rows if row['media_type'] == media_format]
+    return rows
+
+def iter_snapshot_entries(status, media_format = None, amount = 0, mal_token=None, username = None, lazy_related = False, projection = None):
+    # Serves the list from the local snapshot after a delta sync, only the rows that changed get their entries rebuilt
+    if status != "ALL" and status != "REPEATING" and not status in status_options:
+        print("Invalid status option. Allowed options are:", ", ".join(str(option) for option in status_options))
+        return
+    fields = get_projection(projection)
+    # Lazily built entries are cached without their relations, they get them once they are read
+    required_fields = [field for field in fields if field != 'related'] if lazy_related else fields
+    rows, changed = sync_list_snapshot(username, mal_token, fields)
+    rows = select_list_rows(rows, status, media_format, amount)
+    anime_data = {}
+    missing_ids = []
+    for row in rows:
+        anime_id = str(row['id'])
+        if anime_id in changed:
+            continue
+        cached_entry = mal_id_cache.get(anime_id)
+        if cached_entry is None or not has_fields(cached_entry, required_fields):
+            missing_ids.append(anime_id)
+        elif 'related' in fields and 'related' not in cached_entry:
+            anime_data[anime_id] = lazy_cached_entry(anime_id, cached_entry, mal_token)
+        else:
+            anime_data[anime_id] = cached_entry
+    if len(missing_ids) > user_list_snapshots.page_size:
+        # Reading the whole list again is cheaper than fetching that many entries one by one
+        rows, changed = sync_list_snapshot(username, mal_token, fields, True)
+        rows = select_list_rows(rows, status, media_format, amount)
+        missing_ids = []
+    changed_nodes = [changed[str(row['id'])] for row in rows if str(row['id']) in changed]
+    for start in range(0, len(changed_nodes), 1000):
+        with mal_id_cache.batch(), mal_to_al_cache.batch():
+            anime_data.update(generate_anime_entries(changed_nodes[start:start + 1000], mal_token, lazy_related, projection))
+    if missing_ids:
+        anime_data.update(get_anime_info_many(missing_ids, mal_token = mal_token, projection = fields))
+    anime_data = as_entries(anime_data)
+    for row in rows:
+        anime_id = str(row['id'])
+        if anime_id not in anime_data:
+            continue
+        anime_info = anime_data[anime_id].copy()
+        try:
+            add_user_list_status(anime_info, row['my_list_status'])
+        except:
+            pass
+        yield anime_id, anime_info
+
+def iter_user_entries(status, media_format = None, amount = 0, mal_token=None, username = None, user_request = False, lazy_related = False, prefetch = False, projection = None):
+    status = status.upper()
+    if user_request and user_list_snapshots.serves(username, amount, prefetch):
+        # Only the token owner's list carries list_updated_at for the delta sync
+        yield from iter_snapshot_entries(status, media_format, amount, mal_token, username, lazy_related, projection)
+        return
+    for page in iter_user_list_pages(status, amount, mal_token, username, user_request, prefetch, projection):
+        anime_nodes = []
+        for anime_entry_data in page:
+            if status == "REPEATING" and not anime_entry_data['my_list_status']['is_rewatching']:
+                continue
+            if media_format and media_format != anime_entry_data['media_type']:
+                continue
+            anime_nodes.append(anime_entry_data)
+        with mal_id_cache.batch(), mal_to_al_cache.batch():
+            anime_entries = generate_anime_entries(anime_nodes, mal_token, lazy_related, projection)
+        for anime_entry_data in anime_nodes:
+            anime_id = str(anime_entry_data['id'])
+            anime_info = anime_entries[anime_id].copy()
+            try:
+                add_user_list_status(anime_info, anime_entry_data['my_list_status'])
+            except:
+                pass
+            yield anime_id, anime_info
 
-def get_all_anime_for_user(status_list="ALL", media_format = None, amount = 0, mal_token=None, username = None):
+def iter_all_anime_for_user(status_list="ALL", media_format = None, amount = 0, mal_token=None, username = None, lazy_related = False, prefetch = False, projection = None):
+    # Yields (anime_id, entry) pairs as the pages arrive, so memory stays flat for huge lists
+    if not username:
+        username = get_userdata(mal_token)[0]
+        user_request = True
+    else:
+        user_request = False
+    if isinstance(status_list, str):
+        status_list = [status_list]
+    for status in status_list:
+        yield from iter_user_entries(status, media_format, amount, mal_token, username, user_request, lazy_related, prefetch, projection)
+
+def get_all_anime_for_user(status_list="ALL", media_format = None, amount = 0, mal_token=None, username = None, lazy_related = False, prefetch = False, projection = None):
     if not username:
         username = get_userdata(mal_token)[0]
         user_request = True
@@ -173,102 +627,38 @@ def get_all_anime_for_user(status_list="ALL", media_format = None, amount = 0, m
         user_request = False
         
     def main_function(status):
-        status = status.upper()
-        params = {}
-        params['sort'] = "list_updated_at"
-        params['limit'] = 1000 if not amount else amount
-        params['fields'] = (
-            "id,"
-            "title,"
-            "alternative_titles,"
-            "start_date,"
-            "end_date,"
-            "nsfw,"
-            "media_type,"
-            "status,"
-            "genres,"
-            "my_list_status{status,num_times_rewatched,is_rewatching,num_episodes_watched},"
-            "num_episodes,"
-            "related_anime"
-        )
-        if status != "ALL" and status != "REPEATING":
-            if not status in status_options:
-                print("Invalid status option. Allowed options are:", ", ".join(str(option) for option in status_options))
-                return
-            params['status'] = al_to_mal_user_status[status]
-
-        request_url = f"https://api.myanimelist.net/v2/users/{username}/animelist"
-        data = make_mal_request(request_url, params, mal_token = mal_token, user_request = user_request)
-
-        user_ids = {}
-            
-        if data:
-            for anime_entry in data:
-                anime_entry_data = anime_entry['node']
-                if status == "REPEATING" and not anime_entry_data['my_list_status']['is_rewatching']:
-                    continue
-                if media_format and media_format != anime_entry_data['media_type']:
-                    continue
-                anime_id = anime_entry_data['id']
-                anime_id = str(anime_id)
-                anime_info = generate_anime_entry(anime_entry_data, mal_token)
-                if not anime_id in user_ids:
-                    user_ids[anime_id] = {}    # Initialize as a dictionary if not already initialized
-                user_ids[anime_id].update(anime_info)
-                try:
-                    user_ids[anime_id]['watched_ep'] = anime_entry_data['my_list_status']['num_episodes_watched']
-                    user_ids[anime_id]['watching_status'] = 'REPEATING' if anime_entry_data['my_list_status']['is_rewatching'] else mal_to_al_user_status[anime_entry_data['my_list_status']['status']]
-                    user_ids[anime_id]['rewatch_count'] = anime_entry_data['my_list_status']['num_times_rewatched'] if 'num_times_rewatched' in anime_entry_data['my_list_status'] else 0
-                except:
-                    pass
+        user_ids = dict(iter_user_entries(status, media_format, amount, mal_token, username, user_request, lazy_related, prefetch, projection))
+        if user_ids:
             return user_ids
         print(f"No entries found for {username}'s {status.lower()} anime list.")
         return None    
 
     if isinstance(status_list, str):
-        status_list = status_list.upper()
-        main_function(status_list)
         return main_function(status_list)
     elif len(status_list) == 1:
-        status = status_list[0].upper()
-        main_function(status)
-        return main_function(status_list)
+        return main_function(status_list[0])
     elif isinstance(status_list, list):
         ani_list = {}
         for status in status_list:
-            status.upper()
-            ani_list.update(main_function(status))
+            ani_list.update(main_function(status) or {})
         return ani_list
 
-def get_latest_anime_entry_for_user(status = "ALL", media_format = None, mal_token=None,  username = None):
+def get_latest_anime_entry_for_user(status = "ALL", media_format = None, mal_token=None,  username = None, projection = None):
     if not username:
         username = get_userdata(mal_token)[0]
 
     status = status.upper()
-    data = get_all_anime_for_user(status, media_format, 1, mal_token, username)
+    data = get_all_anime_for_user(status, media_format, 1, mal_token, username, projection = projection)
     if data:
         return data
     print(f"No entries found for {username}'s {status.lower()} anime list.")
     return None
 
-def get_anime_entry_for_user(mal_id, mal_token=None):
+def get_anime_entry_for_user(mal_id, mal_token=None, lazy_related = False, projection = None):
     mal_id = str(mal_id)
 
     params = {}
-    params['fields'] = (
-        "id,"
-        "title,"
-        "alternative_titles,"
-        "start_date,"
-        "end_date,"
-        "nsfw,"
-        "media_type,"
-        "status,"
-        "genres,"
-        "my_list_status{status,num_times_rewatched,is_rewatching,num_episodes_watched},"
-        "num_episodes,"
-        "related_anime"
-    )
+    params['fields'] = projection_query(get_projection(projection), True)
     request_url = f"{anime_request_url}/{mal_id}"
     data = make_mal_request(request_url, params, mal_token = mal_token, user_request=True)
     anime_data = {}
@@ -276,140 +666,297 @@ def get_anime_entry_for_user(mal_id, mal_token=None):
         anime_id = str(data['id'])
         if 'my_list_status' not in data:
             return None
-        anime_data[anime_id] = generate_anime_entry(data, mal_token)
-        anime_data[anime_id]['watched_ep'] = data['my_list_status']['num_episodes_watched']
-        anime_data[anime_id]['watching_status'] = mal_to_al_user_status[data['my_list_status']['status']]
-        anime_data[anime_id]['watching_status'] = 'REPEATING' if data['my_list_status']['is_rewatching'] else mal_to_al_user_status[data['my_list_status']['status']]
-        anime_data[anime_id]['rewatch_count'] = data['my_list_status']['num_times_rewatched'] if 'num_times_rewatched' in data['my_list_status'] else 0
+        anime_data[anime_id] = generate_anime_entry(data, mal_token, lazy_related, projection).copy()
+        add_user_list_status(anime_data[anime_id], data['my_list_status'])
         return anime_data
     return None
 
-def get_anime_info(anime_id, force_update = False, mal_token=None):
-    if force_update:
-        anime_cache = {}
-    else:
-        anime_cache = load_cache()
+def get_anime_info(anime_id, force_update = False, mal_token=None, projection = None):
     anime_id = str(anime_id)
     if not anime_id:
         return None
+    fields = get_projection(projection)
+    if force_update:
+        cached_entry = None
+    else:
+        check_status_in_cache()
+        cached_entry = mal_id_cache.get(anime_id)
+        if cached_entry is not None and not has_fields(cached_entry, fields):
+            print_deb("Upgrading partial cached entry for anime_id:", anime_id)
+            cached_entry = None
     def fetch_from_mal():
-        # Fetch anime info from myanimelist API or any other source
-        anime_info = mal_fetch_anime_info(anime_id, mal_token)
-        # Cache the fetched anime info
-        utils_save_json(mal_id_cache_path, anime_info, False)
-        return anime_info
+        # Fetch anime info from myanimelist API, generate_anime_entries() caches it
+        return as_entries(mal_fetch_anime_info(anime_id, mal_token, fields, force_update))
     # Check if anime_id exists in cache
-    try:
-        if anime_id in anime_cache and not force_update:
-                print_deb("Returning cached result for anime_id:", anime_id)
-                return {anime_id: anime_cache[anime_id]}
-        else:
-            return fetch_from_mal()
-    except TypeError:
-        return fetch_from_mal()
+    if cached_entry is not None:
+        print_deb("Returning cached result for anime_id:", anime_id)
+        return as_entries({anime_id: cached_entry})
+    return fetch_from_mal()
 
-def mal_fetch_anime_info(mal_id, mal_token=None):
+def get_anime_info_many(anime_ids, force_update = False, mal_token=None, workers = None, projection = None):
+    anime_ids = [str(anime_id) for anime_id in dict.fromkeys(anime_ids) if anime_id]
+    fields = get_projection(projection)
+    anime_data = {}
+    missing_ids = []
+    stale_entries = {} # refetched, but kept as they are when MAL answers 304
+    if not force_update:
+        check_status_in_cache()
+    for anime_id in anime_ids:
+        cached_entry = mal_id_cache.get(anime_id)
+        if cached_entry is not None and has_fields(cached_entry, fields):
+            if not force_update:
+                anime_data[anime_id] = cached_entry
+                continue
+            stale_entries[anime_id] = cached_entry
+        missing_ids.append(anime_id)
+    if missing_ids:
+        print_deb(f"Fetching {len(missing_ids)} anime from MAL, {len(anime_data)} served from cache")
+        workers = min(workers or max_workers, len(missing_ids))
+        def fetch_node(anime_id):
+            return make_mal_request(f'{anime_request_url}/{anime_id}', {'fields': projection_query(fields)}, mal_token = mal_token, keep_body = False, revalidate = anime_id in stale_entries, force_update = force_update)
+        anime_nodes = []
+        with ThreadPoolExecutor(max_workers=workers) as executor, http_cache.batch():
+            for anime_id, node in zip(missing_ids, executor.map(fetch_node, missing_ids)):
+                if node is not_modified:
+                    anime_data[anime_id] = stale_entries[anime_id]
+                elif node:
+                    anime_nodes.append(node)
+        # Relations and AniList ids get resolved for the whole batch, written to the cache in a single flush
+        with mal_id_cache.batch(), mal_to_al_cache.batch():
+            anime_data.update(generate_anime_entries(anime_nodes, mal_token, projection = fields))
+    return as_entries({anime_id: anime_data[anime_id] for anime_id in anime_ids if anime_id in anime_data})
+
+def mal_fetch_anime_info(mal_id, mal_token=None, projection = None, force_update = False):
     params = {
-        'fields': (
-            "id,"
-            "title,"
-            "alternative_titles,"
-            "start_date,"
-            "end_date,"
-            "nsfw,"
-            "media_type,"
-            "status,"
-            "genres,"
-            "my_list_status,"
-            "num_episodes,"
-            "related_anime"
-        )
+        'fields': projection_query(get_projection(projection))
     }
     
     request_url = f'{anime_request_url}/{mal_id}'
-    data = make_mal_request(request_url, params, mal_token = mal_token)
+    data = make_mal_request(request_url, params, mal_token = mal_token, force_update = force_update)
     anime_data = {}
     if data:
-        anime_id = str(data['id'])
-        anime_data[anime_id] = {}
-        anime_data[anime_id].update(generate_anime_entry(data, mal_token))
+        anime_data[str(data['id'])] = generate_anime_entry(data, mal_token, projection = projection)
     return anime_data
 
-def generate_anime_entry(anime_info, mal_token):
-    def getRelated():
-        def get_additional_info(relation_id):
-            params = {
-                'fields': "status, related_anime"
-            }
-            data = make_mal_request(anime_request_url + f"/{relation_id}", params, mal_token = mal_token)
-            return data            
-        
-        relations = {}
-        try:
-            edges = anime_info['related_anime']
-        except:
-            edges = get_additional_info(anime_info['id'])['related_anime']
-        for edge in edges:
-            relation_type = edge['relation_type'].upper()
-            if relation_type == "PREQUEL" or relation_type == "SEQUEL":
-                relation_id = str(edge['node']['id'])
-                relations[relation_id] = {}
-                relations[relation_id]['main_title'] = edge['node']['title']
-                relations[relation_id]['status'] = mal_to_al_status[get_additional_info(relation_id)['status']]
-                relations[relation_id]['type'] = relation_type
-        if not relations:
-            relations = None
-        return relations
-
-    def is_sus(anime_data):
-        genres = [item['name'] for item in anime_data['genres']]
-        adult_status = False if anime_data['nsfw']== 'white' else True
-        sus_genres = ['Hentai', 'Ecchi', 'Erotica']
-        for sus_genre in sus_genres:
-            if sus_genre in genres:
-                return True
-        return adult_status
-
-    def generate_upcoming_ep(release_date):
-            current_date = datetime.now().date()
-            release_date = datetime.strptime(release_date, '%Y-%m-%d').date()
-            upcoming_ep = math.ceil(int((current_date - release_date).days)/7) + 1
-            return upcoming_ep
-
-    def ensure_day_in_date(date_str):
+class LazyAnimeEntry(dict):
+    # Anime entry that resolves its 'related' relations only once they are read
+    def __init__(self, data, resolver):
+        super().__init__(data)
+        self.resolver = resolver
+
+    def resolve(self):
+        if not dict.__contains__(self, 'related'):
+            self['related'] = self.resolver()
+        return dict.__getitem__(self, 'related')
+
+    def __missing__(self, key):
+        if key == 'related':
+            return self.resolve()
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key == 'related' or dict.__contains__(self, key)
+
+    def get(self, key, default = None):
+        if key == 'related':
+            return self.resolve()
+        return dict.get(self, key, default)
+
+    def copy(self):
+        return LazyAnimeEntry(dict(self), self.resolver)
+
+def lazy_cached_entry(anime_id, cached_entry, mal_token = None):
+    # A cached entry that was built without its relations, they get fetched once they are read
+    def resolve():
+        anime_data = get_anime_info(anime_id, mal_token = mal_token) or {}
+        return anime_data[anime_id]['related'] if anime_id in anime_data else {}
+    return LazyAnimeEntry(cached_entry, resolve)
+
+def get_relation_edges(related_anime):
+    return [
+        (str(edge['node']['id']), edge['node']['title'], edge['relation_type'].upper())
+        for edge in related_anime
+        if edge['relation_type'].upper() in ("PREQUEL", "SEQUEL")
+    ]
+
+def build_related(edges, statuses):
+    relations = {}
+    for relation_id, title, relation_type in edges:
+        relations[relation_id] = {}
+        relations[relation_id]['main_title'] = title
+        relations[relation_id]['status'] = statuses[relation_id]
+        relations[relation_id]['type'] = relation_type
+    return relations or None
+
+def fetch_many(fetch_function, items):
+    # Run fetch_function for every item on the shared worker pool, returns {item: result}
+    items = list(dict.fromkeys(items))
+    if not items:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return dict(zip(items, executor.map(fetch_function, items)))
+
+def fetch_relation_statuses(relation_ids, mal_token=None):
+    def fetch_status(relation_id):
+        data = make_mal_request(anime_request_url + f"/{relation_id}", {'fields': "status"}, mal_token = mal_token)
+        return mal_to_al_status[data['status']] if data else None
+    return fetch_many(fetch_status, relation_ids)
+
+def generate_anime_entries(anime_infos, mal_token=None, lazy_related = False, projection = None):
+    # Build entries for a whole batch of MAL nodes. Relation statuses come from the batch itself
+    # and the id cache first, whatever is still unknown gets fetched once for the whole batch.
+    fields = get_projection(projection)
+    anime_infos = list(anime_infos)
+    known_statuses = {str(anime_info['id']): mal_to_al_status[anime_info['status']] for anime_info in anime_infos if 'status' in anime_info}
+    # Projections without relations skip the relation lookups altogether
+    related_infos = anime_infos if 'related' in fields else []
+    relation_edges = {}
+    cached_related = {}
+    for anime_info in related_infos:
+        anime_id = str(anime_info['id'])
+        if 'related_anime' in anime_info:
+            relation_edges[anime_id] = get_relation_edges(anime_info['related_anime'])
+            continue
+        cached_entry = mal_id_cache.get(anime_id)
+        if cached_entry is not None and 'related' in cached_entry:
+            cached_related[anime_id] = cached_entry['related']
+    missing_edges = [str(anime_info['id']) for anime_info in related_infos if str(anime_info['id']) not in relation_edges and str(anime_info['id']) not in cached_related]
+    def fetch_edges(anime_id):
+        data = make_mal_request(anime_request_url + f"/{anime_id}", {'fields': "related_anime"}, mal_token = mal_token)
+        return get_relation_edges(data['related_anime']) if data else []
+    relation_edges.update(fetch_many(fetch_edges, missing_edges))
+
+    def get_known_status(relation_id):
+        if relation_id not in known_statuses:
+            cached_entry = mal_id_cache.get(relation_id)
+            if cached_entry is None or cached_entry.get('status') is None:
+                return None
+            known_statuses[relation_id] = cached_entry['status']
+        return known_statuses[relation_id]
+
+    unknown_ids = {}
+    for anime_id, edges in relation_edges.items():
+        unknown_ids[anime_id] = [relation_id for relation_id, _, _ in edges if get_known_status(relation_id) is None]
+
+    if not lazy_related:
+        known_statuses.update(fetch_relation_statuses([relation_id for ids in unknown_ids.values() for relation_id in ids], mal_token))
+
+    def lazy_resolver(anime_id, entry_data):
+        resolved = []
+        def resolve():
+            if not resolved:
+                statuses = dict(known_statuses)
+                statuses.update(fetch_relation_statuses(unknown_ids[anime_id], mal_token))
+                related = build_related(relation_edges[anime_id], statuses)
+                mal_id_cache.set(anime_id, dict(entry_data, related=related))
+                index_cached_entries({anime_id: dict(entry_data, related=related)})
+                resolved.append(related)
+            return resolved[0]
+        return resolve
+
+    al_ids = mal_to_al_ids(str(anime_info['id']) for anime_info in anime_infos) if 'al_id' in fields else {}
+    anime_data = {}
+    cache_data = {}
+    for anime_info in anime_infos:
+        anime_id = str(anime_info['id'])
+        if 'related' not in fields:
+            related = None
+        elif anime_id in cached_related:
+            related = cached_related[anime_id]
+        elif lazy_related and unknown_ids[anime_id]:
+            entry_data = build_anime_entry(anime_info, al_ids.get(anime_id), None, fields)
+            del entry_data['related']
+            anime_data[anime_id] = LazyAnimeEntry(entry_data, lazy_resolver(anime_id, entry_data))
+            # Cached without the relations until they are read, get_anime_info() upgrades it like any partial entry
+            cached_entry = mal_id_cache.get(anime_id)
+            cache_data[anime_id] = dict(cached_entry, **entry_data) if cached_entry is not None else entry_data
+            continue
+        else:
+            related = build_related(relation_edges[anime_id], known_statuses)
+        anime_data[anime_id] = build_anime_entry(anime_info, al_ids.get(anime_id), related, fields)
+        if fields != projections['full']:
+            # A partial entry never drops the fields the cache already holds
+            cached_entry = mal_id_cache.get(anime_id)
+            if cached_entry is not None:
+                anime_data[anime_id] = dict(cached_entry, **anime_data[anime_id])
+        cache_data[anime_id] = anime_data[anime_id]
+    mal_id_cache.update(cache_data)
+    index_cached_entries(cache_data)
+    return as_entries(anime_data)
+
+def generate_anime_entry(anime_info, mal_token, lazy_related = False, projection = None):
+    return generate_anime_entries([anime_info], mal_token, lazy_related, projection)[str(anime_info['id'])]
+
+def is_sus(anime_data):
+    genres = [item['name'] for item in anime_data['genres']]
+    adult_status = False if anime_data['nsfw']== 'white' else True
+    sus_genres = ['Hentai', 'Ecchi', 'Erotica']
+    for sus_genre in sus_genres:
+        if sus_genre in genres:
+            return True
+    return adult_status
+
+def generate_upcoming_ep(release_date):
+    current_date = datetime.now().date()
+    release_date = datetime.strptime(release_date, '%Y-%m-%d').date()
+    upcoming_ep = math.ceil(int((current_date - release_date).days)/7) + 1
+    return upcoming_ep
+
+def ensure_day_in_date(date_str):
+    try:
+        datetime.strptime(date_str, '%Y-%m-%d')
+        return date_str
+    except ValueError:
         try:
-            datetime.strptime(date_str, '%Y-%m-%d')
-            return date_str
+            year_month = datetime.strptime(date_str, '%Y-%m')
+            full_date = year_month.replace(day=1)
+            return full_date.strftime('%Y-%m-%d')
         except ValueError:
-            try:
-                year_month = datetime.strptime(date_str, '%Y-%m')
-                full_date = year_month.replace(day=1)
-                return full_date.strftime('%Y-%m-%d')
-            except ValueError:
-                return None
+            return None
 
-    anime_id = str(anime_info['id'])
+def build_anime_entry(anime_info, al_id, related, fields = None):
+    # Turn a MAL api node into a cache entry, without doing any requests. Only the entry fields in
+    # fields get built, the node has to hold their MAL fields.
+    fields = projections['full'] if fields is None else fields
     anime_data = {}
-    anime_data['al_id'] = mal_to_al_id(anime_id)
-    anime_data['total_eps'] = anime_info['num_episodes']
-    anime_data['is_sus'] = is_sus(anime_info)
-    anime_data['main_title'] = anime_info['title']
-    anime_data['synonyms'] = [
-            anime_info['alternative_titles']['ja'],
-            anime_info['alternative_titles']['en'],
-    ] + anime_info['alternative_titles']['synonyms']
-    anime_data['synonyms'] = [item for item in anime_data['synonyms'] if item is not None]    
-    anime_data['status'] = mal_to_al_status[anime_info['status']]
-    anime_data['release_date'] = ensure_day_in_date(anime_info['start_date']) if 'start_date' in anime_info else None
-    anime_data['end_date'] = ensure_day_in_date(anime_info['end_date']) if 'end_date' in anime_info else None
-    anime_data['upcoming_ep'] = generate_upcoming_ep(anime_data['release_date']) if anime_data['status'] == "RELEASING" else None
-    anime_data['format'] = anime_info['media_type'].upper()
-    anime_data['related'] = getRelated()
-    utils_save_json(mal_id_cache_path, {anime_id: anime_data}, False)
+    if 'al_id' in fields:
+        anime_data['al_id'] = al_id
+    if 'total_eps' in fields:
+        anime_data['total_eps'] = anime_info['num_episodes']
+    if 'is_sus' in fields:
+        anime_data['is_sus'] = is_sus(anime_info)
+    if 'main_title' in fields:
+        anime_data['main_title'] = anime_info['title']
+    if 'synonyms' in fields:
+        anime_data['synonyms'] = [
+                anime_info['alternative_titles']['ja'],
+                anime_info['alternative_titles']['en'],
+        ] + anime_info['alternative_titles']['synonyms']
+        anime_data['synonyms'] = [item for item in anime_data['synonyms'] if item is not None]    
+    status = mal_to_al_status[anime_info['status']] if 'status' in anime_info else None
+    release_date = ensure_day_in_date(anime_info['start_date']) if 'start_date' in anime_info else None
+    if 'status' in fields:
+        anime_data['status'] = status
+    if 'release_date' in fields:
+        anime_data['release_date'] = release_date
+    if 'end_date' in fields:
+        anime_data['end_date'] = ensure_day_in_date(anime_info['end_date']) if 'end_date' in anime_info else None
+    if 'upcoming_ep' in fields:
+        anime_data['upcoming_ep'] = generate_upcoming_ep(release_date) if status == "RELEASING" else None
+    if 'format' in fields:
+        anime_data['format'] = anime_info['media_type'].upper()
+    if 'related' in fields:
+        anime_data['related'] = related
+    return anime_data
+
+def add_user_list_status(anime_data, list_status):
+    anime_data['watched_ep'] = list_status['num_episodes_watched']
+    anime_data['watching_status'] = 'REPEATING' if list_status['is_rewatching'] else mal_to_al_user_status[list_status['status']]
+    anime_data['rewatch_count'] = list_status['num_times_rewatched'] if 'num_times_rewatched' in list_status else 0
     return anime_data
 
-def get_id(name, media_format = None, amount = 1, mal_token=None):
-    search_cache = utils_read_json(mal_search_cache_path)
+def get_id(name, media_format = None, amount = 1, mal_token=None, fuzzy = True):
+    search_cache = mal_search_cache.load()
     id_dict = {}
     amount = int(amount)
     format_name = name
@@ -430,9 +977,8 @@ def get_id(name, media_format = None, amount = 1, mal_token=None):
                 search_cache[format_name].extend(new_anime_ids) 
             else:
                 search_cache[format_name] = anime_ids
-            utils_save_json(mal_search_cache_path, search_cache)
-            for anime_id in search_cache[format_name][:amount]:
-                id_dict.update(get_anime_info(anime_id, True, mal_token))
+            mal_search_cache.set(format_name, search_cache[format_name])
+            id_dict.update(get_anime_info_many(search_cache[format_name][:amount], True, mal_token))
             return id_dict
         return None
     # Check if anime_id exists in cache
@@ -440,11 +986,14 @@ def get_id(name, media_format = None, amount = 1, mal_token=None):
         if search_cache and format_name in search_cache and len(search_cache[format_name]) >= amount:
             print_deb("Returning cached result for search query:", name)
             found_ids = search_cache[format_name]
-            for found_id in found_ids:
-                id_dict.update(get_anime_info(found_id, False, mal_token))
+            id_dict.update(get_anime_info_many(found_ids, False, mal_token))
             return id_dict
-        else:
-            return fetch_from_mal()
+        matches = title_index.search(name, media_format, amount) if fuzzy and amount else []
+        if len(matches) >= amount:
+            print_deb("Returning title index result for search query:", name)
+            id_dict.update(get_anime_info_many([anime_id for anime_id, _, _ in matches], False, mal_token))
+            return id_dict
+        return fetch_from_mal()
     except:
         return fetch_from_mal()
             
@@ -471,7 +1020,7 @@ def mal_fetch_id(name, media_format, amount, mal_token=None):
 
 def get_userdata(mal_token):
     params = {}
-    request_url = "https://api.myanimelist.net/v2/users/@me"
+    request_url = f"{mal_base_url}/users/@me"
     data = make_mal_request(request_url, params, mal_token = mal_token, user_request = True)
 
     if data:
@@ -480,6 +1029,37 @@ def get_userdata(mal_token):
         profile_pic = data['picture']
         return [username, profile_pic]
 
+def make_anilist_request(url, body, headers):
+    retry_state = retry_policies['anilist'].start('anilist')
+    circuit_breaker = circuit_breakers['anilist']
+    while True:
+        if not circuit_breaker.allow():
+            print_deb("AniList is not responding, failing fast")
+            return None
+        try:
+            response = http_client.post(url, json=body, headers=headers)
+        except RequestException:
+            circuit_breaker.record_failure()
+            delay = retry_state.next_delay(None)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            continue
+        finally:
+            circuit_breaker.end_trial()
+        if response.status_code >= 500:
+            circuit_breaker.record_failure()
+        else:
+            circuit_breaker.record_success()
+        if response.status_code == 200 or response.status_code not in retry_state.policy.status_rules:
+            return response
+        delay = retry_state.next_delay(response.status_code, response.headers.get('Retry-After'))
+        if delay is None:
+            print_deb(f"AniList request failed with {response.status_code}, giving up")
+            return None
+        time.sleep(delay)
+
+@traced('mal_to_al_id')
 def mal_to_al_id(mal_id):
     query = """
     query ($malId: Int) {
@@ -488,35 +1068,107 @@ def mal_to_al_id(mal_id):
         }
     }
     """
-    cached_al_ids = utils_read_json(mal_to_al_cache_path)
-    if cached_al_ids and mal_id in cached_al_ids:
-        return int(cached_al_ids[mal_id])
+    mal_id = str(mal_id)
+    cached_al_id = mal_to_al_cache.get(mal_id)
+    if cached_al_id is not None:
+        return int(cached_al_id)
     # Constants for GraphQL endpoint and headers
-    ANILIST_API_URL = "https://graphql.anilist.co"
+    ANILIST_API_URL = anilist_api_url
     HEADERS = {'Content-Type': "application/json"}
     variables = {'malId': mal_id}
-    response = requests.post(ANILIST_API_URL, json={'query': query, 'variables': variables}, headers=HEADERS)
-    while response.status_code == 429: # retry if we hit rate limit
-        time.sleep(int(response.headers['Retry-After']))
-        response = requests.post(ANILIST_API_URL, json={'query': query, 'variables': variables}, headers=HEADERS)
+    response = make_anilist_request(ANILIST_API_URL, {'query': query, 'variables': variables}, HEADERS)
+    if response is None:
+        return None
     response_dict = response.json()
 
     if response_dict:
         if response.status_code == 200:
-            utils_save_json(mal_to_al_cache_path, {mal_id: response_dict['data']['Media']['id']}, False)
+            mal_to_al_cache.set(mal_id, response_dict['data']['Media']['id'])
             return int(response_dict['data']['Media']['id'])
     return None
 
+@traced('mal_to_al_ids')
+def mal_to_al_ids(mal_ids, chunk_size = 50):
+    # Resolve many ids at once, AniList pages hold at most 50 media per request
+    query = """
+    query ($ids: [Int], $perPage: Int) {
+        Page(perPage: $perPage) {
+            media(idMal_in: $ids, type: ANIME) {
+                id
+                idMal
+            }
+        }
+    }
+    """
+    mal_ids = list(dict.fromkeys(str(mal_id) for mal_id in mal_ids))
+    al_ids = {}
+    missing_ids = []
+    for mal_id in mal_ids:
+        cached_al_id = mal_to_al_cache.get(mal_id)
+        if cached_al_id is not None:
+            al_ids[mal_id] = int(cached_al_id)
+        else:
+            missing_ids.append(mal_id)
+    ANILIST_API_URL = anilist_api_url
+    HEADERS = {'Content-Type': "application/json"}
+    fetched_ids = {}
+    for index in range(0, len(missing_ids), chunk_size):
+        chunk = missing_ids[index:index + chunk_size]
+        variables = {'ids': [int(mal_id) for mal_id in chunk], 'perPage': len(chunk)}
+        response = make_anilist_request(ANILIST_API_URL, {'query': query, 'variables': variables}, HEADERS)
+        if response is None or response.status_code != 200:
+            continue
+        for media in response.json()['data']['Page']['media']:
+            fetched_ids[str(media['idMal'])] = media['id']
+    mal_to_al_cache.update(fetched_ids)
+    al_ids.update(fetched_ids)
+    return {mal_id: al_ids.get(mal_id) for mal_id in mal_ids}
+
+def get_franchise_node(anime_id):
+    # None when MAL doesn't have the anime (deleted or private)
+    node = franchise_index.get_node(anime_id)
+    if node is None:
+        node = (get_anime_info(anime_id) or {}).get(anime_id)
+        if node is not None:
+            franchise_index.update({anime_id: node})
+    return node
+
+def get_franchise(anime_id):
+    # {'id', 'members', 'seasons'} of the franchise the anime belongs to, seasons are in release order
+    anime_id = str(anime_id)
+    get_franchise_node(anime_id)
+    return franchise_index.get_franchise(anime_id)
+
 def get_season_ranges(anime_id):
     anime_id = str(anime_id)
+    season_ranges = franchise_index.get_ranges(anime_id)
+    if season_ranges is None:
+        missing = set() # asked for once, not again for every relation pointing at them
+        def get_info(anime_id):
+            if anime_id in missing:
+                return None
+            node = get_franchise_node(anime_id)
+            if node is None:
+                missing.add(anime_id)
+            return node
+        season_ranges = compute_season_ranges(anime_id, get_info)
+        franchise_index.set_ranges(anime_id, season_ranges)
+    return season_ranges
+
+def compute_season_ranges(anime_id, get_info):
+    # get_info(anime_id) has to return the cache entry of the given anime, or None when MAL
+    # doesn't have it, the chain is then cut at that anime
+    anime_id = str(anime_id)
+    if get_info(anime_id) is None:
+        return {}
     def go_to_first_season(anime_id):
-        anime_info = get_anime_info(anime_id)[anime_id]
+        anime_info = get_info(anime_id)
         related_anime = None
         if not anime_info['related']:
             return anime_id
         for relation in anime_info['related']:
             if anime_info['related'][relation]['type'] == 'PREQUEL':
-                related_anime = get_anime_info(relation)[relation]
+                related_anime = get_info(relation)
                 has_prequel = True
                 break
         if not related_anime:
@@ -527,16 +1179,19 @@ def get_season_ranges(anime_id):
                 has_prequel = False
                 for relation in related_anime:
                     if related_anime[relation]['type'] == 'PREQUEL':
+                        prequel_info = get_info(relation)
+                        if prequel_info is None:
+                            break
                         anime_id = relation
                         has_prequel = True
-                        anime_info = get_anime_info(relation)[relation]
+                        anime_info = prequel_info
                         break
             else:
                 return anime_id
 
     def skip_movies(anime_id):
         while True:
-            anime_info = get_anime_info(anime_id)[anime_id]
+            anime_info = get_info(anime_id)
             if anime_info['format'] != 'MOVIE':
                 break
             related_anime = anime_info['related']
@@ -544,7 +1199,7 @@ def get_season_ranges(anime_id):
                 break
             next_anime_id = None
             for relation in related_anime:
-                if related_anime[relation]['type'] == 'SEQUEL':
+                if related_anime[relation]['type'] == 'SEQUEL' and get_info(relation) is not None:
                     next_anime_id = relation
                     break
             if not next_anime_id:
@@ -556,14 +1211,14 @@ def get_season_ranges(anime_id):
     range_start = 1
     anime_id = go_to_first_season(anime_id)
     anime_id = skip_movies(anime_id)
-    anime_info = get_anime_info(anime_id)[anime_id]
+    anime_info = get_info(anime_id)
     backup_season_counter = 0
     try:
         range_end = int(anime_info['total_eps'])
     except:
         range_end = 9999
     while anime_id:
-        anime_info = get_anime_info(anime_id)[anime_id]
+        anime_info = get_info(anime_id)
         season_regex = re.search(r"(\d+)\w\w season", anime_info['main_title'].lower()) 
         if season_regex:
             season = int(season_regex.group(1))
@@ -580,7 +1235,9 @@ def get_season_ranges(anime_id):
         if related_anime:
             anime_id = None
             for relation in related_anime:
-                relation_info = get_anime_info(relation)[relation]
+                relation_info = get_info(relation)
+                if relation_info is None:
+                    continue
                 if related_anime[relation]['type'] == 'SEQUEL' and related_anime[relation]['status'] != 'NOT_YET_RELEASED':
                     range_start = range_end + 1
                     try:
@@ -604,32 +1261,132 @@ def update_entry(anime_id, progress, mal_token=None):
     except:
         anime_info = get_anime_info(anime_id)[anime_id]
         current_status = 'PLANNING'
-    total_eps = anime_info['total_eps']
-    if progress > total_eps:
-        season_ranges = get_season_ranges(anime_id)
-        skipped_eps = 0
-        for season in season_ranges:
-            if progress <= season_ranges[season]['end']:
-                anime_id = str(season_ranges[season]['id'])
-                progress = progress - skipped_eps
-                try:
-                    anime_info = get_anime_entry_for_user(anime_id)[anime_id]
-                    current_status = anime_info['watching_status']
-                except:
-                    anime_info = get_anime_info(anime_id)[anime_id]
-                    current_status = 'PLANNING'
-                total_eps = anime_info['total_eps']
-                break
-            skipped_eps += season_ranges[season]['total_eps']
-    try:
-        user_eps = anime_info['watched_ep']
-    except:
-        user_eps = -1 #allow for 0 as a value
+    if progress > anime_info['total_eps']:
+        target_id, progress = find_season(get_season_ranges(anime_id), anime_id, progress)
+        if target_id != anime_id:
+            anime_id = target_id
+            try:
+                anime_info = get_anime_entry_for_user(anime_id, mal_token=mal_token)[anime_id]
+                current_status = anime_info['watching_status']
+            except:
+                anime_info = get_anime_info(anime_id)[anime_id]
+                current_status = 'PLANNING'
+    params = entry_update_params(anime_info, current_status, progress)
+    if params is None:
+        return
+    request_url = f"{anime_request_url}/{anime_id}/my_list_status"
+    make_mal_request(request_url, params, 'put', mal_token, True)
+    print_deb('Updating progress successful')
+
+def update_entries(progress_map, mal_token=None):
+    # Sync many progress values at once: the user's list is fetched once, the changes are
+    # computed locally and only the real ones get sent. Returns a report per requested anime.
+    if not mal_token:
+        mal_token = load_config()
+    progress_map = {str(anime_id): int(progress) for anime_id, progress in dict(progress_map).items()}
+    user_list = get_all_anime_for_user("ALL", mal_token=mal_token, lazy_related=True) or {}
+    anime_infos = dict(user_list)
+    anime_infos.update(get_anime_info_many([anime_id for anime_id in progress_map if anime_id not in user_list], mal_token=mal_token))
+    season_ranges = {anime_id: get_season_ranges(anime_id) for anime_id in overflowing_ids(progress_map, anime_infos)}
+    targets = season_targets(progress_map, anime_infos, season_ranges)
+    anime_infos.update(get_anime_info_many([target_id for target_id, _ in targets.values() if target_id not in anime_infos], mal_token=mal_token))
+    report, updates, owners = plan_entry_updates(progress_map, targets, anime_infos)
+
+    def send_update(target_id):
+        request_url = f"{anime_request_url}/{target_id}/my_list_status"
+        return make_mal_request(request_url, updates[target_id], 'put', mal_token, True)
+
+    return report_entry_updates(report, owners, fetch_many(send_update, updates))
+
+# Planning shared with the async update_entry()/update_entries(), the callers only fetch and send
+
+def overflowing_ids(progress_map, anime_infos):
+    # The requested anime whose progress runs past their last episode, they need their season ranges
+    return [anime_id for anime_id, progress in progress_map.items() if anime_id in anime_infos and progress > anime_infos[anime_id]['total_eps']]
+
+def season_targets(progress_map, anime_infos, season_ranges):
+    # {anime_id: (target anime_id, progress)} for every anime in anime_infos,
+    # season_ranges holds the ranges of the overflowing ones
+    targets = {}
+    for anime_id, progress in progress_map.items():
+        if anime_id not in anime_infos:
+            continue
+        if anime_id in season_ranges:
+            targets[anime_id] = find_season(season_ranges[anime_id], anime_id, progress)
+        else:
+            targets[anime_id] = (anime_id, progress)
+    return targets
 
+def plan_entry_updates(progress_map, targets, anime_infos):
+    # -> (report per requested anime, {target_id: params} to send, {target_id: requested anime_id})
+    report = {}
+    owners = {}
+    for anime_id in progress_map:
+        if anime_id not in targets:
+            report[anime_id] = {'result': "failed", 'reason': "anime not found"}
+            continue
+        target_id, progress = targets[anime_id]
+        report[anime_id] = {'id': target_id, 'progress': progress}
+        if target_id not in anime_infos:
+            report[anime_id].update(result="failed", reason="anime not found")
+            continue
+        # Several requests for the same season keep the furthest progress
+        if target_id in owners and report[owners[target_id]]['progress'] >= progress:
+            report[anime_id].update(result="skipped", reason="superseded by another update")
+            continue
+        if target_id in owners:
+            report[owners[target_id]].update(result="skipped", reason="superseded by another update")
+        owners[target_id] = anime_id
+
+    updates = {}
+    for target_id, anime_id in owners.items():
+        params, reason = plan_update(anime_infos[target_id], report[anime_id]['progress'])
+        if params is None:
+            report[anime_id].update(result="skipped", reason=reason)
+        else:
+            report[anime_id]['params'] = params
+            updates[target_id] = params
+    return report, updates, owners
+
+def report_entry_updates(report, owners, responses):
+    # responses is {target_id: response} of the sent updates
+    for target_id, response in responses.items():
+        report[owners[target_id]]['result'] = "updated" if response else "failed"
+    print_deb(f"Updated {len([item for item in report.values() if item['result'] == 'updated'])} of {len(report)} entries")
+    return report
+
+def find_season(season_ranges, anime_id, progress):
+    # Map overflowing progress to the season it falls into
+    skipped_eps = 0
+    for season in season_ranges:
+        if progress <= season_ranges[season]['end']:
+            return str(season_ranges[season]['id']), progress - skipped_eps
+        skipped_eps += season_ranges[season]['total_eps']
+    return anime_id, progress
+
+def entry_update_params(anime_info, current_status, progress):
+    # What update_entry() sends, None when the user is further already
+    total_eps = anime_info['total_eps']
+    user_eps = anime_info.get('watched_ep', -1) #allow for 0 as a value
     if progress <= user_eps and user_eps != total_eps:
         print_deb('Not updating, progress is lower or equal than user progress')
-        return
+        return None
+    return generate_update_params(progress, total_eps, current_status, anime_info.get('rewatch_count', 0))
+
+def plan_update(anime_info, progress):
+    # Returns (params, None) for a needed update, (None, reason) when there is nothing to send
+    current_status = anime_info.get('watching_status', 'PLANNING')
+    total_eps = anime_info['total_eps']
+    user_eps = anime_info.get('watched_ep', -1)
+    if progress <= user_eps and user_eps != total_eps:
+        return None, "progress is lower or equal than user progress"
+    params = generate_update_params(progress, total_eps, current_status, anime_info.get('rewatch_count', 0))
+    new_status = params.get('status', al_to_mal_user_status.get(current_status))
+    if progress == user_eps and 'is_rewatching' not in params and new_status == al_to_mal_user_status.get(current_status):
+        return None, "already up to date"
+    return params, None
 
+def generate_update_params(progress, total_eps, current_status, rewatch_count = 0):
     params = {}
     params['num_watched_episodes'] = progress
     if progress == total_eps and current_status != 'REPEATING':
@@ -641,12 +1398,10 @@ def update_entry(anime_id, progress, mal_token=None):
             params['is_rewatching'] = 'true'
         elif current_status == 'REPEATING':
             if progress == total_eps:
-                params['num_times_rewatched'] = anime_info['rewatch_count'] + 1
+                params['num_times_rewatched'] = rewatch_count + 1
                 params['is_rewatching'] = 'false'
                 params['status'] = 'completed'
         else:
             if current_status != 'CURRENT':
                 params['status'] = 'watching'
-    request_url = f"https://api.myanimelist.net/v2/anime/{anime_id}/my_list_status"
-    make_mal_request(request_url, params, 'put', mal_token, True)
-    print_deb('Updating progress successful')
+    return params
\ No newline at end of file
@@ -0,0 +1,169 @@
+import re, time, inspect, threading, functools
+from contextlib import contextmanager, ExitStack
+from urllib.parse import urlsplit
+
+# Process wide counters and histograms. Read them with get_metrics() or metrics_text()
+# (Prometheus text format), or push every observation somewhere else with add_metrics_exporter().
+# add_span_hook() wraps requests, id conversions and cache writes in tracing spans.
+
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+metric_help = {
+    'malfetcher_requests_total': ('counter', "HTTP requests sent, by service, endpoint and status"),
+    'malfetcher_request_seconds': ('histogram', "HTTP request latency, by service and endpoint"),
+    'malfetcher_response_bytes_total': ('counter', "HTTP response body bytes received"),
+    'malfetcher_retries_total': ('counter', "Retried requests, by service and the status that caused them"),
+    'malfetcher_retry_sleep_seconds_total': ('counter', "Time spent waiting before retries, status 429 is the rate limit backoff"),
+    'malfetcher_rate_limiter_wait_seconds_total': ('counter', "Time spent waiting for the client side rate limiter"),
+    'malfetcher_cache_hits_total': ('counter', "Cache lookups that found the key, by cache and tier"),
+    'malfetcher_cache_misses_total': ('counter', "Cache lookups that missed, by cache and tier"),
+    'malfetcher_cache_bytes_read_total': ('counter', "Bytes read from cache files"),
+    'malfetcher_cache_bytes_written_total': ('counter', "Bytes written to cache files")
+}
+
+lock = threading.Lock()
+counters = {} # (name, labels) -> value
+histograms = {} # (name, labels) -> [bucket counts, sum, count]
+exporters = []
+span_hooks = []
+
+def label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def export(name, labels, value):
+    for exporter in list(exporters):
+        try:
+            exporter(name, labels, value)
+        except Exception as e:
+            print("Metrics exporter failed:", e)
+
+def increment(name, value = 1, **labels):
+    key = (name, label_key(labels))
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+    if exporters:
+        export(name, labels, value)
+
+def observe(name, value, **labels):
+    key = (name, label_key(labels))
+    with lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [[0] * len(latency_buckets), 0.0, 0]
+        for index, bound in enumerate(latency_buckets):
+            if value <= bound:
+                histogram[0][index] += 1
+        histogram[1] += value
+        histogram[2] += 1
+    if exporters:
+        export(name, labels, value)
+
+def endpoint_name(url):
+    # /v2/anime/5114/my_list_status -> /v2/anime/{id}/my_list_status
+    return re.sub(r'/\d+(?=/|$)', '/{id}', urlsplit(url).path) or '/'
+
+def record_request(service, url, status, seconds, size = None):
+    endpoint = endpoint_name(url)
+    increment('malfetcher_requests_total', service=service, endpoint=endpoint, status=status)
+    observe('malfetcher_request_seconds', seconds, service=service, endpoint=endpoint)
+    if size:
+        increment('malfetcher_response_bytes_total', size, service=service, endpoint=endpoint)
+
+def record_cache_lookup(cache, hit, tier = 'backend'):
+    increment('malfetcher_cache_hits_total' if hit else 'malfetcher_cache_misses_total', cache=cache, tier=tier)
+
+def add_metrics_exporter(callback):
+    # callback(name, labels, value) is called for every observation
+    exporters.append(callback)
+    return callback
+
+def remove_metrics_exporter(callback):
+    if callback in exporters:
+        exporters.remove(callback)
+
+def add_span_hook(hook):
+    # hook(name, attributes) has to return a context manager, an OpenTelemetry tracer fits with
+    # add_span_hook(lambda name, attributes: tracer.start_as_current_span(name, attributes=attributes))
+    span_hooks.append(hook)
+    return hook
+
+def remove_span_hook(hook):
+    if hook in span_hooks:
+        span_hooks.remove(hook)
+
+@contextmanager
+def span(name, **attributes):
+    if not span_hooks:
+        yield
+        return
+    with ExitStack() as stack:
+        for hook in list(span_hooks):
+            stack.enter_context(hook(name, attributes))
+        yield
+
+def traced(name):
+    # Runs the decorated function, sync or async, inside span(name)
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            async def wrapper(*args, **kwargs):
+                with span(name):
+                    return await function(*args, **kwargs)
+        else:
+            def wrapper(*args, **kwargs):
+                with span(name):
+                    return function(*args, **kwargs)
+        return functools.wraps(function)(wrapper)
+    return decorator
+
+def timer():
+    started = time.perf_counter()
+    return lambda: time.perf_counter() - started
+
+def get_metrics():
+    with lock:
+        return {
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in counters.items()],
+            'histograms': [
+                {'name': name, 'labels': dict(labels), 'buckets': dict(zip(latency_buckets, buckets)), 'sum': total, 'count': count}
+                for (name, labels), (buckets, total, count) in histograms.items()
+            ]
+        }
+
+def format_labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+def metrics_text():
+    # Prometheus text exposition format
+    with lock:
+        counter_items = sorted(counters.items())
+        histogram_items = sorted((key, (list(buckets), total, count)) for key, (buckets, total, count) in histograms.items())
+    lines = []
+    described = set()
+
+    def describe(name):
+        if name not in described and name in metric_help:
+            metric_type, help_text = metric_help[name]
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            described.add(name)
+
+    for (name, labels), value in counter_items:
+        describe(name)
+        lines.append(f"{name}{format_labels(labels)} {value}")
+    for (name, labels), (buckets, total, count) in histogram_items:
+        describe(name)
+        for bound, bucket_count in zip(latency_buckets, buckets):
+            lines.append(f"{name}_bucket{format_labels(labels, le=bound)} {bucket_count}")
+        lines.append(f"{name}_bucket{format_labels(labels, le='+Inf')} {count}")
+        lines.append(f"{name}_sum{format_labels(labels)} {total}")
+        lines.append(f"{name}_count{format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+def reset_metrics():
+    with lock:
+        counters.clear()
+        histograms.clear()
@@ -0,0 +1,112 @@
+import sys
+from collections.abc import Mapping, MutableMapping
+
+# Compact entry model. AnimeEntry and Relation keep their fields in __slots__, share interned
+# status/format/type strings and still behave like the dicts the rest of the api returns,
+# so existing code can keep indexing them by key. to_dict() gives back a plain dict.
+
+statuses = ('FINISHED', 'RELEASING', 'NOT_YET_RELEASED')
+user_statuses = ('CURRENT', 'COMPLETED', 'PAUSED', 'DROPPED', 'PLANNING', 'REPEATING')
+formats = ('TV', 'MOVIE', 'SPECIAL', 'OVA', 'ONA', 'MUSIC', 'TV_SPECIAL', 'CM', 'PV', 'UNKNOWN')
+relation_types = ('PREQUEL', 'SEQUEL')
+enum_values = {value: sys.intern(value) for value in statuses + user_statuses + formats + relation_types}
+
+missing = object()
+
+def intern_enum(value):
+    if value is None:
+        return None
+    return enum_values.get(value) or sys.intern(value)
+
+class SlotMapping(MutableMapping):
+    # Dict view over __slots__, unset slots behave like missing keys
+    __slots__ = ()
+    fields = ()
+    enum_fields = ()
+
+    def __init__(self, data = None, **kwargs):
+        for field in self.fields:
+            object.__setattr__(self, field, missing)
+        self.update(data or {}, **kwargs)
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        value = getattr(self, key)
+        if value is missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self.fields:
+            raise KeyError(f"{type(self).__name__} has no field {key}")
+        if key in self.enum_fields:
+            value = intern_enum(value)
+        object.__setattr__(self, key, value)
+
+    def __delitem__(self, key):
+        if self.get(key, missing) is missing:
+            raise KeyError(key)
+        object.__setattr__(self, key, missing)
+
+    def __iter__(self):
+        return (field for field in self.fields if getattr(self, field) is not missing)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        if isinstance(other, SlotMapping):
+            other = other.to_dict()
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return self.to_dict() == dict(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def copy(self):
+        return type(self)(self.to_dict())
+
+    def to_dict(self):
+        return {key: self[key] for key in self}
+
+class Relation(SlotMapping):
+    __slots__ = ('main_title', 'status', 'type')
+    fields = __slots__
+    enum_fields = ('status', 'type')
+
+class AnimeEntry(SlotMapping):
+    __slots__ = (
+        'al_id', 'total_eps', 'is_sus', 'main_title', 'synonyms', 'status', 'release_date', 'end_date',
+        'upcoming_ep', 'format', 'related', 'watched_ep', 'watching_status', 'rewatch_count'
+    )
+    fields = __slots__
+    enum_fields = ('status', 'format', 'watching_status')
+
+    def __setitem__(self, key, value):
+        if key == 'synonyms' and value is not None:
+            value = tuple(value)
+        elif key == 'related' and value is not None:
+            value = {sys.intern(str(relation_id)): relation if isinstance(relation, Relation) else Relation(relation) for relation_id, relation in value.items()}
+        super().__setitem__(key, value)
+
+    def to_dict(self):
+        data = super().to_dict()
+        if data.get('synonyms') is not None:
+            data['synonyms'] = list(data['synonyms'])
+        if data.get('related') is not None:
+            data['related'] = {relation_id: relation.to_dict() for relation_id, relation in data['related'].items()}
+        return data
+
+def to_models(anime_data):
+    # {anime_id: entry dict} -> {anime_id: AnimeEntry}
+    return {anime_id: entry if isinstance(entry, AnimeEntry) else AnimeEntry(entry) for anime_id, entry in anime_data.items()}
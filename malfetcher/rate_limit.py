@@ -0,0 +1,152 @@
+import os, json, time, threading, asyncio
+from .metrics import increment
+from .utils import lock_file, unlock_file
+from urllib.parse import urlsplit
+
+# Budgets in requests per second. MAL_RATE_LIMIT_DIR makes the buckets shared between processes through small state files.
+
+rate_limit_dir = os.getenv('MAL_RATE_LIMIT_DIR', '')
+default_limits = {
+    'mal': (float(os.getenv('MAL_RATE_LIMIT', 2)), float(os.getenv('MAL_RATE_BURST', 5))),
+    'anilist': (float(os.getenv('ANILIST_RATE_LIMIT', 1.5)), float(os.getenv('ANILIST_RATE_BURST', 5)))
+}
+service_hosts = {
+    'api.myanimelist.net': 'mal',
+    'myanimelist.net': 'mal',
+    'graphql.anilist.co': 'anilist'
+}
+
+class TokenBucket:
+    def __init__(self, rate, burst, state_path = None, service = None):
+        self.service = service
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.state_path = state_path
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+        # Metrics
+        self.acquired = 0
+        self.waited = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def refill(self, tokens, updated, now):
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def take_local(self, now):
+        self.tokens = self.refill(self.tokens, self.updated, now)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take_shared(self, now):
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        with open(self.state_path, 'a+', encoding="utf-8") as file:
+            lock_file(file)
+            try:
+                file.seek(0)
+                try:
+                    state = json.loads(file.read())
+                    tokens = self.refill(state['tokens'], state['updated'], now)
+                except (ValueError, KeyError):
+                    tokens = self.burst
+                wait = 0
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    wait = (1 - tokens) / self.rate
+                file.seek(0)
+                file.truncate()
+                file.write(json.dumps({'tokens': tokens, 'updated': now}))
+                file.flush()
+            finally:
+                unlock_file(file)
+        return wait
+
+    def take(self):
+        # Returns 0 when a token was taken, otherwise how long to wait before trying again
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            now = time.time()
+            if self.state_path:
+                return self.take_shared(now)
+            return self.take_local(now)
+
+    def record(self, waited):
+        with self.lock:
+            self.acquired += 1
+            if waited > 0:
+                self.waited += 1
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+        if waited > 0:
+            increment('malfetcher_rate_limiter_wait_seconds_total', waited, service=self.service)
+
+    def acquire(self):
+        waited = 0
+        while True:
+            wait = self.take()
+            if wait <= 0:
+                break
+            time.sleep(wait)
+            waited += wait
+        self.record(waited)
+        return waited
+
+    async def acquire_async(self):
+        # The shared bucket can wait on another process' file lock, that happens on a worker thread
+        loop = asyncio.get_running_loop()
+        waited = 0
+        while True:
+            wait = await loop.run_in_executor(None, self.take) if self.state_path else self.take()
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+            waited += wait
+        self.record(waited)
+        return waited
+
+    def stats(self):
+        with self.lock:
+            return {
+                'rate': self.rate,
+                'burst': self.burst,
+                'shared': bool(self.state_path),
+                'acquired': self.acquired,
+                'waited': self.waited,
+                'wait_time': self.wait_time,
+                'max_wait': self.max_wait
+            }
+
+def create_bucket(service, rate, burst, shared_dir = None):
+    state_path = os.path.join(shared_dir, f"{service}_rate_limit.json") if shared_dir else None
+    return TokenBucket(rate, burst, state_path, service)
+
+rate_limiters = {service: create_bucket(service, *limits, rate_limit_dir) for service, limits in default_limits.items()}
+
+def configure_rate_limit(service, rate = None, burst = None, shared_dir = None):
+    # shared_dir="" turns process sharing off again, None keeps the current setting
+    bucket = rate_limiters[service]
+    if shared_dir is None:
+        shared_dir = os.path.dirname(bucket.state_path) if bucket.state_path else None
+    rate_limiters[service] = create_bucket(
+        service,
+        bucket.rate if rate is None else rate,
+        bucket.burst if burst is None else burst,
+        shared_dir
+    )
+    return rate_limiters[service]
+
+def get_service(url):
+    netloc = urlsplit(url).netloc
+    return service_hosts.get(netloc, netloc)
+
+def get_rate_limiter(url):
+    return rate_limiters.get(get_service(url))
+
+def get_rate_limit_stats():
+    return {service: bucket.stats() for service, bucket in rate_limiters.items()}
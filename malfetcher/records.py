@@ -0,0 +1,158 @@
+import os, mmap, struct, bisect, hashlib, tempfile
+from .utils import fsync_writes
+
+# Compact binary cache file. Length prefixed records are followed by an index of
+# (key hash, record offset) pairs sorted by hash and a fixed size footer, so a lookup
+# maps the file, binary searches the index and decodes only the record it needs.
+#
+#   record: <u32 key length><key utf-8><u32 value length><serialized value>
+#   index:  <u64 key hash><u64 record offset> for every record
+#   footer: <u64 index offset><u64 record count><8 byte magic>
+
+magic = b'MALREC01'
+footer_format = '<QQ8s'
+footer_size = struct.calcsize(footer_format)
+index_format = '<QQ'
+index_entry_size = struct.calcsize(index_format)
+length_format = '<I'
+length_size = struct.calcsize(length_format)
+
+def key_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def encode_record(key, value):
+    # value is already serialized
+    key = key.encode('utf-8')
+    return struct.pack(length_format, len(key)) + key + struct.pack(length_format, len(value)) + value
+
+class RecordFile:
+    # Read only view over one version of a record file, writers replace the file instead of changing it
+    def __init__(self, file_path):
+        self.file = open(file_path, 'rb')
+        try:
+            stat = os.fstat(self.file.fileno())
+            self.stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if stat.st_size < footer_size:
+                raise ValueError(f"{file_path} is not a record file")
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except BaseException:
+            self.file.close()
+            raise
+        self.index_offset, self.count, file_magic = struct.unpack_from(footer_format, self.map, stat.st_size - footer_size)
+        if file_magic != magic or self.index_offset + self.count * index_entry_size + footer_size != stat.st_size:
+            self.close()
+            raise ValueError(f"{file_path} is not a record file")
+
+    def index_entry(self, position):
+        return struct.unpack_from(index_format, self.map, self.index_offset + position * index_entry_size)
+
+    def record_at(self, offset):
+        # -> (key, serialized value, offset of the next record)
+        key_length, = struct.unpack_from(length_format, self.map, offset)
+        offset += length_size
+        key = self.map[offset:offset + key_length].decode('utf-8')
+        offset += key_length
+        value_length, = struct.unpack_from(length_format, self.map, offset)
+        offset += length_size
+        return key, self.map[offset:offset + value_length], offset + value_length
+
+    def index_entries(self):
+        return struct.iter_unpack(index_format, self.map[self.index_offset:self.index_offset + self.count * index_entry_size])
+
+    def find(self, key):
+        # Serialized value of key or None
+        location = self.locate(key)
+        return location and location[1]
+
+    def locate(self, key):
+        # (record offset, serialized value, end offset) of key or None
+        wanted = key_hash(key)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.index_entry(middle)[0] < wanted:
+                low = middle + 1
+            else:
+                high = middle
+        while low < self.count:
+            record_hash, offset = self.index_entry(low)
+            if record_hash != wanted:
+                break
+            record_key, value, end = self.record_at(offset)
+            if record_key == key:
+                return offset, value, end
+            low += 1
+        return None
+
+    def records(self):
+        # (key, serialized value) in file order
+        offset = 0
+        while offset < self.index_offset:
+            key, value, offset = self.record_at(offset)
+            yield key, value
+
+    def keys(self):
+        return [key for key, _ in self.records()]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+def rewrite_records(view, changes, removed = ()):
+    # -> (chunks, index) of a new file: the records of view minus the changed and removed keys,
+    # copied as a few big slices with their index entries shifted, then the changes
+    # ({key: serialized value}) appended. view can be None for a new file.
+    chunks = []
+    index = []
+    size = 0
+    if view is not None:
+        dropped = sorted(location[0::2] for location in map(view.locate, set(changes) | set(removed)) if location)
+        starts = [start for start, _ in dropped]
+        shifts = [0]
+        start = 0
+        for offset, end in dropped:
+            chunks.append(view.map[start:offset])
+            shifts.append(shifts[-1] + end - offset)
+            start = end
+        chunks.append(view.map[start:view.index_offset])
+        for record_hash, offset in view.index_entries():
+            position = bisect.bisect_right(starts, offset)
+            if position and starts[position - 1] == offset:
+                continue
+            index.append((record_hash, offset - shifts[position]))
+        size = view.index_offset - shifts[-1]
+    for key, value in changes.items():
+        record = encode_record(key, value)
+        chunks.append(record)
+        index.append((key_hash(key), size))
+        size += len(record)
+    return chunks, index
+
+def write_records(file_path, chunks, index):
+    # Writes the record bytes and the index to a temp file and returns its path,
+    # the caller os.replace()s it over file_path once it closed its own views
+    directory = os.path.dirname(file_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    mode = os.stat(file_path).st_mode & 0o777 if os.path.exists(file_path) else 0o644
+    fd, temp_path = tempfile.mkstemp(dir=directory or None, prefix=f"{os.path.basename(file_path)}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, "wb") as file:
+            offset = 0
+            for chunk in chunks:
+                file.write(chunk)
+                offset += len(chunk)
+            index = sorted(index)
+            file.write(b''.join(struct.pack(index_format, record_hash, record_offset) for record_hash, record_offset in index))
+            file.write(struct.pack(footer_format, offset, len(index), magic))
+            file.flush()
+            if fsync_writes:
+                os.fsync(file.fileno())
+        os.chmod(temp_path, mode)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    return temp_path
@@ -0,0 +1,208 @@
+import os, time, heapq, threading
+from datetime import datetime, timedelta
+from .utils import env_flag
+
+# MAL_REFRESH_AUTO=0 turns the automatic background runs off, refresh_stale_entries() still works.
+
+default_budget = int(os.getenv('MAL_REFRESH_BUDGET', 20))
+default_interval = float(os.getenv('MAL_REFRESH_INTERVAL', 300))
+default_auto = env_flag('MAL_REFRESH_AUTO')
+min_recheck = 24 * 3600 # an entry is never refetched more than once a day
+failure_retry = 3600
+
+def parse_date(date_str):
+    try:
+        return datetime.strptime(date_str, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+def next_expected_change(entry):
+    # When the cached entry is expected to go stale, None for entries that don't change anymore
+    status = entry.get('status')
+    if status == "FINISHED" or status is None:
+        # Partial entries without a status get upgraded when someone asks for more fields
+        return None
+    now = time.time()
+    if status == "NOT_YET_RELEASED":
+        # Dates and episode counts get announced any time, check daily
+        return now
+    release_date = parse_date(entry.get('release_date'))
+    end_date = parse_date(entry.get('end_date'))
+    upcoming_ep = entry.get('upcoming_ep')
+    if status == "RELEASING" and release_date and upcoming_ep:
+        changes = [(release_date + timedelta(days=upcoming_ep * 7 + 1)).timestamp()]
+        if end_date:
+            changes.append((end_date + timedelta(days=1)).timestamp())
+        return min(changes)
+    return now
+
+class RefreshScheduler:
+    # Priority queue of cached entries ordered by the time they are expected to change.
+    # Due entries are refetched in bounded batches, either on demand with run() or by a
+    # background worker that reads only poke(), so cache reads never wait for a refresh.
+    def __init__(self, store, load_entries, refresh_entries, budget = default_budget, interval = default_interval, auto = default_auto):
+        self.store = store # persisted {anime_id: due timestamp}, shared between processes
+        self.load_entries = load_entries
+        self.refresh_entries = refresh_entries
+        self.budget = budget
+        self.interval = interval
+        self.auto = auto
+        self.due = {}
+        self.queue = []
+        self.loaded = False
+        self.lock = threading.RLock()
+        self.run_lock = threading.Lock()
+        self.next_poke = 0
+        self.worker = None
+        self.stop_event = None
+
+    def push(self, anime_id, due):
+        if due is None:
+            self.due.pop(anime_id, None)
+        else:
+            self.due[anime_id] = due
+            heapq.heappush(self.queue, (due, anime_id))
+
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            stored = self.store.load()
+            for anime_id, due in stored.items():
+                self.push(anime_id, due)
+            # Entries cached before the scheduler knew about them are due right away
+            seeded = {}
+            for anime_id, entry in self.load_entries().items():
+                if anime_id not in stored:
+                    seeded[anime_id] = next_expected_change(entry)
+                    self.push(anime_id, seeded[anime_id])
+            self.store.update({anime_id: due for anime_id, due in seeded.items() if due is not None})
+            self.loaded = True
+
+    def track(self, anime_data):
+        # Called with freshly fetched entries, they are up to date until their next expected change
+        if not anime_data:
+            return
+        now = time.time()
+        scheduled = {}
+        finished = []
+        with self.lock:
+            for anime_id, entry in anime_data.items():
+                due = next_expected_change(entry)
+                if due is None:
+                    finished.append(anime_id)
+                    self.push(anime_id, None)
+                    continue
+                scheduled[anime_id] = max(due, now + min_recheck)
+                self.push(anime_id, scheduled[anime_id])
+        with self.store.batch():
+            self.store.update(scheduled)
+            for anime_id in finished:
+                if anime_id in self.store:
+                    self.store.delete(anime_id)
+
+    def pop_due(self, budget):
+        now = time.time()
+        anime_ids = []
+        with self.lock:
+            while self.queue and len(anime_ids) < budget:
+                due, anime_id = self.queue[0]
+                if self.due.get(anime_id) != due:
+                    heapq.heappop(self.queue) # superseded by a later push
+                    continue
+                if due > now:
+                    break
+                heapq.heappop(self.queue)
+                del self.due[anime_id]
+                anime_ids.append(anime_id)
+        return anime_ids
+
+    def pending(self):
+        self.load()
+        now = time.time()
+        with self.lock:
+            return sum(1 for due in self.due.values() if due <= now)
+
+    def run(self, budget = None):
+        # Refresh at most budget due entries, returns the ids that were refreshed
+        self.load()
+        with self.run_lock:
+            anime_ids = self.pop_due(budget or self.budget)
+            if not anime_ids:
+                return []
+            refreshed = {}
+            try:
+                refreshed = self.refresh_entries(anime_ids) or {}
+                self.track(refreshed)
+            finally:
+                failed = [anime_id for anime_id in anime_ids if anime_id not in refreshed]
+                if failed:
+                    retry_at = time.time() + failure_retry
+                    with self.lock:
+                        for anime_id in failed:
+                            self.push(anime_id, retry_at)
+                    self.store.update({anime_id: retry_at for anime_id in failed})
+            return [anime_id for anime_id in anime_ids if anime_id in refreshed]
+
+    def run_once(self):
+        try:
+            self.run()
+        except Exception as e:
+            print("Cache refresh failed:", e)
+
+    def poke(self):
+        # Cheap enough for every read, starts a bounded background run at most once per interval
+        if not self.auto or self.stop_event is not None:
+            return
+        now = time.monotonic()
+        if now < self.next_poke:
+            return
+        with self.lock:
+            if now < self.next_poke or (self.worker and self.worker.is_alive()):
+                return
+            self.next_poke = now + self.interval
+            self.worker = threading.Thread(target=self.run_once, name="malfetcher-refresh", daemon=True)
+            self.worker.start()
+
+    def start(self, interval = None):
+        # Keep refreshing in the background until stop() is called
+        with self.lock:
+            if self.stop_event is not None:
+                return
+            self.stop_event = threading.Event()
+            stop_event = self.stop_event
+        interval = interval or self.interval
+
+        def loop():
+            while not stop_event.is_set():
+                self.run_once()
+                stop_event.wait(0 if self.pending() else interval)
+
+        self.worker = threading.Thread(target=loop, name="malfetcher-refresh", daemon=True)
+        self.worker.start()
+
+    def stop(self):
+        with self.lock:
+            stop_event, self.stop_event = self.stop_event, None
+            worker = self.worker
+        if stop_event is not None:
+            stop_event.set()
+        if worker is not None:
+            worker.join()
+
+    def configure(self, budget = None, interval = None, auto = None):
+        if budget is not None:
+            self.budget = budget
+        if interval is not None:
+            self.interval = interval
+        if auto is not None:
+            self.auto = auto
+        self.next_poke = 0
+
+    def clear(self):
+        with self.lock:
+            self.due = {}
+            self.queue = []
+            self.loaded = False
+            self.next_poke = 0
+        self.store.clear()
@@ -0,0 +1,142 @@
+import os, time, random, threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from .metrics import increment
+
+default_max_retries = int(os.getenv('MAL_MAX_RETRIES', 5))
+default_deadline = float(os.getenv('MAL_RETRY_DEADLINE', 120))
+
+default_status_rules = {
+    429: {'retry_after': True},
+    500: {},
+    502: {},
+    503: {},
+    504: {},
+    None: {} # connection errors
+}
+
+def parse_retry_after(value):
+    # Retry-After is either seconds or an HTTP date, None when it's neither
+    try:
+        return max(float(value), 0)
+    except (TypeError, ValueError):
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if retry_at is None:
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+
+class RetryPolicy:
+    # Capped exponential backoff with full jitter, a total deadline and per status rules.
+    # A status rule can override max_retries and whether retry-after headers are honoured,
+    # statuses without a rule are not retried.
+    def __init__(self, max_retries = default_max_retries, base_delay = 0.5, max_delay = 30, deadline = default_deadline, status_rules = None):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.status_rules = status_rules if status_rules is not None else dict(default_status_rules)
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def start(self, service = None):
+        return RetryState(self, service)
+
+class RetryState:
+    def __init__(self, policy, service = None):
+        self.policy = policy
+        self.service = service
+        self.started = time.monotonic()
+        self.attempts = {}
+        self.total_attempts = 0
+
+    def next_delay(self, status, retry_after = None):
+        # Returns how long to wait before the next attempt, or None when we should give up
+        if status not in self.policy.status_rules:
+            return None
+        rule = self.policy.status_rules[status]
+        attempt = self.attempts.get(status, 0)
+        if attempt >= rule.get('max_retries', self.policy.max_retries) or self.total_attempts >= self.policy.max_retries:
+            return None
+        self.attempts[status] = attempt + 1
+        self.total_attempts += 1
+        delay = None
+        if retry_after is not None and rule.get('retry_after'):
+            delay = parse_retry_after(retry_after)
+        if delay is None:
+            delay = self.policy.backoff(attempt)
+        if time.monotonic() - self.started + delay > self.policy.deadline:
+            return None
+        increment('malfetcher_retries_total', service=self.service, status=status or 'connection_error')
+        increment('malfetcher_retry_sleep_seconds_total', delay, service=self.service, status=status or 'connection_error')
+        return delay
+
+class CircuitBreaker:
+    # Opens after failure_threshold consecutive failures and fails fast until reset_timeout passes,
+    # then lets a single trial request through
+    def __init__(self, failure_threshold = 5, reset_timeout = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def end_trial(self):
+        # Called once the request is sent, whatever it raised the next one can be the trial again.
+        # The caller records a success or failure right after when the request got an answer.
+        with self.lock:
+            self.trial_running = False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return 'closed'
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+retry_policies = {
+    'mal': RetryPolicy(status_rules={**default_status_rules, 400: {'max_retries': 2}}),
+    'anilist': RetryPolicy()
+}
+circuit_breakers = {
+    'mal': CircuitBreaker(),
+    'anilist': CircuitBreaker()
+}
+
+def configure_retry_policy(service, policy = None, circuit_breaker = None):
+    if policy is not None:
+        retry_policies[service] = policy
+    if circuit_breaker is not None:
+        circuit_breakers[service] = circuit_breaker
+    return retry_policies[service], circuit_breakers[service]
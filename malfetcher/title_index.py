@@ -0,0 +1,97 @@
+import os, re, threading, unicodedata
+
+# In memory trigram index over the cached titles and synonyms. It is built from the id cache on
+# the first lookup and kept current as entries get cached, so fuzzy title lookups don't need the api.
+
+default_threshold = float(os.getenv('MAL_TITLE_MATCH_THRESHOLD', 0.8))
+
+def normalize_title(title):
+    title = unicodedata.normalize('NFKD', title)
+    title = "".join(char for char in title if not unicodedata.combining(char)).lower()
+    return " ".join(re.findall(r"[^\W_]+", title))
+
+def title_trigrams(normalized):
+    padded = f"  {normalized} "
+    return {padded[index:index + 3] for index in range(len(padded) - 2)}
+
+def title_numbers(normalized):
+    # Season numbers and years have to match exactly, "2nd season" is not "3rd season"
+    return set(re.findall(r"\d+", normalized))
+
+class TitleIndex:
+    def __init__(self, load_entries, threshold = default_threshold):
+        self.load_entries = load_entries
+        self.threshold = threshold
+        self.postings = {} # trigram -> {(anime_id, title index)}
+        self.titles = {} # anime_id -> [(normalized title, trigram count, numbers)]
+        self.formats = {}
+        self.built = False
+        self.lock = threading.RLock()
+
+    def build(self):
+        with self.lock:
+            if self.built:
+                return
+            self.built = True
+            self.add(self.load_entries())
+
+    def remove(self, anime_id):
+        for title_index, (normalized, _, _) in enumerate(self.titles.pop(anime_id, [])):
+            for trigram in title_trigrams(normalized):
+                postings = self.postings.get(trigram)
+                if postings is not None:
+                    postings.discard((anime_id, title_index))
+                    if not postings:
+                        del self.postings[trigram]
+        self.formats.pop(anime_id, None)
+
+    def add(self, anime_data):
+        with self.lock:
+            if not self.built:
+                return # the first lookup builds everything from the cache anyway
+            for anime_id, entry in anime_data.items():
+                anime_id = str(anime_id)
+                self.remove(anime_id)
+                names = [entry.get('main_title')] + list(entry.get('synonyms') or [])
+                normalized_names = list(dict.fromkeys(normalize_title(name) for name in names if name))
+                self.titles[anime_id] = []
+                for title_index, normalized in enumerate(normalized_names):
+                    trigrams = title_trigrams(normalized)
+                    self.titles[anime_id].append((normalized, len(trigrams), title_numbers(normalized)))
+                    for trigram in trigrams:
+                        self.postings.setdefault(trigram, set()).add((anime_id, title_index))
+                self.formats[anime_id] = entry.get('format')
+
+    def search(self, query, media_format = None, limit = 10, threshold = None):
+        # Returns [(anime_id, score, matched title)] ranked by the dice similarity of the trigrams
+        self.build()
+        threshold = self.threshold if threshold is None else threshold
+        normalized = normalize_title(query)
+        if not normalized:
+            return []
+        trigrams = title_trigrams(normalized)
+        numbers = title_numbers(normalized)
+        shared = {}
+        with self.lock:
+            for trigram in trigrams:
+                for posting in self.postings.get(trigram, ()):
+                    shared[posting] = shared.get(posting, 0) + 1
+            best = {}
+            for (anime_id, title_index), count in shared.items():
+                if media_format and self.formats.get(anime_id) != media_format:
+                    continue
+                title, trigram_count, numbers_in_title = self.titles[anime_id][title_index]
+                if numbers_in_title != numbers:
+                    continue
+                score = 1.0 if title == normalized else 2 * count / (len(trigrams) + trigram_count)
+                if score >= threshold and score > best.get(anime_id, (0,))[0]:
+                    best[anime_id] = (score, title)
+        ranked = sorted(best.items(), key=lambda item: (-item[1][0], item[0]))
+        return [(anime_id, score, title) for anime_id, (score, title) in ranked[:limit]]
+
+    def clear(self):
+        with self.lock:
+            self.postings = {}
+            self.titles = {}
+            self.formats = {}
+            self.built = False
@@ -0,0 +1,98 @@
+import os, time, threading
+from datetime import datetime
+from .utils import env_flag
+
+# Local snapshots of whole user lists. MAL sorts a list by list_updated_at newest first, so a
+# delta sync reads pages only until it reaches rows older than the last sync and merges the
+# rows that changed. Removed entries never show up that way, a full sync every
+# full_sync_interval drops them.
+
+default_enabled = env_flag('MAL_LIST_SNAPSHOT')
+default_full_sync_interval = float(os.getenv('MAL_LIST_FULL_SYNC_INTERVAL', 3600))
+default_page_size = int(os.getenv('MAL_LIST_SYNC_PAGE_SIZE', 100))
+
+def updated_at(node):
+    # my_list_status.updated_at as a timestamp, None when MAL didn't send it
+    value = (node.get('my_list_status') or {}).get('updated_at')
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except (AttributeError, ValueError):
+        return None
+
+def list_row(node):
+    # All a snapshot keeps of a list node, the entries themselves live in the id cache
+    return {'id': node['id'], 'media_type': node.get('media_type'), 'my_list_status': node.get('my_list_status')}
+
+def newer_nodes(nodes, watermark):
+    # The leading nodes of a newest first page that changed since watermark, and whether an older one was reached
+    if watermark is None:
+        return nodes, False
+    for index, node in enumerate(nodes):
+        node_updated = updated_at(node)
+        if node_updated is not None and node_updated < watermark:
+            return nodes[:index], True
+    return nodes, False
+
+class UserListSnapshots:
+    def __init__(self, store, enabled = default_enabled, full_sync_interval = default_full_sync_interval, page_size = default_page_size):
+        self.store = store # {username: {'watermark': timestamp, 'full_synced_at': timestamp, 'rows': [list rows newest first]}}
+        self.enabled = enabled
+        self.full_sync_interval = full_sync_interval
+        self.page_size = page_size
+        self.lock = threading.RLock()
+
+    def plan(self, username, full = False):
+        # The watermark to sync down to, None asks for a full sync
+        snapshot = self.store.get(username)
+        if full or snapshot is None or snapshot.get('watermark') is None:
+            return None
+        if time.time() - snapshot['full_synced_at'] >= self.full_sync_interval:
+            return None
+        return snapshot['watermark']
+
+    def serves(self, username, amount = 0, prefetch = False):
+        # Whether a list read goes through the snapshot: always once a delta sync is enough, a cold one
+        # only for a whole list read, partial and streaming reads would wait for the whole list first
+        if not self.enabled:
+            return False
+        return self.plan(username) is not None or not (amount or prefetch)
+
+    def apply(self, username, nodes, complete, full_sync):
+        # Merges the fetched list nodes, complete means the list was read to its end or down to the watermark.
+        # -> (list rows newest first, {anime_id: node} of the rows whose entries need rebuilding)
+        with self.lock:
+            snapshot = self.store.get(username)
+            timestamps = [timestamp for timestamp in map(updated_at, nodes) if timestamp is not None]
+            if full_sync and complete:
+                rows = [list_row(node) for node in nodes]
+                # A full sync rebuilds every entry, the anime data could have changed without the list changing
+                self.store.set(username, {'watermark': max(timestamps, default=None), 'full_synced_at': time.time(), 'rows': rows})
+                return rows, {str(node['id']): node for node in nodes}
+            rows = snapshot['rows'] if snapshot else []
+            stored = {str(row['id']): row for row in rows}
+            changed = {str(node['id']): node for node in nodes if stored.get(str(node['id'])) != list_row(node)}
+            if snapshot is None:
+                # An incomplete first sync is returned but not kept
+                return [list_row(node) for node in nodes], changed
+            watermark = snapshot['watermark']
+            if complete and timestamps:
+                watermark = max(timestamps + [watermark])
+            if changed or watermark != snapshot['watermark']:
+                rows = [list_row(node) for node in changed.values()] + [row for row in rows if str(row['id']) not in changed]
+                self.store.set(username, dict(snapshot, watermark=watermark, rows=rows))
+            return rows, changed
+
+    def clear(self, username = None):
+        with self.lock:
+            if username is None:
+                self.store.clear()
+            else:
+                self.store.delete(username)
+
+    def configure(self, enabled = None, full_sync_interval = None, page_size = None):
+        if enabled is not None:
+            self.enabled = enabled
+        if full_sync_interval is not None:
+            self.full_sync_interval = full_sync_interval
+        if page_size is not None:
+            self.page_size = page_size
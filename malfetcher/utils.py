@@ -1,36 +1,146 @@
-import json, os
+import json, os, tempfile, threading
+from contextlib import contextmanager
+from .metrics import increment, span
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def to_json(value):
+    # Lets objects with a to_dict() (the entry models) be saved like plain dicts
+    if hasattr(value, 'to_dict'):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def env_flag(name, default = True):
+    # On/off env vars, 0, false and an empty value turn a flag off
+    return os.getenv(name, '1' if default else '0') not in ('0', 'false', 'False', '')
 
 silent_mode = True if os.getenv('WEEB_SILENCE', '') else False
+# MAL_CACHE_FSYNC=0 skips the fsync before the rename, faster but a power loss can lose the last write
+fsync_writes = env_flag('MAL_CACHE_FSYNC')
+
+# Serializers turn data into bytes and back, orjson is used when it's installed.
+# MAL_CACHE_SERIALIZER or set_serializer() pick one, register_serializer() adds more.
+
+def stdlib_dumps(data):
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=to_json).encode('utf-8')
+
+def orjson_dumps(data):
+    return orjson.dumps(data, default=to_json, option=orjson.OPT_NON_STR_KEYS)
+
+serializers = {'json': (stdlib_dumps, json.loads)}
+if orjson:
+    serializers['orjson'] = (orjson_dumps, orjson.loads)
+serializer_name = os.getenv('MAL_CACHE_SERIALIZER') or ('orjson' if orjson else 'json')
+
+def register_serializer(name, dumps, loads):
+    # dumps(data) -> bytes and loads(bytes) -> data
+    serializers[name] = (dumps, loads)
+
+def set_serializer(name):
+    global serializer_name
+    if name not in serializers:
+        raise ValueError(f"Unknown serializer {name}. Available serializers: {', '.join(serializers)}")
+    serializer_name = name
+
+def get_serializer():
+    return serializers.get(serializer_name) or serializers['json']
+
+def dumps(data, pretty = False):
+    if pretty:
+        # The human readable format the cache files always had
+        return json.dumps(data, indent=4, ensure_ascii=False, default=to_json).encode('utf-8')
+    return get_serializer()[0](data)
+
+def loads(raw):
+    return get_serializer()[1](raw)
 
-def utils_save_json(file_path, data, overwrite = True):
-    def update_json():
-        json_copy = utils_read_json(file_path)
-        if json_copy is None:
-            json_copy = {}
-        json_copy.update(data)
+def lock_file(file):
+    if fcntl:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+    elif msvcrt:
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+
+def unlock_file(file):
+    if fcntl:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+    elif msvcrt:
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+file_locks = {} # lock path -> [thread lock, depth, open lock file]
+file_locks_lock = threading.Lock()
+
+@contextmanager
+def file_lock(file_path):
+    # Advisory lock on file_path.lock, shared with other processes and reentrant within this one
+    lock_path = f"{file_path}.lock"
+    with file_locks_lock:
+        state = file_locks.setdefault(lock_path, [threading.RLock(), 0, None])
+    with state[0]:
+        if state[1] == 0:
+            if os.path.dirname(lock_path):
+                os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+            state[2] = open(lock_path, 'a+')
+            lock_file(state[2])
+        state[1] += 1
         try:
-            with open(file_path, "w", encoding="utf-8") as file:
-                json.dump(json_copy, file, indent=4, ensure_ascii=False)
-        except:
-            os.makedirs(os.path.dirname(file_path))
-            with open(file_path, "w", encoding="utf-8") as file:
-                json.dump(json_copy, file, indent=4, ensure_ascii=False)
-    json_file = utils_read_json(file_path)
-    if json_file != None:
-        if overwrite:
-            try:
-                with open(file_path, "w", encoding="utf-8") as file:
-                    json.dump(data, file, indent=4, ensure_ascii=False)
-            except:
-                os.makedirs(os.path.dirname(file_path))
-                with open(file_path, "w", encoding="utf-8") as file:
-                    json.dump(data, file, indent=4, ensure_ascii=False)
-        else:
-            update_json()
-    else:
-        update_json() 
+            yield
+        finally:
+            state[1] -= 1
+            if state[1] == 0:
+                unlock_file(state[2])
+                state[2].close()
+                state[2] = None
+
+def utils_save_json(file_path, data, overwrite = True, pretty = True):
+    # overwrite=False merges data into the file under the lock, so concurrent writers keep each other's keys.
+    # pretty=False writes compact json with the configured serializer.
+    with span('utils_save_json', file_path=file_path):
+        with file_lock(file_path):
+            if not overwrite:
+                merged = utils_read_json(file_path) if pretty else read_cache_file(file_path)
+                merged.update(data)
+                data = merged
+            write_json(file_path, data, pretty)
+    increment('malfetcher_cache_bytes_written_total', os.path.getsize(file_path), file=os.path.basename(file_path))
+
+def write_json(file_path, data, pretty = True):
+    # Dump into a temp file next to the target and rename it over the target,
+    # readers see either the old or the new file but never a partial one
+    directory = os.path.dirname(file_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    mode = os.stat(file_path).st_mode & 0o777 if os.path.exists(file_path) else 0o644
+    fd, temp_path = tempfile.mkstemp(dir=directory or None, prefix=f"{os.path.basename(file_path)}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(dumps(data, pretty))
+            file.flush()
+            if fsync_writes:
+                os.fsync(file.fileno())
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
 
 def utils_read_json(file_path):
+    # Config and other plain json files, the cache serializer never touches them
     if os.path.exists(file_path):
         with open(file_path, "r", encoding="utf-8") as json_file:
             data = json.load(json_file)
@@ -41,5 +151,26 @@ def utils_read_json(file_path):
     else:
         return {}
 
+def read_cache_file(file_path):
+    # Cache files, written with the configured serializer or as indented json
+    if not os.path.exists(file_path):
+        return {}
+    with open(file_path, "rb") as cache_file:
+        raw = cache_file.read()
+    increment('malfetcher_cache_bytes_read_total', len(raw), file=os.path.basename(file_path))
+    data = None
+    for decode in (loads, json.loads):
+        try:
+            data = decode(raw)
+            break
+        except Exception:
+            continue
+    if not isinstance(data, dict):
+        # Left behind by an older version that wrote in place, keep it aside and start over
+        print(f"Cache file {file_path} is corrupt, moving it to {file_path}.corrupt")
+        os.replace(file_path, f"{file_path}.corrupt")
+        return {}
+    return data
+
 def print_deb(*args, **kwargs):
     if not silent_mode: print(*args, **kwargs)
\ No newline at end of file
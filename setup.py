@@ -5,5 +5,6 @@ setup(
     description='A Python library to fetch data from MyAnimeList',
     author='Dominik Procházka',
     packages=find_packages(),
-    install_requires=['flask', 'gevent', 'requests']
+    install_requires=['flask', 'gevent', 'requests'],
+    extras_require={'aio': ['aiohttp'], 'fast': ['orjson']}
 )
\ No newline at end of file
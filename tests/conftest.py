@@ -0,0 +1,45 @@
+import os, sys, shutil, tempfile, pytest
+
+# The tests run against the local stub server from the benchmarks, it has to be up
+# before malfetcher is imported since the api urls are read at import time.
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_path)
+sys.path.insert(0, os.path.join(repo_path, 'benchmarks'))
+from stub_server import StubServer, make_franchises
+
+server = StubServer(make_franchises(20)).start()
+base_cache_dir = tempfile.mkdtemp(prefix='malfetcher-tests-')
+os.environ['MAL_API_URL'] = server.mal_url
+os.environ['ANILIST_API_URL'] = server.anilist_url
+os.environ['MAL_CACHE_DIR'] = base_cache_dir
+os.environ['MAL_CLIENT_ID'] = 'tests'
+os.environ['myanimelist_key'] = 'tests'
+os.environ['WEEB_SILENCE'] = '1'
+os.environ['MAL_REFRESH_AUTO'] = '0'
+
+def pytest_unconfigure(config):
+    server.stop()
+    shutil.rmtree(base_cache_dir, ignore_errors=True)
+
+@pytest.fixture
+def stub():
+    server.anime = make_franchises(20)
+    server.set_list(sorted(server.anime))
+    server.replayed.clear()
+    server.reset_stats()
+    return server
+
+@pytest.fixture
+def fetcher(stub, tmp_path):
+    # mal_fetcher with empty caches in tmp_path and nothing remembered from earlier tests
+    from malfetcher import mal_fetcher
+    from malfetcher.coalesce import response_memo
+    from malfetcher.retry import circuit_breakers, CircuitBreaker
+    mal_fetcher.set_cache_dir(str(tmp_path), 'json')
+    response_memo.invalidate()
+    for service in circuit_breakers:
+        circuit_breakers[service] = CircuitBreaker()
+    yield mal_fetcher
+    mal_fetcher.refresh_scheduler.stop()
+    mal_fetcher.http_cache.close()
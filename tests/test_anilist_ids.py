@@ -0,0 +1,28 @@
+import asyncio
+from malfetcher import aio
+
+def graphql_requests(stub):
+    return stub.stats()['paths'].get('/graphql', 0)
+
+def test_ids_are_resolved_in_chunks(fetcher, stub):
+    mal_ids = list(range(1, 61)) + [99999, 1]
+    al_ids = fetcher.mal_to_al_ids(mal_ids, chunk_size=25)
+    assert list(al_ids) == [str(mal_id) for mal_id in range(1, 61)] + ['99999']
+    assert al_ids['1'] == 100001 and al_ids['60'] == 100060
+    assert al_ids['99999'] is None
+    # 61 distinct ids in chunks of 25
+    assert graphql_requests(stub) == 3
+
+def test_cached_ids_are_not_requested_again(fetcher, stub):
+    fetcher.mal_to_al_ids(range(1, 11))
+    stub.reset_stats()
+    assert fetcher.mal_to_al_ids(range(1, 21), chunk_size=5)['15'] == 100015
+    assert graphql_requests(stub) == 2
+
+def test_ids_are_resolved_in_chunks_async(fetcher, stub):
+    async def run():
+        async with aio.AsyncClient() as client:
+            return await aio.mal_to_al_ids(range(1, 31), chunk_size=10, client=client)
+    al_ids = asyncio.run(run())
+    assert al_ids == {str(mal_id): mal_id + 100000 for mal_id in range(1, 31)}
+    assert graphql_requests(stub) == 3
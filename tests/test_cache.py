@@ -0,0 +1,184 @@
+import os, glob, pytest
+from malfetcher import cache, utils
+from malfetcher.cache import open_cache, JsonCache, MemoryCache, ShardedJsonCache
+
+backends = ['json', 'sharded', 'sqlite', 'records']
+
+def entry(anime_id, **changes):
+    return dict({'main_title': f"Anime {anime_id}", 'total_eps': 12, 'related': {'1': {'relation_type': 'sequel'}}}, **changes)
+
+def temp_files(directory):
+    return glob.glob(os.path.join(str(directory), '**', '*.tmp'), recursive=True)
+
+@pytest.mark.parametrize('backend', backends)
+def test_round_trip(backend, tmp_path):
+    file_path = str(tmp_path / 'myanimelist_id_cache.json')
+    writer = open_cache(file_path, backend, memory_tier=False)
+    writer.set('1', entry(1))
+    writer.update({'2': entry(2), 3: entry(3)})
+    writer.delete('2')
+    reader = open_cache(file_path, backend, memory_tier=False)
+    assert reader.get('1') == entry(1)
+    assert reader.get(3) == entry(3)
+    assert reader.get('2') is None
+    assert '1' in reader and '2' not in reader
+    assert sorted(reader.keys()) == ['1', '3']
+    assert reader.load() == {'1': entry(1), '3': entry(3)}
+
+    writer.save({'4': entry(4)})
+    assert open_cache(file_path, backend, memory_tier=False).load() == {'4': entry(4)}
+    writer.clear()
+    assert open_cache(file_path, backend, memory_tier=False).load() == {}
+
+@pytest.mark.parametrize('backend', backends)
+def test_batch_writes_once(backend, tmp_path):
+    file_path = str(tmp_path / 'myanimelist_id_cache.json')
+    writer = open_cache(file_path, backend, memory_tier=False)
+    with writer.batch():
+        for anime_id in range(20):
+            writer.set(str(anime_id), entry(anime_id))
+        assert writer.get('5') == entry(5)
+    assert open_cache(file_path, backend, memory_tier=False).load() == {str(anime_id): entry(anime_id) for anime_id in range(20)}
+
+@pytest.mark.parametrize('backend', backends)
+def test_failed_write_keeps_old_contents(backend, tmp_path):
+    file_path = str(tmp_path / 'myanimelist_id_cache.json')
+    writer = open_cache(file_path, backend, memory_tier=False)
+    writer.set('1', entry(1))
+    with pytest.raises(TypeError):
+        writer.set('2', entry(2, related=object()))
+    reader = open_cache(file_path, backend, memory_tier=False)
+    assert reader.get('1') == entry(1)
+    assert reader.get('2') is None
+    assert temp_files(tmp_path) == []
+
+@pytest.mark.parametrize('backend', ['json', 'records'])
+def test_interrupted_replace_keeps_old_file(backend, tmp_path, monkeypatch):
+    # Both write a temp file and rename it over the cache, a crash before the rename changes nothing
+    file_path = str(tmp_path / 'myanimelist_id_cache.json')
+    writer = open_cache(file_path, backend, memory_tier=False)
+    writer.set('1', entry(1))
+
+    def crash(source, target):
+        raise OSError("simulated crash")
+    monkeypatch.setattr(os, 'replace', crash)
+    with pytest.raises(OSError):
+        writer.set('1', entry(1, total_eps=24))
+    monkeypatch.undo()
+    assert open_cache(file_path, backend, memory_tier=False).get('1') == entry(1)
+    assert temp_files(tmp_path) == []
+
+def test_writers_keep_each_others_entries(tmp_path):
+    # Two cache objects on one file, like two processes, every write merges with what is on disk
+    file_path = str(tmp_path / 'myanimelist_id_cache.json')
+    first = JsonCache(file_path)
+    second = JsonCache(file_path)
+    first.set('1', entry(1))
+    second.set('2', entry(2))
+    first.set('3', entry(3))
+    assert sorted(JsonCache(file_path).keys()) == ['1', '2', '3']
+
+@pytest.mark.parametrize('memory_tier', [False, True])
+def test_values_are_copied_in_and_out(memory_tier, tmp_path):
+    stored = open_cache(str(tmp_path / 'myanimelist_id_cache.json'), 'json', memory_tier=memory_tier)
+    value = entry(1)
+    stored.set('1', value)
+    value['related']['1']['relation_type'] = 'changed by the caller'
+    read = stored.get('1')
+    assert read == entry(1)
+    read['related'].clear()
+    read['main_title'] = 'changed by the reader'
+    assert stored.get('1') == entry(1)
+
+def test_memory_tier_serves_repeated_reads(tmp_path):
+    file_path = str(tmp_path / 'myanimelist_id_cache.json')
+    stored = MemoryCache(JsonCache(file_path))
+    stored.set('1', entry(1))
+    os.remove(file_path)
+    assert stored.get('1') == entry(1)
+    stored.invalidate('1')
+    assert stored.get('1') is None
+
+@pytest.fixture
+def serializer():
+    previous = utils.serializer_name
+    yield
+    utils.set_serializer(previous)
+
+def test_serializer_selection(serializer, tmp_path):
+    utils.set_serializer('json')
+    assert utils.get_serializer() is utils.serializers['json']
+    assert utils.dumps({'a': 'é'}) == '{"a":"é"}'.encode('utf-8')
+    with pytest.raises(ValueError):
+        utils.set_serializer('missing')
+    assert utils.get_serializer() is utils.serializers['json']
+
+    calls = []
+    def tagged_dumps(data):
+        calls.append(data)
+        return utils.stdlib_dumps(data)
+    utils.register_serializer('tagged', tagged_dumps, utils.serializers['json'][1])
+    cache.configure_cache_format('tagged')
+    file_path = str(tmp_path / 'myanimelist_id_cache.json')
+    JsonCache(file_path).set('1', entry(1))
+    assert calls
+    assert JsonCache(file_path).get('1') == entry(1)
+
+@pytest.mark.skipif('orjson' not in utils.serializers, reason="orjson is not installed")
+def test_files_are_readable_with_any_serializer(serializer, tmp_path):
+    file_path = str(tmp_path / 'myanimelist_id_cache.json')
+    utils.set_serializer('orjson')
+    JsonCache(file_path).set('1', entry(1))
+    utils.set_serializer('json')
+    assert JsonCache(file_path).get('1') == entry(1)
+    JsonCache(file_path).set('2', entry(2))
+    utils.set_serializer('orjson')
+    assert JsonCache(file_path).load() == {'1': entry(1), '2': entry(2)}
+
+def test_pretty_files_stay_readable(serializer, tmp_path):
+    file_path = str(tmp_path / 'myanimelist_id_cache.json')
+    cache.configure_cache_format(pretty=True)
+    try:
+        JsonCache(file_path).set('1', entry(1))
+    finally:
+        cache.configure_cache_format(pretty=False)
+    with open(file_path, encoding='utf-8') as cache_file:
+        assert cache_file.read().startswith('{\n    "1"')
+    assert JsonCache(file_path).get('1') == entry(1)
+
+def test_corrupt_file_is_moved_aside(tmp_path):
+    file_path = str(tmp_path / 'myanimelist_id_cache.json')
+    with open(file_path, 'w', encoding='utf-8') as cache_file:
+        cache_file.write('[1, 2')
+    assert JsonCache(file_path).load() == {}
+    assert os.path.exists(file_path + '.corrupt')
+
+def test_sharded_cache_keeps_its_shard_count(tmp_path):
+    file_path = str(tmp_path / 'myanimelist_id_cache.json')
+    ShardedJsonCache(file_path, shards=64).update({str(anime_id): entry(anime_id) for anime_id in range(100)})
+    reopened = ShardedJsonCache(file_path, shards=16)
+    assert reopened.shard_count == 64
+    assert all(reopened.get(str(anime_id)) == entry(anime_id) for anime_id in range(100))
+    reopened.set('100', entry(100))
+    assert ShardedJsonCache(file_path, shards=64).get('100') == entry(100)
+
+    reopened.clear()
+    ShardedJsonCache(file_path, shards=16).set('1', entry(1))
+    assert ShardedJsonCache(file_path).shard_count == 16
+
+@pytest.mark.parametrize('backend', backends)
+@pytest.mark.parametrize('memory_tier', [False, True])
+def test_loaded_values_are_copies(backend, memory_tier, tmp_path):
+    stored = open_cache(str(tmp_path / 'myanimelist_id_cache.json'), backend, memory_tier=memory_tier)
+    stored.set('1', entry(1))
+    with stored.batch():
+        stored.set('2', entry(2))
+        loaded = stored.load()
+        loaded['2']['related'].clear()
+    loaded = stored.load()
+    loaded['1']['related'].clear()
+    loaded['1']['main_title'] = 'changed by the caller'
+    stored.set('3', entry(3))
+    assert stored.get('1') == entry(1)
+    assert stored.get('2') == entry(2)
+    assert open_cache(str(tmp_path / 'myanimelist_id_cache.json'), backend, memory_tier=False).load() == {str(anime_id): entry(anime_id) for anime_id in (1, 2, 3)}
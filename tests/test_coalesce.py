@@ -0,0 +1,73 @@
+import asyncio, threading
+from malfetcher.coalesce import SingleFlight, AsyncSingleFlight, ResponseMemo
+
+def anime_requests(stub):
+    return stub.stats()['paths'].get('/v2/anime/{id}', 0)
+
+def test_memo_answers_repeats(fetcher, stub):
+    url = f"{fetcher.mal_base_url}/anime/1"
+    first = fetcher.make_mal_request(url, {'fields': 'id,title'})
+    assert fetcher.make_mal_request(url, {'fields': 'id,title'}) == first
+    assert anime_requests(stub) == 1
+
+def test_force_update_skips_the_memo(fetcher, stub):
+    fetcher.get_anime_info(1)
+    stub.anime[1]['title'] = 'Renamed'
+    stub.reset_stats()
+    assert fetcher.get_anime_info(1, force_update=True)['1']['main_title'] == 'Renamed'
+    assert anime_requests(stub) == 1
+    # The new answer is remembered in place of the old one
+    assert fetcher.make_mal_request(f"{fetcher.anime_request_url}/1", {'fields': fetcher.projection_query(fetcher.get_projection(None))}, force_update=False)['title'] == 'Renamed'
+
+def test_force_update_many_skips_the_memo(fetcher, stub):
+    fetcher.get_anime_info_many([1, 2])
+    stub.anime[2]['title'] = 'Renamed'
+    stub.reset_stats()
+    entries = fetcher.get_anime_info_many([1, 2], force_update=True)
+    assert anime_requests(stub) == 2
+    assert entries['2']['main_title'] == 'Renamed'
+
+def test_concurrent_calls_share_one_run():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return {'value': 1}
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.run('key', slow)))
+    leader.start()
+    started.wait()
+    follower = threading.Thread(target=lambda: results.append(flight.run('key', slow)))
+    follower.start()
+    while flight.shared == 0:
+        pass
+    release.set()
+    leader.join()
+    follower.join()
+    assert calls == [1]
+    assert results == [{'value': 1}, {'value': 1}]
+    assert results[0] is not results[1]
+
+def test_refresh_replaces_the_memo():
+    flight = SingleFlight(ResponseMemo(ttl=60))
+    assert flight.run('key', lambda: {'value': 1}, memoize=True) == {'value': 1}
+    assert flight.run('key', lambda: {'value': 2}, memoize=True) == {'value': 1}
+    assert flight.run('key', lambda: {'value': 2}, memoize=True, refresh=True) == {'value': 2}
+    assert flight.run('key', lambda: {'value': 3}, memoize=True) == {'value': 2}
+
+def test_async_refresh_replaces_the_memo():
+    flight = AsyncSingleFlight(ResponseMemo(ttl=60))
+
+    async def value(number):
+        return {'value': number}
+
+    async def run():
+        assert await flight.run('key', lambda: value(1), memoize=True) == {'value': 1}
+        assert await flight.run('key', lambda: value(2), memoize=True) == {'value': 1}
+        assert await flight.run('key', lambda: value(2), memoize=True, refresh=True) == {'value': 2}
+    asyncio.run(run())
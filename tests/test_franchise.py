@@ -0,0 +1,70 @@
+import asyncio
+from malfetcher import aio
+from malfetcher.cache import open_cache
+from malfetcher.franchise import FranchiseIndex
+
+def make_node(title, **related):
+    return {'main_title': title, 'format': 'TV', 'total_eps': 12, 'status': 'FINISHED', 'related': {
+        relation_id: {'main_title': relation_id, 'status': 'FINISHED', 'type': relation_type} for relation_id, relation_type in related.items()
+    } or None}
+
+def make_index(tmp_path):
+    return FranchiseIndex(open_cache(str(tmp_path / 'nodes.json'), 'json'), open_cache(str(tmp_path / 'franchises.json'), 'json'))
+
+def test_season_ranges(fetcher, stub):
+    assert fetcher.get_season_ranges(2) == {
+        1: {'id': '1', 'start': 1, 'end': 12, 'total_eps': 12},
+        2: {'id': '2', 'start': 13, 'end': 25, 'total_eps': 12},
+        3: {'id': '3', 'start': 26, 'end': 38, 'total_eps': 12}
+    }
+
+def test_missing_sequel_is_skipped(fetcher, stub):
+    del stub.anime[3]
+    assert list(fetcher.get_season_ranges(1)) == [1, 2]
+    assert stub.stats()['requests'] < 20
+
+def test_missing_sequel_is_skipped_async(fetcher, stub):
+    del stub.anime[3]
+
+    async def run():
+        async with aio.AsyncClient() as client:
+            return await asyncio.wait_for(aio.get_season_ranges(1, client=client), 10)
+    assert list(asyncio.run(run())) == [1, 2]
+    assert stub.stats()['requests'] < 20
+
+def test_franchises_are_merged_as_edges_show_up(tmp_path):
+    index = make_index(tmp_path)
+    index.update({'2': make_node("B", **{'1': 'PREQUEL'})})
+    index.update({'10': make_node("X")})
+    assert index.get_franchise('1') == {'id': '1', 'members': ['1', '2'], 'seasons': ['2']}
+    # relations only seen from other entries are stubs
+    assert index.get_node('1') is None
+    index.set_ranges('2', {1: {'id': '2', 'start': 1, 'end': 12, 'total_eps': 12}})
+    assert index.get_ranges('1') == {1: {'id': '2', 'start': 1, 'end': 12, 'total_eps': 12}}
+    index.update({'3': make_node("C", **{'2': 'PREQUEL', '10': 'SEQUEL'}), '1': make_node("A", **{'2': 'SEQUEL'})})
+    franchise = index.get_franchise('10')
+    assert franchise == {'id': '1', 'members': ['1', '2', '3', '10'], 'seasons': ['1', '2', '3', '10']}
+    assert index.get_franchise('2') == franchise
+    assert list(index.franchises.keys()) == ['1']
+    # new members invalidate the computed season ranges
+    assert index.get_ranges('1') is None
+
+def test_unchanged_entries_keep_the_season_ranges(tmp_path):
+    index = make_index(tmp_path)
+    index.update({'1': make_node("A", **{'2': 'SEQUEL'}), '2': make_node("B", **{'1': 'PREQUEL'})})
+    index.set_ranges('1', {1: {'id': '1'}, 2: {'id': '2'}})
+    index.update({'2': make_node("B", **{'1': 'PREQUEL'})})
+    assert index.get_ranges('2') == {1: {'id': '1'}, 2: {'id': '2'}}
+
+def test_cycles_keep_every_season(tmp_path):
+    nodes = {'1': make_node("A", **{'2': 'SEQUEL'}), '2': make_node("B", **{'3': 'SEQUEL'}), '3': make_node("C", **{'1': 'SEQUEL'}), '4': make_node("D", **{'3': 'PREQUEL'})}
+    assert make_index(tmp_path).order_seasons(['1', '2', '3', '4'], nodes) == ['1', '2', '3', '4']
+
+def test_season_ranges_are_served_from_the_index(fetcher, stub):
+    assert fetcher.get_franchise(2)['seasons'] == ['2']
+    season_ranges = fetcher.get_season_ranges(3)
+    # the walk cached the whole franchise
+    assert fetcher.get_franchise(2) == {'id': '1', 'members': ['1', '2', '3'], 'seasons': ['1', '2', '3']}
+    stub.reset_stats()
+    assert fetcher.get_season_ranges(1) == season_ranges
+    assert stub.stats()['requests'] == 0
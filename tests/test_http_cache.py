@@ -0,0 +1,97 @@
+import pytest
+from malfetcher.coalesce import configure_request_coalescing
+from malfetcher.http_cache import HttpCache, not_modified
+
+@pytest.fixture
+def no_memo():
+    # Every call reaches the server, the response memo would answer repeats by itself
+    memo = configure_request_coalescing()
+    ttl = memo.ttl
+    configure_request_coalescing(memo_ttl=0)
+    yield
+    configure_request_coalescing(memo_ttl=ttl)
+
+@pytest.fixture
+def http_cache(tmp_path):
+    cache = HttpCache(str(tmp_path / 'http_validators.sqlite3'))
+    yield cache
+    cache.close()
+
+def test_repeated_request_is_revalidated(fetcher, stub, no_memo):
+    url = f"{fetcher.mal_base_url}/anime"
+    params = {'q': 'franchise 1', 'limit': 5}
+    first = fetcher.make_mal_request(url, params)
+    stub.reset_stats()
+    assert fetcher.make_mal_request(url, params) == first
+    assert stub.stats()['not_modified'] == 1
+    assert stub.stats()['bytes_sent'] == 0
+
+def test_changed_response_is_sent_again(fetcher, stub, no_memo):
+    url = f"{fetcher.mal_base_url}/anime/1"
+    fetcher.make_mal_request(url, {'fields': 'id,title'})
+    stub.anime[1]['title'] = 'Renamed'
+    stub.reset_stats()
+    assert fetcher.make_mal_request(url, {'fields': 'id,title'})['title'] == 'Renamed'
+    assert stub.stats()['not_modified'] == 0
+
+def test_force_update_keeps_unchanged_entries(fetcher, stub, no_memo):
+    cold = fetcher.get_anime_info_many([1, 2])
+    stub.reset_stats()
+    assert fetcher.get_anime_info_many([1, 2], force_update=True) == cold
+    assert stub.stats()['paths']['/v2/anime/{id}'] == 2
+    assert stub.stats()['not_modified'] == 2
+    # The entries are in the id cache already, only the validators are kept for them
+    rows = fetcher.http_cache.load()
+    params = {'fields': fetcher.projection_query(fetcher.get_projection(None))}
+    for anime_id in (1, 2):
+        assert rows[fetcher.http_cache.key(f"{fetcher.anime_request_url}/{anime_id}", params)]['body'] is None
+
+def test_cleared_entries_are_fetched_again(fetcher, stub, no_memo):
+    cold = fetcher.get_anime_info_many([1])
+    fetcher.mal_id_cache.clear()
+    stub.reset_stats()
+    # Only validators were stored for it, so the node is sent in full again
+    assert fetcher.get_anime_info_many([1]) == cold
+
+def test_user_requests_are_not_stored(http_cache):
+    key, entry, headers = http_cache.lookup('https://example.com/v2/users/@me/animelist', {}, {'Authorization': 'Bearer token'})
+    assert key is None and entry is None
+    assert 'If-None-Match' not in headers
+    http_cache.save(key, {'ETag': '"a"'}, {'data': []})
+    assert http_cache.load() == {}
+
+def test_validators_are_needed(http_cache):
+    key, _, _ = http_cache.lookup('https://example.com/v2/anime/1', {}, {})
+    http_cache.save(key, {}, {'id': 1})
+    assert http_cache.load() == {}
+    http_cache.save(key, {'ETag': '"a"'}, {'id': 1})
+    _, entry, headers = http_cache.lookup('https://example.com/v2/anime/1', {}, {})
+    assert headers['If-None-Match'] == '"a"'
+    assert http_cache.revalidated(entry) == {'id': 1}
+
+def test_validators_only(http_cache):
+    key, _, _ = http_cache.lookup('https://example.com/v2/anime/1', {}, {})
+    http_cache.save(key, {'ETag': '"a"'}, {'id': 1}, keep_body=False)
+    # A caller that needs the body doesn't send validators it can't use
+    assert http_cache.lookup('https://example.com/v2/anime/1', {}, {})[1] is None
+    _, entry, _ = http_cache.lookup('https://example.com/v2/anime/1', {}, {}, keep_body=False)
+    assert http_cache.revalidated(entry) is not_modified
+
+def test_least_recently_used_rows_are_evicted(http_cache):
+    http_cache.max_entries = 3
+    keys = []
+    for anime_id in range(5):
+        key, _, _ = http_cache.lookup(f'https://example.com/v2/anime/{anime_id}', {}, {})
+        http_cache.save(key, {'ETag': f'"{anime_id}"'}, {'id': anime_id})
+        keys.append(key)
+    _, entry, _ = http_cache.lookup('https://example.com/v2/anime/0', {}, {})
+    http_cache.revalidated(entry)
+    http_cache.trim()
+    assert sorted(http_cache.load()) == sorted([keys[0], keys[3], keys[4]])
+
+def test_disabled(tmp_path):
+    http_cache = HttpCache(str(tmp_path / 'http_validators.sqlite3'), enabled=False)
+    assert http_cache.lookup('https://example.com/v2/anime/1', {}, {}) == (None, None, {})
+    with http_cache.batch():
+        pass
+    assert http_cache.connection is None
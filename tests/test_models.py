@@ -0,0 +1,29 @@
+import asyncio, pytest
+from malfetcher import aio
+from malfetcher.models import AnimeEntry
+
+@pytest.fixture
+def entry_model(fetcher):
+    fetcher.use_entry_model(True)
+    yield fetcher
+    fetcher.use_entry_model(False)
+
+def test_same_type_from_the_api_and_the_cache(entry_model, stub):
+    cold = entry_model.get_anime_info(1)['1']
+    warm = entry_model.get_anime_info(1)['1']
+    assert isinstance(cold, AnimeEntry) and isinstance(warm, AnimeEntry)
+    assert cold.to_dict() == warm.to_dict()
+    assert stub.stats()['paths']['/v2/anime/{id}'] >= 1
+    # Stored once by generate_anime_entries, as a plain dict
+    assert type(entry_model.mal_id_cache.get('1')) is dict
+
+def test_same_type_from_the_async_api(entry_model, stub):
+    async def run():
+        async with aio.AsyncClient() as client:
+            return (await aio.get_anime_info(1, client=client))['1'], (await aio.get_anime_info(1, client=client))['1']
+    cold, warm = asyncio.run(run())
+    assert isinstance(cold, AnimeEntry) and isinstance(warm, AnimeEntry)
+
+def test_plain_dicts_by_default(fetcher, stub):
+    assert type(fetcher.get_anime_info(1)['1']) is dict
+    assert type(fetcher.get_anime_info(1)['1']) is dict
@@ -0,0 +1,35 @@
+from malfetcher.mal_fetcher import get_projection, projection_query, projections, anime_fields, user_anime_fields
+
+def test_get_projection():
+    assert get_projection() == projections['full']
+    assert get_projection('minimal') == ('main_title', 'format')
+    assert get_projection('nope') == projections['full']
+    # entry field order, unknown fields dropped
+    assert get_projection(['format', 'nope', 'total_eps']) == ('total_eps', 'format')
+
+def test_projection_query():
+    assert projection_query(projections['full']) == anime_fields
+    assert projection_query(projections['full'], True) == user_anime_fields
+    assert projection_query(get_projection('minimal')) == "id,title,media_type"
+    assert projection_query(('upcoming_ep', 'status')) == "id,status,start_date"
+    user_query = projection_query(('total_eps',), True).split(",")
+    assert user_query[:3] == ['id', 'num_episodes', 'media_type']
+    assert user_query[3].startswith("my_list_status{")
+
+def test_partial_entries_are_upgraded(fetcher, stub):
+    minimal = fetcher.get_anime_info(1, projection='minimal')['1']
+    assert dict(minimal) == {'main_title': "Franchise 0", 'format': 'TV'}
+    # no relation or AniList lookups for the minimal fields
+    assert stub.stats()['paths'] == {'/v2/anime/{id}': 1}
+    full = fetcher.get_anime_info(1)['1']
+    assert set(full) == set(projections['full'])
+    stub.reset_stats()
+    # the cached full entry covers any projection
+    assert fetcher.get_anime_info(1, projection='list')['1'] == full
+    assert stub.stats()['requests'] == 0
+
+def test_partial_refetch_keeps_cached_fields(fetcher, stub):
+    fetcher.get_anime_info(1)
+    fetcher.get_anime_info_many([1, 2], True, projection=['status'])
+    assert set(fetcher.mal_id_cache.get('1')) == set(projections['full'])
+    assert set(fetcher.mal_id_cache.get('2')) == {'status'}
@@ -0,0 +1,42 @@
+import time, asyncio, threading
+from malfetcher.rate_limit import TokenBucket
+from malfetcher.utils import lock_file, unlock_file
+
+def test_local_bucket_waits_for_tokens():
+    bucket = TokenBucket(20, 2)
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    assert bucket.acquire() > 0
+    assert bucket.stats()['waited'] == 1
+
+def test_shared_bucket_does_not_block_the_event_loop(tmp_path):
+    bucket = TokenBucket(10, 1, str(tmp_path / 'mal_rate_limit.json'), 'mal')
+    bucket.acquire()
+    locked = threading.Event()
+
+    def hold_lock():
+        # another process holding the state file
+        with open(bucket.state_path, 'a+', encoding="utf-8") as file:
+            lock_file(file)
+            locked.set()
+            time.sleep(0.3)
+            unlock_file(file)
+
+    async def run():
+        ticks = 0
+
+        async def heartbeat():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        locked.wait(5)
+        beat = asyncio.create_task(heartbeat())
+        await bucket.acquire_async()
+        beat.cancel()
+        holder.join()
+        return ticks
+    assert asyncio.run(run()) >= 10
+    assert bucket.stats()['acquired'] == 2
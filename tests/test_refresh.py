@@ -0,0 +1,74 @@
+import time, threading
+from malfetcher.cache import open_cache
+from malfetcher.refresh import RefreshScheduler, next_expected_change, min_recheck, failure_retry
+
+def make_scheduler(tmp_path, entries, refresh_entries, **options):
+    return RefreshScheduler(open_cache(str(tmp_path / 'schedule.json'), 'json', memory_tier=False), lambda: entries, refresh_entries, **options)
+
+def test_next_expected_change():
+    now = time.time()
+    assert next_expected_change({'status': "FINISHED"}) is None
+    assert next_expected_change({'title': "partial entry"}) is None
+    assert next_expected_change({'status': "NOT_YET_RELEASED"}) >= now
+    releasing = {'status': "RELEASING", 'release_date': '2020-01-01', 'end_date': '2020-01-10', 'upcoming_ep': 4}
+    # the end date comes before the 4th weekly episode
+    assert next_expected_change(releasing) == time.mktime((2020, 1, 11, 0, 0, 0, 0, 0, -1))
+
+def test_run_refreshes_due_entries_within_budget(tmp_path):
+    entries = {str(anime_id): {'status': "NOT_YET_RELEASED"} for anime_id in range(5)}
+    entries['9'] = {'status': "FINISHED"}
+    calls = []
+
+    def refresh_entries(anime_ids):
+        calls.append(anime_ids)
+        return {anime_id: {'status': "FINISHED"} for anime_id in anime_ids}
+    scheduler = make_scheduler(tmp_path, entries, refresh_entries, budget=2, auto=False)
+    # cached entries without a schedule are due right away, finished ones are never refreshed
+    assert scheduler.pending() == 5
+    assert len(scheduler.run()) == 2
+    assert scheduler.pending() == 3
+    assert len(scheduler.run(10)) == 3
+    assert scheduler.run() == []
+    assert sorted(anime_id for anime_ids in calls for anime_id in anime_ids) == [str(anime_id) for anime_id in range(5)]
+    # refreshed entries that finished airing leave the persisted schedule
+    assert scheduler.store.load() == {}
+
+def test_failed_refreshes_are_retried_later(tmp_path):
+    scheduler = make_scheduler(tmp_path, {'1': {'status': "RELEASING"}, '2': {'status': "RELEASING"}}, lambda anime_ids: {'2': {'status': "RELEASING"}}, auto=False)
+    now = time.time()
+    assert scheduler.run() == ['2']
+    assert scheduler.pending() == 0
+    schedule = scheduler.store.load()
+    assert now + failure_retry <= schedule['1'] < now + min_recheck
+    assert schedule['2'] >= now + min_recheck
+
+def test_poke_refreshes_in_the_background(tmp_path):
+    release = threading.Event()
+
+    def refresh_entries(anime_ids):
+        release.wait(5)
+        return {anime_id: {'status': "FINISHED"} for anime_id in anime_ids}
+    scheduler = make_scheduler(tmp_path, {'1': {'status': "RELEASING"}}, refresh_entries, auto=True)
+    started = time.perf_counter()
+    scheduler.poke()
+    assert time.perf_counter() - started < 1
+    worker = scheduler.worker
+    scheduler.poke() # within the interval, no second worker
+    assert scheduler.worker is worker
+    release.set()
+    worker.join(5)
+    assert scheduler.pending() == 0
+
+def test_fetched_airing_entries_are_scheduled(fetcher, stub):
+    for anime_id in (1, 2, 3):
+        stub.anime[anime_id]['status'] = 'currently_airing'
+    fetcher.get_anime_info_many([1, 2, 3, 4])
+    schedule = fetcher.refresh_scheduler.store.load()
+    assert sorted(schedule) == ['1', '2', '3']
+    assert min(schedule.values()) >= time.time() + min_recheck - 60
+    assert fetcher.refresh_scheduler.pending() == 0
+    fetcher.refresh_scheduler.push('2', 0)
+    stub.reset_stats()
+    assert fetcher.refresh_stale_entries() == ['2']
+    assert stub.stats()['requests'] >= 1
+    assert fetcher.refresh_scheduler.pending() == 0
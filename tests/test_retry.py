@@ -0,0 +1,135 @@
+import pytest
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from stub_server import recording_key
+from malfetcher import retry
+from malfetcher.retry import RetryPolicy, CircuitBreaker, configure_retry_policy
+
+def stub_key(anime_id):
+    # What the stub answers GET /anime/<id>?fields=id with is looked up by this key
+    return recording_key('GET', f"/v2/anime/{anime_id}", {'fields': 'id'}, {})
+
+@pytest.fixture
+def clock(monkeypatch):
+    # time.monotonic() of the retry module, moved by hand
+    now = [1000.0]
+    monkeypatch.setattr(retry.time, 'monotonic', lambda: now[0])
+    return now
+
+@pytest.fixture
+def quick_retries():
+    policy, breaker = retry.retry_policies['mal'], retry.circuit_breakers['mal']
+    configure_retry_policy('mal', RetryPolicy(max_retries=3, base_delay=0, max_delay=0))
+    yield retry.retry_policies['mal']
+    configure_retry_policy('mal', policy, breaker)
+
+def test_backoff_is_capped():
+    policy = RetryPolicy(base_delay=1, max_delay=4)
+    for attempt in range(10):
+        assert 0 <= policy.backoff(attempt) <= min(4, 2 ** attempt)
+
+def test_unknown_status_is_not_retried():
+    state = RetryPolicy().start()
+    assert state.next_delay(404) is None
+    assert state.total_attempts == 0
+
+def test_retry_limits(clock):
+    policy = RetryPolicy(max_retries=3, base_delay=0, status_rules={500: {}, 400: {'max_retries': 1}})
+    state = policy.start()
+    assert state.next_delay(400) == 0
+    assert state.next_delay(400) is None
+    assert state.next_delay(500) == 0
+    assert state.next_delay(500) == 0
+    # The total over all statuses is capped by max_retries too
+    assert state.next_delay(500) is None
+    assert state.attempts == {400: 1, 500: 2}
+
+def test_retry_after_is_honoured(clock):
+    policy = RetryPolicy(base_delay=0, status_rules={429: {'retry_after': True}, 503: {}})
+    state = policy.start()
+    assert state.next_delay(429, '7') == 7
+    assert state.next_delay(503, '7') == 0
+
+def test_retry_after_date(clock):
+    state = RetryPolicy(base_delay=0, status_rules={429: {'retry_after': True}}).start()
+    retry_at = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=20), usegmt=True)
+    assert 18 <= state.next_delay(429, retry_at) <= 20
+    assert state.next_delay(429, format_datetime(datetime(2020, 1, 1, tzinfo=timezone.utc), usegmt=True)) == 0
+    # Anything else falls back to the backoff
+    assert state.next_delay(429, 'soon') == 0
+
+def test_deadline(clock):
+    state = RetryPolicy(base_delay=0, deadline=10, status_rules={429: {'retry_after': True}}).start()
+    assert state.next_delay(429, '5') == 5
+    clock[0] += 6
+    assert state.next_delay(429, '5') is None
+
+def test_circuit_breaker_states(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    assert breaker.state == 'closed'
+    breaker.record_failure()
+    assert breaker.state == 'closed' and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+    clock[0] += 30
+    assert breaker.state == 'half-open'
+    # A single trial request goes through
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+
+    clock[0] += 30
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    assert breaker.allow() and breaker.allow()
+
+def test_trial_can_end_without_an_answer(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock[0] += 30
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.end_trial()
+    assert breaker.allow()
+
+def test_success_resets_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=2)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+
+def test_server_errors_are_retried(fetcher, stub, quick_retries):
+    stub.replayed[stub_key(1)] = (503, {'error': 'unavailable'})
+    assert fetcher.send_mal_request(f"{fetcher.mal_base_url}/anime/1", {'fields': 'id'}) == {}
+    assert stub.stats()['requests'] == quick_retries.max_retries + 1
+
+def test_failures_open_the_circuit(fetcher, stub, quick_retries):
+    configure_retry_policy('mal', circuit_breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60))
+    stub.replayed[stub_key(1)] = (500, {'error': 'internal'})
+    fetcher.send_mal_request(f"{fetcher.mal_base_url}/anime/1", {'fields': 'id'})
+    assert retry.circuit_breakers['mal'].state == 'open'
+    assert stub.stats()['requests'] == 2
+    # Fails fast without touching the server
+    assert fetcher.send_mal_request(f"{fetcher.mal_base_url}/anime/2", {'fields': 'id'}) == {}
+    assert stub.stats()['requests'] == 2
+
+def test_crashed_trial_keeps_the_circuit_usable(fetcher, stub, quick_retries, clock, monkeypatch):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    configure_retry_policy('mal', circuit_breaker=breaker)
+    breaker.record_failure()
+    clock[0] += 30
+
+    def broken_request(*args, **kwargs):
+        raise ValueError("not a connection error")
+    request = fetcher.http_client.request
+    monkeypatch.setattr(fetcher.http_client, 'request', broken_request)
+    with pytest.raises(ValueError):
+        fetcher.send_mal_request(f"{fetcher.mal_base_url}/anime/1", {'fields': 'id'})
+    monkeypatch.setattr(fetcher.http_client, 'request', request)
+    assert fetcher.send_mal_request(f"{fetcher.mal_base_url}/anime/1", {'fields': 'id'})['id'] == 1
+    assert breaker.state == 'closed'
@@ -0,0 +1,32 @@
+from malfetcher.title_index import TitleIndex, normalize_title
+
+def test_normalize_title():
+    assert normalize_title("Shöw:  2nd_Season!") == "show 2nd season"
+
+def test_index_is_built_lazily_and_kept_current():
+    entries = {'1': {'main_title': "Frieren", 'synonyms': ["Sousou no Frieren"], 'format': 'TV'}}
+    index = TitleIndex(lambda: entries)
+    index.add({'2': {'main_title': "Ignored", 'format': 'TV'}}) # the build reads everything from the cache
+    assert index.search("sousou no frieren") == [('1', 1.0, "sousou no frieren")]
+    assert index.search("ignored") == []
+    index.add({'1': {'main_title': "Frieren 2nd Season", 'format': 'MOVIE'}})
+    assert index.search("sousou no frieren") == []
+    assert index.search("frieren 2nd season", 'TV') == []
+    assert index.search("frieren 2nd season", 'MOVIE')[0][0] == '1'
+
+def test_numbers_have_to_match(fetcher, stub):
+    fetcher.get_anime_info_many(range(1, 7))
+    assert fetcher.search_titles("FRANCHISE-1 2th Season!") == [('5', 1.0, "franchise 1 2th season")]
+    assert [anime_id for anime_id, _, _ in fetcher.search_titles("Franchise 1 3th Season")] == ['6']
+    assert fetcher.search_titles("Franchse 0") == []
+    assert fetcher.search_titles("Franchse 0", threshold=0.5)[0][0] == '1'
+    assert fetcher.search_titles("franchise 1 synonym", 'tv')[0][0] == '4'
+    assert fetcher.search_titles("franchise 1 synonym", 'movie') == []
+
+def test_get_id_uses_the_index_before_the_api(fetcher, stub):
+    fetcher.get_anime_info_many(range(1, 7))
+    stub.reset_stats()
+    assert list(fetcher.get_id("franchise-1", 'tv')) == ['4']
+    assert stub.stats()['requests'] == 0
+    assert list(fetcher.get_id("Franchise 4", 'tv')) == ['13']
+    assert stub.stats()['paths']['/v2/anime'] == 1
@@ -0,0 +1,34 @@
+import asyncio
+from malfetcher import aio
+
+# Every stub list entry starts as watching with 1 episode, franchises are 3 seasons of 12 episodes
+progress_map = {1: 1, 2: 5, 4: 30, 10: 14, 11: 5, 99999: 3}
+
+def check_report(report, stub):
+    assert report['1'] == {'id': '1', 'progress': 1, 'result': "skipped", 'reason': "progress is lower or equal than user progress"}
+    assert report['2'] == {'id': '2', 'progress': 5, 'params': {'num_watched_episodes': 5}, 'result': "updated"}
+    # 30 episodes into the franchise of 4 is episode 6 of its third season
+    assert report['4'] == {'id': '6', 'progress': 6, 'params': {'num_watched_episodes': 6}, 'result': "updated"}
+    assert report['10'] == {'id': '11', 'progress': 2, 'result': "skipped", 'reason': "superseded by another update"}
+    assert report['11']['result'] == "updated"
+    assert report['99999'] == {'result': "failed", 'reason': "anime not found"}
+    assert stub.stats()['paths']['/v2/anime/{id}/my_list_status'] == 3
+    assert {anime_id: stub.list_status[anime_id]['num_episodes_watched'] for anime_id in (1, 2, 6, 11)} == {1: 1, 2: 5, 6: 6, 11: 5}
+
+def test_update_entries(fetcher, stub):
+    check_report(fetcher.update_entries(progress_map, 'tests'), stub)
+
+def test_update_entries_async(fetcher, stub):
+    async def run():
+        async with aio.AsyncClient() as client:
+            return await aio.update_entries(progress_map, 'tests', client)
+    check_report(asyncio.run(run()), stub)
+
+def test_later_season_requests_supersede_by_progress(fetcher):
+    anime_infos = {'2': {'total_eps': 12, 'watched_ep': 1, 'watching_status': 'CURRENT'}}
+    targets = {'1': ('2', 8), '2': ('2', 3)}
+    report, updates, owners = fetcher.plan_entry_updates({'1': 20, '2': 3, '3': 1}, targets, anime_infos)
+    assert updates == {'2': {'num_watched_episodes': 8}}
+    assert owners == {'2': '1'}
+    assert report['2']['reason'] == "superseded by another update"
+    assert report['3'] == {'result': "failed", 'reason': "anime not found"}
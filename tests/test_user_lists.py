@@ -0,0 +1,77 @@
+from malfetcher.user_lists import UserListSnapshots, newer_nodes
+from malfetcher.cache import open_cache
+
+def list_requests(stub):
+    return stub.stats()['paths'].get('/v2/users/stub_user/animelist', 0)
+
+def test_warm_sync_reads_one_page(fetcher, stub):
+    cold = fetcher.get_all_anime_for_user('ALL')
+    assert len(cold) == len(stub.anime)
+    stub.reset_stats()
+    assert fetcher.get_all_anime_for_user('ALL') == cold
+    assert list_requests(stub) == 1
+    assert stub.stats()['paths'].get('/v2/anime/{id}', 0) == 0
+
+def test_changed_rows_are_merged(fetcher, stub):
+    fetcher.get_all_anime_for_user('ALL')
+    stub.update_list_status(5, num_episodes_watched=9)
+    stub.update_list_status(7, status='completed')
+    stub.reset_stats()
+    entries = fetcher.get_all_anime_for_user('ALL')
+    assert entries['5']['watched_ep'] == 9
+    assert entries['7']['watching_status'] == 'COMPLETED'
+    # Newest first like MAL sorts the list
+    assert list(entries)[:2] == ['7', '5']
+    assert list_requests(stub) == 1
+    assert list(fetcher.get_all_anime_for_user('COMPLETED')) == ['7']
+
+def test_removed_rows_go_with_the_full_sync(fetcher, stub):
+    fetcher.get_all_anime_for_user('ALL')
+    del stub.list_status[3]
+    assert '3' in fetcher.get_all_anime_for_user('ALL')
+    fetcher.configure_user_list_sync(full_sync_interval=0)
+    try:
+        assert '3' not in fetcher.get_all_anime_for_user('ALL')
+    finally:
+        fetcher.configure_user_list_sync(full_sync_interval=3600)
+
+def test_partial_cold_reads_stay_paged(fetcher, stub):
+    entries = fetcher.get_all_anime_for_user('ALL', amount=5)
+    assert len(entries) == 5
+    assert list_requests(stub) == 1
+    assert fetcher.user_list_snapshots.store.get('stub_user') is None
+
+def test_disabled_snapshots_fetch_everything(fetcher, stub):
+    cold = fetcher.get_all_anime_for_user('ALL')
+    fetcher.configure_user_list_sync(enabled=False)
+    try:
+        stub.reset_stats()
+        assert fetcher.get_all_anime_for_user('ALL') == cold
+        assert stub.stats()['bytes_sent'] > 0
+    finally:
+        fetcher.configure_user_list_sync(enabled=True)
+
+def node(anime_id, second, status = 'watching'):
+    return {'id': anime_id, 'media_type': 'tv', 'my_list_status': {'status': status, 'updated_at': f"2024-01-01T00:00:{second:02d}+00:00"}}
+
+def test_newer_nodes():
+    nodes = [node(3, 30), node(2, 20), node(1, 10)]
+    assert newer_nodes(nodes, None) == (nodes, False)
+    changed, reached = newer_nodes(nodes, 1704067220)
+    assert [item['id'] for item in changed] == [3, 2]
+    assert reached
+
+def test_apply_and_plan(tmp_path):
+    snapshots = UserListSnapshots(open_cache(str(tmp_path / 'user_lists.json'), 'json', memory_tier=False))
+    assert snapshots.plan('user') is None
+    rows, changed = snapshots.apply('user', [node(2, 20), node(1, 10)], complete=True, full_sync=True)
+    assert [row['id'] for row in rows] == [2, 1]
+    assert set(changed) == {'2', '1'}
+    assert snapshots.plan('user') == 1704067220
+    assert snapshots.serves('user', amount=1)
+
+    rows, changed = snapshots.apply('user', [node(1, 40, 'completed')], complete=True, full_sync=False)
+    assert [row['id'] for row in rows] == [1, 2]
+    assert list(changed) == ['1']
+    assert snapshots.plan('user') == 1704067240
+    assert snapshots.plan('user', full=True) is None